@@ -0,0 +1,923 @@
+import asyncio
+import json
+import os
+import time
+import zlib
+import utils
+import compression
+import monitor
+import manifest_cache
+import striped
+import dirsync
+import catalog
+import resume
+import delta
+import storage
+import protocol2
+
+# asyncio engine for the same wire protocol as server.handle_client.
+# One coroutine per connection instead of one thread, so thousands of mostly
+# idle sync clients cost a few KB each. Hashing and file I/O run on the
+# default executor so they never stall the event loop.
+
+BACKLOG = 1024
+IO_CHUNK = 64 * 1024
+
+async def _blocking(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+def _write_and_hash(f, hasher, data):
+    f.write(data)
+    hasher.update(data)
+
+def _write_chunk(f, on_data, data):
+    f.write(data)
+    if on_data:
+        on_data(data)
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+def _write_at(f, offset, data):
+    f.seek(offset)
+    f.write(data)
+
+async def _send(writer, data):
+    writer.write(data)
+    await writer.drain()
+
+async def _recv_binary_manifest(reader, server_hashes, expected=None, digest_len=32, block_size=utils.BLOCK_SIZE):
+    """Async version of utils.recv_binary_manifest."""
+    header = utils.parse_manifest_header(await reader.readexactly(utils.MANIFEST_HEADER_SIZE), digest_len, block_size)
+    if header is None:
+        return None
+    total_blocks, digest_len = header
+
+    missing_blocks = []
+    index = 0
+    while index < total_blocks:
+        count = min(utils.MANIFEST_BATCH, total_blocks - index)
+        data = await reader.readexactly(count * digest_len)
+        await _blocking(utils.diff_digest_batch, data, index, digest_len, server_hashes, missing_blocks, expected)
+        index += count
+
+    file_hash = await reader.readexactly(32)
+    return total_blocks, missing_blocks, file_hash.hex()
+
+async def _recv_chunk_manifest(reader, server_chunks):
+    """Async version of utils.recv_chunk_manifest."""
+    server_index = utils.index_chunks(server_chunks)
+    plan = []
+    missing_chunks = []
+    dst_offset = 0
+    while True:
+        entry = await reader.readexactly(36)
+        length = int.from_bytes(entry[:4], 'big')
+        digest = entry[4:].hex()
+        if length == 0:
+            return plan, missing_chunks, digest
+
+        src = server_index.get(digest)
+        if src is None:
+            missing_chunks.append(len(plan))
+        plan.append([dst_offset, length, src, digest])
+        dst_offset += length
+
+async def _merkle_exchange(reader, writer, server_hashes, total_blocks, max_blocks, expected):
+    """Async version of utils.merkle_exchange_server."""
+    if total_blocks > max_blocks:
+        return None
+    if total_blocks == 0:
+        return [], 0
+
+    levels = await _blocking(utils.build_server_merkle_tree, server_hashes, total_blocks)
+    frontier = [0]
+    rounds = 0
+
+    for level in range(len(levels) - 1, -1, -1):
+        count = int.from_bytes(await reader.readexactly(4), 'big')
+        if count != len(frontier):
+            return None
+        data = await reader.readexactly(count * 32)
+
+        flags = [data[k * 32:(k + 1) * 32] != levels[level][node] for k, node in enumerate(frontier)]
+        await _send(writer, utils.pack_bitmap(flags))
+        rounds += 1
+
+        differing = [node for node, flag in zip(frontier, flags) if flag]
+        if level == 0:
+            for k, node in enumerate(frontier):
+                if flags[k]:
+                    expected[node] = data[k * 32:(k + 1) * 32].hex()
+            return differing, rounds
+        if not differing:
+            return [], rounds
+        frontier = utils.merkle_children(differing, len(levels[level - 1]))
+
+async def _recv_delta_op(reader):
+    """Async version of utils.recv_delta_op."""
+    kind = await reader.readexactly(1)
+    if kind == b"C":
+        header = await reader.readexactly(12)
+        return ("COPY", int.from_bytes(header[:8], 'big'), int.from_bytes(header[8:], 'big'))
+    if kind == b"L":
+        length = int.from_bytes(await reader.readexactly(4), 'big')
+        if length > utils.LITERAL_MAX_LENGTH:
+            return None
+        return ("LITERAL", await reader.readexactly(length))
+    if kind == b"E":
+        return ("END", (await reader.readexactly(64)).decode())
+    return None
+
+async def _read_frame(reader, header=None, max_raw=compression.MAX_FRAME_SIZE):
+    """
+    Reads one compression frame (after `header` if already read). None if
+    malformed or longer than `max_raw` raw bytes.
+    """
+    if header is None:
+        header = await reader.readexactly(compression.FRAME_HEADER_SIZE)
+    frame = compression.parse_frame_header(header, max_raw)
+    if frame is None:
+        return None
+    raw_len, codec, payload_len = frame
+    payload = await reader.readexactly(payload_len)
+    return await _blocking(compression.decode_frame, raw_len, codec, payload)
+
+async def _send_frame(writer, compressor, prefix, data):
+    """Sends `prefix` + a compression frame of `data`, timing the write for the link estimate."""
+    frame_header, payload = await _blocking(compressor.frame, data)
+    start = time.perf_counter()
+    writer.write(prefix + frame_header + payload)
+    await writer.drain()
+    compressor.sent(len(prefix) + len(frame_header) + len(payload), time.perf_counter() - start)
+
+async def _send_blocks(writer, file_path, block_indices, progress=None, compressor=None, block_size=utils.BLOCK_SIZE):
+    """Streams blocks as Index (4) + Len (4) + Data, like send_delta_blocks(window=0)."""
+    with open(file_path, "rb") as f:
+        for count, idx in enumerate(block_indices, 1):
+            block_data = await _blocking(_read_at, f, idx * block_size, block_size)
+            if compressor is None:
+                writer.write(idx.to_bytes(4, 'big') + len(block_data).to_bytes(4, 'big') + block_data)
+                await writer.drain()
+            else:
+                await _send_frame(writer, compressor, idx.to_bytes(4, 'big'), block_data)
+            if progress:
+                progress(count)
+
+async def handle_rolling_delta(reader, writer, filename, file_path):
+    """Async version of server.handle_rolling_delta."""
+    if (await reader.read(1024)).decode() != "OK":
+        return None
+
+    print(f"[Delta Sync] Rolling sync requested for {filename}")
+    monitor.log_event(f"Rolling Delta Request: {filename}")
+
+    await _send(writer, await _blocking(delta.signature_reply, file_path))
+
+    rebuild = await _blocking(delta.RollingApply, filename, file_path)
+    client_final_hash = None
+    try:
+        while True:
+            op = await _recv_delta_op(reader)
+            if op is None:
+                break
+            if op[0] == "COPY":
+                await _blocking(rebuild.copy, op[1], op[2])
+            elif op[0] == "LITERAL":
+                await _blocking(rebuild.literal, op[1])
+            else:  # END
+                client_final_hash = op[1]
+                break
+    except BaseException:
+        rebuild.abort()
+        raise
+
+    ok = await _blocking(rebuild.finish, client_final_hash)
+    if client_final_hash is None:
+        return None  # cut off or out of sync
+    await _send(writer, b"INTEGRITY_OK" if ok else b"INTEGRITY_FAIL")
+    return ok
+
+async def handle_cdc_delta(reader, writer, filename, file_path, params, window, compressed=False):
+    """Async version of server.handle_cdc_delta. Returns whether the file was updated."""
+    print(f"[Delta Sync] CDC sync requested for {filename} ({utils.format_cdc_params(params)})")
+    monitor.log_event(f"CDC Delta Request: {filename}")
+
+    server_chunks, server_final_hash, exists = await _blocking(delta.server_chunks, file_path, params)
+    plan, missing_chunks, client_final_hash = await _recv_chunk_manifest(reader, server_chunks)
+    missing_chunks, foreign = await _blocking(delta.find_chunks, filename, plan, missing_chunks, params)
+    await _send(writer, utils.encode_block_ranges(missing_chunks))
+
+    if not missing_chunks and server_final_hash == client_final_hash:
+        await _send(writer, b"INTEGRITY_OK")
+        monitor.log_event(f"{filename} already up to date")
+        return True
+
+    rebuild = await _blocking(delta.ChunkApply, filename, file_path, exists, plan, missing_chunks, foreign)
+    ack_every = utils.ack_interval(window)
+    try:
+        for count in range(1, len(missing_chunks) + 1):
+            if compressed:
+                chunk_idx = int.from_bytes(await reader.readexactly(4), 'big')
+                chunk_data = await _read_frame(reader, max_raw=params[2])
+                if chunk_data is None:
+                    rebuild.verified = False
+                    break
+            else:
+                header = await reader.readexactly(8)
+                chunk_idx = int.from_bytes(header[:4], 'big')
+                chunk_data = await reader.readexactly(int.from_bytes(header[4:], 'big'))
+            await _blocking(rebuild.accept, chunk_idx, chunk_data)
+
+            if window is None:
+                await _send(writer, b"ACK")
+            elif ack_every and count % ack_every == 0:
+                await _send(writer, utils.encode_window_ack(count))
+    except BaseException:
+        rebuild.abort()
+        raise
+
+    ok = await _blocking(rebuild.finish, params, client_final_hash)
+    await _send(writer, b"INTEGRITY_OK" if ok else b"INTEGRITY_FAIL")
+    return ok
+
+async def handle_upload(reader, writer, parts):
+    """
+    PROTOCOL: same as server.handle_client UPLOAD (COMPRESS=, RESUMABLE / RESUME=).
+    Returns False if the stream broke off and the connection must close.
+    """
+    filename = parts[1]
+    codecs = []
+    for part in parts[2:]:
+        if part.startswith("COMPRESS="):
+            codecs = compression.negotiate_codecs(part[9:])
+    token = resume.session_token(parts, resume.UPLOAD, filename)
+    try:
+        return await _recv_upload(reader, writer, filename, codecs, token)
+    finally:
+        if token:
+            resume.release(token)
+
+async def _recv_upload(reader, writer, filename, codecs, token):
+    reply = ["OK"]
+    if codecs:
+        reply.append(f"COMPRESS={compression.format_codecs(codecs)}")
+    if token:
+        reply.append(f"TOKEN={token}")
+    await _send(writer, " ".join(reply).encode())  # ACK the command
+
+    filesize_str = (await reader.read(1024)).decode()
+    try:
+        filesize = int(filesize_str)
+    except ValueError:
+        print("Invalid file size received")
+        await _send(writer, b"ERROR_INVALID_SIZE")
+        return True
+
+    file_path = os.path.join("files", filename)
+    session = None
+    offset = 0
+    target_path = file_path
+    if token:
+        # Partial data is kept in a session file until complete
+        session = await _blocking(resume.upload_session, token, filename, file_path, filesize)
+        offset = session["received"]
+        target_path = session["temp_path"]
+        await _send(writer, f"OK OFFSET={offset}".encode())
+        if offset:
+            print(f"[Resume] {filename}: continuing at {offset}/{filesize} bytes")
+            monitor.log_event(f"Upload Resumed: {filename} at {offset} bytes")
+    else:
+        await _send(writer, b"OK")  # ACK the size
+
+    bytes_received = offset
+    hasher = utils.BlockHasher() if offset == 0 else None  # a resumed upload is hashed once complete
+    try:
+        with open(target_path, "r+b" if offset else "wb") as f:
+            if offset:
+                f.truncate(offset)
+                f.seek(offset)
+            on_data = hasher.update if hasher else None
+            if session:
+                on_data = resume.UploadCheckpoint(session, f, on_data)
+            while bytes_received < filesize:
+                if codecs:
+                    chunk = await _read_frame(reader, max_raw=filesize - bytes_received)
+                    if chunk is None:
+                        print("Malformed compressed upload")
+                        return False
+                else:
+                    chunk = await reader.read(min(IO_CHUNK, filesize - bytes_received))
+                if not chunk:
+                    break
+                await _blocking(_write_chunk, f, on_data, chunk)
+                bytes_received += len(chunk)
+    finally:
+        if session and session["received"] < filesize:
+            await _blocking(resume.save, session)  # checkpoint what arrived before the drop
+
+    if session and bytes_received < filesize:
+        print(f"[Resume] {filename}: interrupted at {bytes_received}/{filesize} bytes")
+        monitor.log_event(f"Upload Interrupted: {filename} (resumable)")
+        return False
+    if session:
+        await _blocking(os.replace, target_path, file_path)
+        await _blocking(resume.discard, token)
+
+    if bytes_received == filesize:
+        if hasher:
+            _, block_hashes, file_hash = hasher.finish()
+        else:
+            _, block_hashes, file_hash = await _blocking(manifest_cache.hash_file, file_path)
+        await _blocking(manifest_cache.store_manifest, file_path, block_hashes, file_hash)
+
+    print(f"Received file: {filename}")
+    monitor.log_event(f"Recv Complete: {filename}")
+    monitor.finish_transfer(filename, filesize, filesize)
+    return True
+
+async def handle_upload_striped(reader, writer, parts):
+    """Async version of server.handle_client UPLOAD_STRIPED (see striped.py)."""
+    filename = parts[1]
+    request = striped.parse_stripe_request(parts)
+    if request is None:
+        await _send(writer, b"ERROR_Usage: UPLOAD_STRIPED filename SIZE=n STRIPES=k HASH=hex")
+        return
+    size, stripes, file_hash = request
+
+    session = await _blocking(striped.open_session, os.path.join("files", filename), size, stripes, file_hash)
+    monitor.log_event(f"Striped Upload: {filename} ({len(session.ranges)} stripes)")
+    closed = False
+    try:
+        await _send(writer, f"OK SESSION={session.id}".encode())
+        reply = (await reader.read(1024)).decode()
+        closed = True
+        ok = await _blocking(striped.close_session, session, reply == "COMMIT")
+    finally:
+        if not closed:
+            await _blocking(striped.close_session, session, False)  # main connection lost
+
+    if ok:
+        await _send(writer, b"INTEGRITY_OK")
+        monitor.log_event(f"Recv Complete: {filename}")
+        monitor.finish_transfer(filename, size, size)
+    else:
+        await _send(writer, b"INTEGRITY_FAIL")
+        monitor.log_event(f"Integrity FAIL: {filename}")
+
+async def handle_stripe(reader, writer, parts):
+    """STRIPE session index: one byte range of a striped upload, written in place."""
+    session = striped.acquire_stripe(parts[1], parts[2]) if len(parts) == 3 else None
+    if session is None:
+        await _send(writer, b"ERROR_NO_SESSION")
+        return
+    index = int(parts[2])
+
+    filename = os.path.basename(session.file_path)
+    offset, length = session.ranges[index]
+    received = 0
+    try:
+        await _send(writer, b"OK")
+        while received < length:
+            chunk = await reader.read(min(IO_CHUNK, length - received))
+            if not chunk:
+                break
+            await _blocking(session.write, offset + received, chunk)
+            received += len(chunk)
+            monitor.update_transfer(filename, session.received, session.size, mode="Striped Upload")
+        if received == length:
+            session.finish_stripe(index)
+    finally:
+        await _blocking(striped.release_stripe, session)  # before the reply, so COMMIT finds it done
+
+    if received == length:
+        await _send(writer, b"STRIPE_OK")
+    else:
+        await _send(writer, b"STRIPE_FAIL")
+
+async def _recv_full(reader, path):
+    """Async version of dirsync.recv_full."""
+    header = await reader.readexactly(16)
+    size = int.from_bytes(header[:8], 'big')
+    mtime_ns = int.from_bytes(header[8:], 'big')
+
+    temp_path = path + ".tmp"
+    hasher = utils.BlockHasher()
+    received = 0
+    with open(temp_path, "wb") as f:
+        while received < size:
+            chunk = await reader.read(min(IO_CHUNK, size - received))
+            if not chunk:
+                break
+            await _blocking(_write_and_hash, f, hasher, chunk)
+            received += len(chunk)
+    if received < size:
+        os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, path)
+    _, block_hashes, file_hash = hasher.finish()
+    await _blocking(manifest_cache.store_manifest, path, block_hashes, file_hash)
+    await _blocking(manifest_cache.set_mtime, path, mtime_ns)
+    return True
+
+async def handle_sync_dir(reader, writer, parts):
+    """Async version of server.handle_sync_dir."""
+    request = dirsync.parse_sync_request(parts)
+    if request is None:
+        await _send(writer, b"ERROR_Usage: SYNC_DIR dirname ENTRIES=n BYTES=m [HASH]")
+        return True
+    name, count, listing_len, with_hash = request
+    base = os.path.join("files", name)
+    await _send(writer, b"OK")
+
+    entries = dirsync.parse_listing(await reader.readexactly(listing_len), count, with_hash)
+    if entries is None:
+        return False
+    actions = await _blocking(dirsync.plan_sync, base, entries)
+    await _send(writer, bytes(actions))
+
+    changed = sum(1 for a in actions if a in (dirsync.DELTA, dirsync.FULL))
+    monitor.log_event(f"Dir Sync: {name} ({changed} of {len(entries)} files changed)")
+
+    updated = failed = 0
+    for (rel_path, size, _, _), action in zip(entries, actions):
+        path = dirsync.safe_path(base, rel_path)
+        if action == dirsync.FULL:
+            if not await _recv_full(reader, path):
+                return False
+            monitor.count_bytes(received=size)
+            ok = True
+        elif action == dirsync.DELTA:
+            mtime_ns = int.from_bytes(await reader.readexactly(8), 'big')
+            ok = await handle_cdc_delta(reader, writer, f"{name}/{rel_path}", path,
+                                        utils.CDC_DEFAULT_PARAMS, utils.DELTA_WINDOW)
+            if ok:
+                await _blocking(manifest_cache.set_mtime, path, mtime_ns)
+        else:
+            continue
+        updated += ok
+        failed += not ok
+
+    if (await reader.read(1024)).decode() != "DONE":
+        return False
+    await _send(writer, f"SYNC_DONE {updated} {failed}".encode())
+    monitor.log_event(f"Dir Sync Complete: {name} ({updated} updated, {failed} failed)")
+    return True
+
+async def handle_stat(writer, filename):
+    await _send(writer, await _blocking(storage.stat_file, filename))
+
+async def handle_upload_delta(reader, writer, parts):
+    """
+    UPLOAD_DELTA with the same options as the threaded engine
+    (ROLLING, MERKLE, CDC, BINARY or JSON manifest, WINDOW=n, COMPRESS=codecs).
+    Returns False if the stream got out of sync and the connection must close.
+    """
+    filename = parts[1]
+    file_path = os.path.join("files", filename)
+
+    options = delta.parse_upload_options(parts)
+    window, cdc_params, codecs = options["window"], options["cdc_params"], options["codecs"]
+    ack_every = utils.ack_interval(window)
+
+    if delta.full_upload_required(parts, options, file_path):
+        await _send(writer, b"FULL_UPLOAD_REQUIRED")
+        return True
+
+    if cdc_params is not None:
+        await _send(writer, delta.cdc_ack(options))
+        await handle_cdc_delta(reader, writer, filename, file_path, cdc_params, window, bool(codecs))
+        return True
+
+    # Ready for hash list; negotiated block hash and size are echoed back
+    ack, algo, digest_len, block_size, token = await _blocking(delta.block_mode_ack, parts, options, filename, file_path)
+    await _send(writer, ack)
+
+    if "ROLLING" in parts[2:]:
+        return await handle_rolling_delta(reader, writer, filename, file_path) is not None
+
+    try:
+        print(f"[Delta Sync] Client wants to sync {filename}")
+        monitor.log_event(f"Delta Sync Request: {filename}")
+
+        server_total, server_hashes, server_final_hash = await _blocking(delta.server_manifest, file_path, algo, block_size)
+        expected = {}  # client's digest of each missing block
+        session, resumed = None, False
+        resumed_blocks = []  # applied before the connection dropped last time
+        foreign = ({}, {})  # blocks found in other stored files (block store)
+
+        if "MERKLE" in parts[2:]:
+            header = await reader.readexactly(40)
+            client_total_blocks = int.from_bytes(header[:8], 'big')
+            client_final_hash = header[8:].hex()
+            exchange = await _merkle_exchange(reader, writer, server_hashes, client_total_blocks,
+                                              delta.merkle_max_blocks(options, block_size), expected)
+            if exchange is None:
+                return False
+            missing_blocks, _ = exchange
+
+        elif "BINARY" in parts[2:]:
+            manifest = await _recv_binary_manifest(reader, server_hashes, expected, digest_len, block_size)
+            if manifest is None:
+                return False
+            client_total_blocks, missing_blocks, client_final_hash = manifest
+            if token:
+                session, resumed, resumed_blocks, missing_blocks = await _blocking(
+                    delta.resume_blocks, token, filename, file_path, missing_blocks, client_final_hash, algo, block_size)
+            missing_blocks, foreign = await _blocking(delta.find_blocks, filename, missing_blocks, expected, algo,
+                                                      block_size, client_total_blocks)
+            await _send(writer, utils.encode_block_ranges(missing_blocks))
+
+        else:
+            json_len = int((await reader.readexactly(10)).decode().strip())
+            await _send(writer, b"OK")
+            client_state = json.loads((await reader.readexactly(json_len)).decode())
+            client_total_blocks, missing_blocks, client_final_hash = await _blocking(
+                delta.json_missing_blocks, client_state, server_hashes, expected)
+            response_bytes = json.dumps({"missing": missing_blocks}).encode()
+            await _send(writer, str(len(response_bytes)).encode().ljust(10) + response_bytes)
+
+        print(f"[Delta Sync] Need to receive {len(missing_blocks)} blocks")
+        monitor.log_event(f"{filename}: {len(missing_blocks)} blocks missing")
+        monitor.count_blocks(compared=client_total_blocks, sent=len(missing_blocks))
+
+        if not missing_blocks and server_final_hash == client_final_hash:
+            await _send(writer, b"INTEGRITY_OK")
+            monitor.log_event(f"{filename} already up to date")
+            return True
+
+        rebuild = await _blocking(delta.BlockApply, filename, file_path, server_hashes, algo, block_size,
+                                  client_total_blocks, missing_blocks, expected, session, resumed, resumed_blocks,
+                                  foreign)
+        lost = False  # stream cut off or out of sync
+        try:
+            for count in range(1, len(missing_blocks) + 1):
+                if codecs:
+                    blk_idx = int.from_bytes(await reader.readexactly(4), 'big')
+                    blk_data = await _read_frame(reader, max_raw=block_size)
+                    if blk_data is None:
+                        lost = True
+                        break
+                else:
+                    header = await reader.readexactly(8)
+                    blk_idx = int.from_bytes(header[:4], 'big')
+                    blk_data = await reader.readexactly(int.from_bytes(header[4:], 'big'))
+
+                # Hashed, verified and written on the executor
+                await _blocking(rebuild.accept, blk_idx, blk_data)
+
+                if window is None:
+                    await _send(writer, b"ACK")
+                elif ack_every and count % ack_every == 0:
+                    await _send(writer, utils.encode_window_ack(count))
+        except BaseException:
+            # A resumable session keeps what arrived; the client resumes with RESUME=token
+            rebuild.interrupt()
+            raise
+
+        if lost:
+            await _blocking(rebuild.interrupt)
+            return False
+
+        ok = await _blocking(rebuild.finish, client_final_hash)
+        await _send(writer, b"INTEGRITY_OK" if ok else b"INTEGRITY_FAIL")
+        return True
+    finally:
+        if token:
+            resume.release(token)
+
+async def handle_download_delta(reader, writer, parts):
+    """Async version of server.handle_download_delta."""
+    filename = parts[1]
+    file_path = os.path.join("files", filename)
+    if not os.path.exists(file_path):
+        await _send(writer, b"NOT_FOUND")
+        return True
+    ack, codecs, block_size = await _blocking(delta.download_ack, parts, file_path)
+    await _send(writer, ack)
+
+    server_total, server_hashes, server_final_hash = await _blocking(
+        manifest_cache.get_manifest, file_path, "sha256", block_size)
+    manifest = await _recv_binary_manifest(reader, server_hashes, block_size=block_size)
+    if manifest is None:
+        return False
+    send_blocks, header = await _blocking(delta.download_plan, filename, file_path, server_total,
+                                          server_final_hash, manifest)
+    await _send(writer, header)
+
+    total_send_bytes = len(send_blocks) * block_size  # approx
+    def _on_block(count):
+        monitor.update_transfer(filename, min(count * block_size, total_send_bytes), total_send_bytes, mode="Delta Download")
+
+    compressor = compression.AdaptiveCompressor(codecs) if codecs else None
+    await _send_blocks(writer, file_path, send_blocks, _on_block, compressor, block_size)
+    total_size = os.path.getsize(file_path)
+    monitor.finish_transfer(filename, min(len(send_blocks) * block_size, total_size), total_size, outbound=True)
+    return True
+
+async def handle_download(reader, writer, parts):
+    filename = parts[1]
+    offset = 0
+    length = None  # None = to the end (LENGTH= is used by striped downloads)
+    use_compression = False
+    codecs = []  # adaptive framed compression
+    for part in parts[2:]:
+        if part.startswith("OFFSET="):
+            try:
+                offset = int(part.split("=")[1])
+            except ValueError:
+                pass
+        elif part.startswith("LENGTH="):
+            try:
+                length = max(0, int(part.split("=")[1]))
+            except ValueError:
+                pass
+        elif part == "COMPRESS":
+            use_compression = True
+        elif part.startswith("COMPRESS="):
+            codecs = compression.negotiate_codecs(part[9:])
+
+    file_path = os.path.join("files", filename)
+    if not os.path.exists(file_path):
+        await _send(writer, b"NOT_FOUND")
+        return
+
+    total_size = os.path.getsize(file_path)
+    remaining_size = max(0, total_size - offset)
+    if length is not None:
+        remaining_size = min(remaining_size, length)
+    if codecs:
+        await _send(writer, f"FRAMED_{remaining_size}".encode())
+    elif use_compression:
+        await _send(writer, f"COMPRESSED_{remaining_size}".encode())
+    else:
+        await _send(writer, str(remaining_size).encode())
+
+    if (await reader.read(1024)).decode() != "OK":
+        return
+
+    with open(file_path, "rb") as f:
+        if codecs:
+            compressor = compression.AdaptiveCompressor(codecs)
+            sent = 0
+            while sent < remaining_size:
+                data = await _blocking(_read_at, f, offset + sent,
+                                       min(compression.STREAM_CHUNK, remaining_size - sent))
+                if not data:
+                    break
+                await _send_frame(writer, compressor, b"", data)
+                sent += len(data)
+            monitor.count_bytes(sent=compressor.link_bytes)
+            print(f"Sent file (adaptive compression): {filename}")
+            return
+
+        if not use_compression:
+            # Zero-copy: os.sendfile straight into the transport's socket
+            if remaining_size > 0:
+                await asyncio.get_running_loop().sendfile(writer.transport, f, offset, remaining_size)
+            monitor.count_bytes(sent=remaining_size)
+            print(f"Sent file: {filename}")
+            return
+
+        if offset > 0:
+            f.seek(offset)
+
+        compressor = zlib.compressobj()
+        to_send = remaining_size
+        wire_bytes = 4  # EOF marker
+        while to_send > 0:
+            data = await _blocking(f.read, min(IO_CHUNK, to_send))
+            if not data:
+                break
+            to_send -= len(data)
+            compressed = compressor.compress(data)
+            if compressed:
+                writer.write(len(compressed).to_bytes(4, byteorder='big') + compressed)
+                wire_bytes += 4 + len(compressed)
+                await writer.drain()
+
+        remaining = compressor.flush()
+        if remaining:
+            writer.write(len(remaining).to_bytes(4, byteorder='big') + remaining)
+            wire_bytes += 4 + len(remaining)
+        writer.write((0).to_bytes(4, byteorder='big'))  # EOF
+        await writer.drain()
+    monitor.count_bytes(sent=wire_bytes)
+    print(f"Sent file (compressed): {filename}")
+
+async def handle_delete(writer, parts):
+    await _send(writer, await _blocking(storage.delete_file, parts))
+
+def _v2_frame(frame_type, request_id, payload=b""):
+    return protocol2.encode_header(frame_type, request_id, len(payload)) + payload
+
+async def _v2_upload(reader, writer, request_id, parts):
+    # Async version of server.handle_v2_upload
+    filename = parts[1] if len(parts) >= 2 else None
+    size_option = next((p[5:] for p in parts[2:] if p.startswith("SIZE=")), None)
+    expected_size = int(size_option) if size_option and size_option.isdigit() else None
+    file_path = os.path.join("files", filename) if filename else None
+    temp_path = None
+    f = None
+    if file_path:
+        temp_path = f"{file_path}.{id(writer)}.tmp"
+        try:
+            f = open(temp_path, "wb")
+        except OSError:
+            temp_path = None
+    if f is None:
+        f = open(os.devnull, "wb")  # the data is drained, then the request refused
+
+    hasher = utils.BlockHasher()
+    received = 0
+    with f:
+        while True:
+            frame_type, frame_id, length = protocol2.parse_header(await reader.readexactly(protocol2.HEADER_SIZE))
+            if frame_id != request_id or frame_type not in (protocol2.DATA, protocol2.END):
+                if temp_path:
+                    os.remove(temp_path)
+                return False
+            if frame_type == protocol2.END:
+                break
+            while length > 0:
+                chunk = await reader.read(min(IO_CHUNK, length))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", length)
+                await _blocking(_write_and_hash, f, hasher, chunk)
+                length -= len(chunk)
+                received += len(chunk)
+            if filename:
+                monitor.update_transfer(filename, received, expected_size or received, mode="Upload")
+
+    if temp_path is None:
+        writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"ERROR_INVALID_NAME"))
+    elif expected_size is not None and expected_size != received:
+        os.remove(temp_path)
+        writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"ERROR_SIZE_MISMATCH"))
+    else:
+        await _blocking(os.replace, temp_path, file_path)
+        _, block_hashes, file_hash = hasher.finish()
+        await _blocking(manifest_cache.store_manifest, file_path, block_hashes, file_hash)
+        writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"OK"))
+        monitor.log_event(f"Recv Complete: {filename}")
+        monitor.finish_transfer(filename, received, received)
+    return True
+
+async def handle_v2(reader, writer):
+    """
+    Async version of server.handle_v2. Replies go to the transport as they
+    are produced (it coalesces them while the socket is busy).
+    """
+    while True:
+        try:
+            header = await reader.readexactly(protocol2.HEADER_SIZE)
+        except asyncio.IncompleteReadError:
+            return
+        frame_type, request_id, length = protocol2.parse_header(header)
+        if frame_type != protocol2.REQUEST or length > protocol2.MAX_MESSAGE:
+            print("[v2] Malformed frame, closing connection")
+            return
+        parts = (await reader.readexactly(length)).decode(errors="replace").split()
+        cmd = parts[0] if parts else ""
+
+        started = time.perf_counter()
+        try:
+            if cmd == "LIST":
+                if len(parts) > 1:
+                    reply = await _blocking(catalog.listing, parts)
+                else:
+                    reply = "\n".join(await _blocking(catalog.names)).encode()
+                writer.write(_v2_frame(protocol2.RESPONSE, request_id, reply))
+
+            elif cmd == "STAT" and len(parts) >= 2:
+                writer.write(_v2_frame(protocol2.RESPONSE, request_id, await _blocking(storage.stat_file, parts[1])))
+
+            elif cmd == "DELETE":
+                writer.write(_v2_frame(protocol2.RESPONSE, request_id, await _blocking(storage.delete_file, parts)))
+
+            elif cmd == "DOWNLOAD" and len(parts) >= 2:
+                file_path = os.path.join("files", parts[1])
+                if not os.path.isfile(file_path):
+                    writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"NOT_FOUND"))
+                    continue
+                with open(file_path, "rb") as f:
+                    requested = protocol2.parse_range(parts, os.fstat(f.fileno()).st_size)
+                    if requested is None:
+                        writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"ERROR_INVALID_RANGE"))
+                        continue
+                    offset, length = requested
+                    writer.write(_v2_frame(protocol2.RESPONSE, request_id, f"OK SIZE={length}".encode()))
+                    if length <= protocol2.COALESCE_LIMIT:
+                        data = await _blocking(_read_at, f, offset, length)
+                        if data:
+                            writer.write(_v2_frame(protocol2.DATA, request_id, data))
+                    else:
+                        sent = 0
+                        while sent < length:
+                            size = min(protocol2.DATA_FRAME, length - sent)
+                            writer.write(protocol2.encode_header(protocol2.DATA, request_id, size))
+                            await asyncio.get_running_loop().sendfile(writer.transport, f, offset + sent, size)
+                            sent += size
+                    writer.write(_v2_frame(protocol2.END, request_id))
+                    monitor.count_bytes(sent=length)
+
+            elif cmd == "UPLOAD":
+                if not await _v2_upload(reader, writer, request_id, parts):
+                    print("[v2] Upload stream broken, closing connection")
+                    return
+
+            elif cmd == "EXIT":
+                return
+
+            else:
+                writer.write(_v2_frame(protocol2.RESPONSE, request_id, b"ERROR_UNSUPPORTED"))
+            await writer.drain()
+        finally:
+            monitor.observe_command(cmd, time.perf_counter() - started)
+
+async def handle_client(reader, writer):
+    address = writer.get_extra_info("peername")
+    monitor.add_client(address[:2])
+    try:
+        while True:
+            data = (await reader.read(1024)).decode()
+            if not data:
+                break
+
+            parts = data.split()
+            if not parts:
+                continue
+            cmd = parts[0]
+
+            started = time.perf_counter()
+            try:
+                if cmd == "LIST":
+                    if len(parts) > 1:
+                        # Paged: LIST [PREFIX=p] [CURSOR=c] [LIMIT=n] [SIZE] [MTIME] [HASH], see catalog.py
+                        page = await _blocking(catalog.listing, parts)
+                        await _send(writer, str(len(page)).encode().ljust(10) + page)
+                        continue
+                    files = await _blocking(catalog.names)
+                    await _send(writer, ("\n".join(files) if files else "No files found").encode())
+                elif cmd == "EXIT":
+                    break
+                elif len(parts) < 2:
+                    continue
+                elif cmd == "UPLOAD":
+                    if not await handle_upload(reader, writer, parts):
+                        break
+                elif cmd == "UPLOAD_STRIPED":
+                    await handle_upload_striped(reader, writer, parts)
+                elif cmd == "STRIPE":
+                    await handle_stripe(reader, writer, parts)
+                elif cmd == "SYNC_DIR":
+                    if not await handle_sync_dir(reader, writer, parts):
+                        break
+                elif cmd == "STAT":
+                    await handle_stat(writer, parts[1])
+                elif cmd == "UPLOAD_DELTA":
+                    if not await handle_upload_delta(reader, writer, parts):
+                        break  # stream is out of sync, drop the connection
+                elif cmd == "DOWNLOAD_DELTA":
+                    if not await handle_download_delta(reader, writer, parts):
+                        break
+                elif cmd == "DOWNLOAD":
+                    await handle_download(reader, writer, parts)
+                elif cmd == "DELETE":
+                    await handle_delete(writer, parts)
+                elif cmd == "PROTO":
+                    if parts[1:] != ["2"]:
+                        await _send(writer, b"ERROR_UNSUPPORTED_PROTOCOL")
+                        continue
+                    await _send(writer, b"OK PROTO=2")
+                    await handle_v2(reader, writer)
+                    break
+            finally:
+                monitor.observe_command(cmd, time.perf_counter() - started)
+
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        print(f"Connection lost from {address}: {e}")
+    except Exception as e:
+        print(f"Error handling client {address}: {e}")
+    finally:
+        writer.close()
+        monitor.remove_client(address[:2])
+
+def _raise_fd_limit():
+    # 10k+ sockets need more than the usual 1024 descriptors
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+async def serve(host="0.0.0.0", port=5001):
+    _raise_fd_limit()
+    server = await asyncio.start_server(handle_client, host, port, backlog=BACKLOG, reuse_address=True)
+    print(f"[+] Server (asyncio) is listening on port {port}...")
+    async with server:
+        await server.serve_forever()
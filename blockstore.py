@@ -0,0 +1,226 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import utils
+import manifest_cache
+
+# Content-addressed index of the data stored on the server
+# (python server.py --blockstore).
+# Every stored file's manifest (manifest_cache: its content-defined chunks
+# for CDC_DEFAULT_PARAMS and its fixed-block view) is indexed by hash across
+# all files, so a delta - CDC or BINARY - can take any chunk or block the
+# server already holds from whichever file has it, including for a file that
+# is new on the server. Only data found nowhere is requested from the client.
+# The index is built from the manifests manifest_cache keeps on disk, in the
+# background at startup (files without a cached chunk manifest are chunked
+# once, then cached); lookups never wait for it.
+# Files stay whole under files/ and are the only copy of their data: chunks
+# taken from other files are placed with copy_file_range, which shares the
+# extents on reflink filesystems (btrfs, XFS). Deleting a file frees its
+# space as usual and prunes its entries from the index.
+# So this saves upload bandwidth everywhere but disk space only where the
+# filesystem reflinks: there are no per-block recipes, reference counts or
+# collection on DELETE. Data copied from another file is re-hashed where it
+# landed before a delta commits (the source may change after the lookup).
+
+ENABLED = False
+PARAMS = utils.CDC_DEFAULT_PARAMS
+STORE_DIR = "files"
+TEMP_SUFFIXES = (".tmp", ".part")
+PREFIX_LEN = 2 * utils.MIN_DIGEST_LEN  # hex digits of a block digest every client sends
+
+_lock = threading.Lock()
+_chunks = {}   # chunk sha256 hex -> {path: (offset, length)}
+_blocks = {}   # (algo, block_size, digest prefix) -> {path: (offset, length, digest)}
+_recipes = {}  # path -> (stat key, chunk keys, block keys)
+_indexer = ThreadPoolExecutor(max_workers=1)  # keeps chunking and loading off the reply path
+
+def enable():
+    """Turns the block store on and indexes what is already stored, in the background."""
+    global ENABLED
+    ENABLED = True
+    _indexer.submit(_load)
+
+def _stat_key(st):
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def _entry_views(entry):
+    # {chunk digest: location} and {block key: location} of one manifest entry
+    chunk_view = {}
+    if entry.get("cdc_params") == utils.format_cdc_params(PARAMS):
+        offset = 0
+        for length, digest in entry["chunks"]:
+            chunk_view.setdefault(digest, (offset, length))
+            offset += length
+
+    block_view = {}
+    if "hashes" in entry:
+        algo, block_size, size = entry["hash_algo"], entry["block_size"], entry["key"][1]
+        for idx, digest in enumerate(entry["hashes"]):
+            offset = idx * block_size
+            block_view.setdefault((algo, block_size, digest[:PREFIX_LEN]),
+                                  (offset, min(block_size, size - offset), digest))
+    return chunk_view, block_view
+
+def _register(path, entry):
+    # The views are built before taking the lock; only the merge holds it
+    chunk_view, block_view = _entry_views(entry)
+    with _lock:
+        _unregister(path)
+        for digest, location in chunk_view.items():
+            _chunks.setdefault(digest, {})[path] = location
+        for block_key, location in block_view.items():
+            _blocks.setdefault(block_key, {})[path] = location
+        _recipes[path] = (tuple(entry["key"][1:]), list(chunk_view), list(block_view))
+
+def _unregister(path):
+    recipe = _recipes.pop(path, None)
+    if recipe is None:
+        return
+    for index, keys in ((_chunks, recipe[1]), (_blocks, recipe[2])):
+        for index_key in keys:
+            holders = index.get(index_key)
+            if holders is None:
+                continue
+            holders.pop(path, None)
+            if not holders:
+                del index[index_key]
+
+def add_file(file_path):
+    """(Re)indexes a stored file from its cached manifest, chunking it first if it has no chunk view."""
+    path = os.path.abspath(file_path)
+    try:
+        entry = manifest_cache.cached_entry(path)
+        if entry is None or entry.get("cdc_params") != utils.format_cdc_params(PARAMS):
+            manifest_cache.get_chunk_manifest(path, PARAMS)
+            entry = manifest_cache.cached_entry(path)
+    except OSError:
+        return
+    if entry is not None:
+        _register(path, entry)
+
+def _load():
+    # Startup: index every stored file whose manifests are cached (cheap),
+    # then chunk the ones that have none yet
+    uncached = []
+    for dirpath, _, filenames in os.walk(STORE_DIR):
+        for name in filenames:
+            if name.endswith(TEMP_SUFFIXES):
+                continue
+            path = os.path.abspath(os.path.join(dirpath, name))
+            try:
+                entry = manifest_cache.cached_entry(path)
+            except OSError:
+                continue
+            if entry is not None and entry.get("cdc_params") == utils.format_cdc_params(PARAMS):
+                _register(path, entry)
+            else:
+                uncached.append(path)
+    for path in uncached:
+        add_file(path)
+    files, chunks, blocks = stats()
+    print(f"[Block Store] Indexed {files} files ({chunks} chunks, {blocks} blocks)")
+
+def file_stored(file_path):
+    """Called whenever a stored file was (re)written; indexing runs in the background."""
+    if ENABLED:
+        _indexer.submit(add_file, file_path)
+
+def remove_file(file_path):
+    """Prunes a deleted file's entries from the index."""
+    if not ENABLED:
+        return
+    with _lock:
+        _unregister(os.path.abspath(file_path))
+
+def _current(path):
+    # The index entry is only trusted while the file is unchanged
+    with _lock:
+        recipe = _recipes.get(path)
+    try:
+        key = _stat_key(os.stat(path))
+    except OSError:
+        remove_file(path)
+        return False
+    if recipe is not None and recipe[0] == key:
+        return True
+    file_stored(path)  # changed outside the server: re-index for next time
+    return False
+
+def locate(digest, length):
+    """(path, offset) of a current stored copy of a chunk, or None."""
+    with _lock:
+        holders = list(_chunks.get(digest, {}).items())
+    for path, (offset, chunk_len) in holders:
+        if chunk_len == length and _current(path):
+            return path, offset
+    return None
+
+def locate_block(algo, block_size, digest):
+    """
+    (path, offset, length, full digest) of a current stored block whose
+    `algo` digest starts with `digest` (hex, possibly truncated), or None.
+    """
+    with _lock:
+        holders = list(_blocks.get((algo, block_size, digest[:PREFIX_LEN]), {}).items())
+    for path, (offset, length, full_digest) in holders:
+        if full_digest.startswith(digest) and _current(path):
+            return path, offset, length, full_digest
+    return None
+
+def _add_copy(copies, src_path, src_offset, dst_offset, length):
+    ranges = copies.setdefault(src_path, [])
+    last = ranges[-1] if ranges else None
+    if last and last[0] + last[2] == src_offset and last[1] + last[2] == dst_offset:
+        ranges[-1] = (last[0], last[1], last[2] + length)
+    else:
+        ranges.append((src_offset, dst_offset, length))
+
+def resolve(plan, missing_chunks, params):
+    """
+    Splits the missing entries of a chunk plan (see utils.recv_chunk_manifest)
+    into those still to be received and those found in other stored files.
+    Returns (missing_chunks, {src_path: [(src_offset, dst_offset, length), ...]}).
+    """
+    if not ENABLED or tuple(params) != tuple(PARAMS):
+        return missing_chunks, {}
+
+    still_missing = []
+    copies = {}
+    for idx in missing_chunks:
+        dst_offset, length, _, digest = plan[idx]
+        location = locate(digest, length)
+        if location is None:
+            still_missing.append(idx)
+            continue
+        _add_copy(copies, location[0], location[1], dst_offset, length)
+    return still_missing, copies
+
+def resolve_blocks(missing_blocks, expected, algo, block_size, total_blocks):
+    """
+    Same for the missing blocks of a block-mode sync, `expected` holding the
+    client's (possibly truncated) digest of each. Returns (missing_blocks,
+    copies as in resolve(), {block index: (full digest, length)} of the
+    blocks found).
+    """
+    if not ENABLED:
+        return missing_blocks, {}, {}
+
+    still_missing = []
+    copies = {}
+    found = {}
+    for idx in missing_blocks:
+        location = locate_block(algo, block_size, expected[idx])
+        # Only the client's last block may be short
+        if location is None or (location[2] != block_size and idx != total_blocks - 1):
+            still_missing.append(idx)
+            continue
+        src_path, src_offset, length, full_digest = location
+        _add_copy(copies, src_path, src_offset, idx * block_size, length)
+        found[idx] = (full_digest, length)
+    return still_missing, copies, found
+
+def stats():
+    """(indexed files, distinct chunks, distinct blocks)."""
+    with _lock:
+        return len(_recipes), len(_chunks), len(_blocks)
@@ -0,0 +1,245 @@
+import bisect
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import manifest_cache
+
+# In-memory catalog of the storage directory: name -> (size, mtime_ns, is_dir)
+# for every top-level entry of files/, the same set os.listdir returns.
+# Kept current by the server (manifest_cache calls file_stored whenever a
+# stored file is written, DELETE calls remove_file) and reconciled with a
+# full scan every RECONCILE_INTERVAL, which picks up changes made outside the
+# server. Listings (the dashboard's /api/files, LIST) are served from here
+# instead of one stat per file per request. In-flight upload data
+# (*.tmp, *.part next to the file it becomes) is never listed.
+#
+# Paged LIST (any option given; a bare LIST still returns every name):
+#   LIST [PREFIX=p] [CURSOR=c] [LIMIT=n] [SIZE] [MTIME] [HASH]
+#   -> {"entries": [{"name", "dir" (directories only), "size", "mtime_ns",
+#       "hash" (whole-file hash, files only): as requested}, ...], "next": c}
+# in name order, at most LIMIT (<= MAX_PAGE) entries; v1 sends the JSON
+# after a 10-byte length. "next" is the cursor of the following page (the
+# hex of the last name), null once the listing is complete.
+# Hashes come from memory: manifest_cache hands over the whole-file hash
+# whenever it stores a manifest. A file without one (changed outside the
+# server, or listed before its first sync since the restart) is listed with
+# "hash": null and hashed by a background worker for later listings.
+
+STORE_DIR = "files"
+RECONCILE_INTERVAL = 60  # seconds
+MAX_PAGE = 1000
+SORT_KEYS = ("name", "size", "mtime")
+TEMP_SUFFIXES = (".tmp", ".part")  # same filter as blockstore
+
+_lock = threading.Lock()
+_loaded = False
+_entries = {}  # name -> (size, mtime_ns, is_dir)
+_names = []    # sorted names
+_views = {}    # (sort key, reverse) -> names in that order, dropped on any change
+_hashes = {}   # name -> (size, mtime_ns, whole-file hash), valid while size and mtime match
+_hashing = set()  # names queued for a background hash
+_hasher = ThreadPoolExecutor(max_workers=1)  # keeps hashing off the LIST reply path
+
+def _stat_entry(path):
+    st = os.stat(path)
+    is_dir = os.path.isdir(path)
+    return (0 if is_dir else st.st_size, st.st_mtime_ns, is_dir)
+
+def _set(name, entry):
+    # Caller holds _lock
+    if name not in _entries:
+        bisect.insort(_names, name)
+    _entries[name] = entry
+    _views.clear()
+
+def _drop(name):
+    # Caller holds _lock
+    _hashes.pop(name, None)
+    if _entries.pop(name, None) is not None:
+        del _names[bisect.bisect_left(_names, name)]
+        _views.clear()
+
+def _top_level(file_path):
+    # Name of the top-level entry of files/ holding `file_path`, or None
+    rel = os.path.relpath(os.path.abspath(file_path), os.path.abspath(STORE_DIR))
+    name = rel.split(os.sep, 1)[0]
+    return None if name in (os.curdir, os.pardir) else name
+
+def _refresh(file_path, file_hash=None):
+    name = _top_level(file_path)
+    if name is None or name.endswith(TEMP_SUFFIXES):
+        return
+    try:
+        entry = _stat_entry(os.path.join(STORE_DIR, name))
+    except OSError:
+        entry = None
+    with _lock:
+        if entry is None:
+            _drop(name)
+            return
+        _set(name, entry)
+        if file_hash is not None and not entry[2]:
+            _hashes[name] = (entry[0], entry[1], file_hash)
+
+def file_stored(file_path, file_hash=None):
+    """
+    Called whenever a stored file was (re)written, with its whole-file hash
+    (as STAT reports it) if the caller has it.
+    """
+    _refresh(file_path, file_hash)
+
+def remove_file(file_path):
+    """Called when a stored file was deleted."""
+    _refresh(file_path)
+
+def reconcile():
+    """Rescans the storage directory and replaces the catalog with what is there."""
+    global _loaded, _names
+    scanned = {}
+    try:
+        with os.scandir(STORE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith(TEMP_SUFFIXES):
+                    continue  # upload in progress
+                try:
+                    st = entry.stat()
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue  # removed while scanning
+                scanned[entry.name] = (0 if is_dir else st.st_size, st.st_mtime_ns, is_dir)
+    except OSError:
+        return
+    with _lock:
+        if scanned != _entries:
+            _entries.clear()
+            _entries.update(scanned)
+            _names = sorted(scanned)
+            _views.clear()
+            for name in [name for name in _hashes if name not in scanned]:
+                del _hashes[name]
+        _loaded = True
+
+def _reconcile_loop():
+    while True:
+        time.sleep(RECONCILE_INTERVAL)
+        reconcile()
+
+def start():
+    """Initial scan, then periodic reconciliation in a background thread."""
+    reconcile()
+    threading.Thread(target=_reconcile_loop, daemon=True).start()
+
+def _ensure_loaded():
+    # e.g. the dashboard running on its own: scan once on first use
+    if not _loaded:
+        reconcile()
+
+def _ordered(sort, reverse):
+    # Caller holds _lock
+    if sort == "name" and not reverse:
+        return _names
+    view = _views.get((sort, reverse))
+    if view is None:
+        if sort == "name":
+            view = _names[::-1]
+        else:
+            field = 0 if sort == "size" else 1
+            view = sorted(_names, key=lambda name: _entries[name][field], reverse=reverse)
+        _views[(sort, reverse)] = view
+    return view
+
+def page(prefix="", sort="name", reverse=False, offset=0, limit=100):
+    """
+    (matching entries, [(name, size, mtime_ns, is_dir), ...]) for one page
+    of the catalog: names starting with `prefix`, ordered by `sort`
+    (one of SORT_KEYS), `limit` entries (at most MAX_PAGE) from `offset`.
+    """
+    _ensure_loaded()
+    limit = max(0, min(limit, MAX_PAGE))
+    offset = max(0, offset)
+    with _lock:
+        if sort == "name" and not reverse:
+            # Prefix matches are one contiguous run of the sorted names
+            lo = bisect.bisect_left(_names, prefix)
+            hi = bisect.bisect_left(_names, prefix + "\U0010ffff") if prefix else len(_names)
+            total = hi - lo
+            names = _names[lo + offset:min(hi, lo + offset + limit)]
+        else:
+            names = _ordered(sort, reverse)
+            if prefix:
+                names = [name for name in names if name.startswith(prefix)]
+            total = len(names)
+            names = names[offset:offset + limit]
+        return total, [(name, *_entries[name]) for name in names]
+
+def names():
+    """Every name, sorted (the plain LIST)."""
+    _ensure_loaded()
+    with _lock:
+        return list(_names)
+
+def after(cursor, prefix="", limit=100):
+    """
+    Up to `limit` entries (at most MAX_PAGE) whose name starts with `prefix`
+    and sorts after `cursor` ("" = from the start), in name order, as
+    [(name, size, mtime_ns, is_dir), ...].
+    """
+    _ensure_loaded()
+    limit = max(0, min(limit, MAX_PAGE))
+    with _lock:
+        lo = max(bisect.bisect_right(_names, cursor), bisect.bisect_left(_names, prefix))
+        result = []
+        for name in _names[lo:lo + limit]:
+            if not name.startswith(prefix):
+                break
+            result.append((name, *_entries[name]))
+        return result
+
+def _hash_in_background(name):
+    try:
+        _, _, file_hash = manifest_cache.get_manifest(os.path.join(STORE_DIR, name))
+        file_stored(os.path.join(STORE_DIR, name), file_hash)
+    except OSError:
+        pass  # removed meanwhile
+    finally:
+        with _lock:
+            _hashing.discard(name)
+
+def _known_hash(name, size, mtime_ns):
+    """The whole-file hash if it is known for this version of the file; else queues it and returns None."""
+    with _lock:
+        known = _hashes.get(name)
+        if known is not None and known[:2] == (size, mtime_ns):
+            return known[2]
+        if name in _hashing:
+            return None
+        _hashing.add(name)
+    _hasher.submit(_hash_in_background, name)
+    return None
+
+def listing(parts):
+    """JSON reply to a paged LIST command (see above)."""
+    options = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+    try:
+        limit = max(1, min(int(options.get("LIMIT", MAX_PAGE)), MAX_PAGE))
+        cursor = bytes.fromhex(options.get("CURSOR", "")).decode()
+    except ValueError:
+        return json.dumps({"error": "invalid LIST options"}).encode()
+
+    entries = after(cursor, options.get("PREFIX", ""), limit)
+    result = []
+    for name, size, mtime_ns, is_dir in entries:
+        item = {"name": name}
+        if is_dir:
+            item["dir"] = True
+        if "SIZE" in parts:
+            item["size"] = size
+        if "MTIME" in parts:
+            item["mtime_ns"] = mtime_ns
+        if "HASH" in parts and not is_dir:
+            item["hash"] = _known_hash(name, size, mtime_ns)
+        result.append(item)
+    next_cursor = entries[-1][0].encode().hex() if len(entries) == limit else None
+    return json.dumps({"entries": result, "next": next_cursor}).encode()
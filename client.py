@@ -1,14 +1,32 @@
 import socket
 import os
+import time
 import zlib
 import json
 import utils
+import compression
+import striped
+import dirsync
+import resume
+import protocol2
 
-client = socket.socket()
-client.connect(("127.0.0.1", 5001))
+SERVER = ("127.0.0.1", 5001)
+
+def connect():
+    sock = socket.socket()
+    sock.connect(SERVER)
+    return sock
+
+def reconnect(error):
+    # An interrupted upload keeps its server session: the same command resumes it
+    print(f"[-] Connection lost ({error}). Reconnecting; repeat the command to resume.")
+    return connect()
+
+client = connect()
+recv_buffer = bytearray(utils.RECV_BUFFER_SIZE)  # reused by every plain download
 
 while True:
-    cmd = input("Enter command (UPLOAD filename / DOWNLOAD filename / LIST / EXIT): ")
+    cmd = input("Enter command (UPLOAD filename / UPLOAD_DELTA filename / DOWNLOAD filename / DOWNLOAD_DELTA filename / SYNC_DIR directory / BATCH cmd ; cmd ... / LIST [PREFIX=p] [SIZE] [MTIME] [HASH] / EXIT): ")
     parts = cmd.split()
 
     # ----- EXIT -----
@@ -16,54 +34,155 @@ while True:
         client.send(cmd.encode())
         break
 
-    # ----- LIST -----
+    # ----- LIST [PREFIX=p] [SIZE] [MTIME] [HASH] -----
     elif parts[0] == "LIST":
-        client.send(cmd.encode())
-        response = client.recv(4096).decode()
-        print("Server:\n", response)
+        prefix = next((p[7:] for p in parts[1:] if p.startswith("PREFIX=")), "")
+        fields = [p for p in parts[1:] if p in ("SIZE", "MTIME", "HASH")]
+        print("Server:")
+        count = 0
+        try:
+            for entry in utils.list_files(client, prefix, fields):
+                columns = [entry["name"] + ("/" if entry.get("dir") else "")]
+                if "size" in entry:
+                    columns.append(str(entry["size"]))
+                if "mtime_ns" in entry:
+                    columns.append(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["mtime_ns"] / 1e9)))
+                if "hash" in entry:
+                    columns.append(entry["hash"] or "-")
+                print("  ".join(columns))
+                count += 1
+        except ConnectionError as e:
+            print(f"[-] LIST failed: {e}")
+            client = reconnect(e)
+            continue
+        if not count:
+            print("No files found")
+
+    # ----- BATCH (pipelined over a framed v2 connection) -----
+    elif parts[0] == "BATCH":
+        commands = [c.strip() for c in cmd[len("BATCH"):].split(";") if c.strip()]
+        if not commands:
+            print("Usage: BATCH LIST ; STAT f ; DOWNLOAD f [OFFSET=o] [LENGTH=l] ; UPLOAD f ; DELETE f password")
+            continue
+        batch_sock = protocol2.connect(SERVER)
+        if batch_sock is None:
+            print("[-] Server does not support protocol v2")
+            continue
+        with batch_sock:
+            # All requests go out at once; replies come back in order
+            for command, reply in protocol2.pipeline(batch_sock, commands):
+                print(f"[{command}] {reply}")
 
 
     # ----- UPLOAD -----
     elif parts[0] == "UPLOAD":
         if len(parts) < 2:
-            print("Usage: UPLOAD filename")
+            print("Usage: UPLOAD filename [COMPRESS=zlib,lzma|none] [STRIPES=n] [RESUME=token]")
             continue
         filename = parts[1]
         if not os.path.exists(filename):
             print("File not found!")
             continue
 
-        client.send(cmd.encode())  # send "UPLOAD filename"
-        
-        # Wait for server acknowledgment/readiness
-        ack = client.recv(1024).decode()
-        if ack != "OK":
-            print(f"[-] Server Error: {ack}")
+        # Striped: byte ranges over n parallel connections, committed by the server at the end
+        stripes = next((p.split("=")[1] for p in parts[2:] if p.startswith("STRIPES=")), None)
+        if stripes is not None:
+            if not stripes.isdigit() or not 1 <= int(stripes) <= striped.MAX_STRIPES:
+                print(f"[-] STRIPES must be 1-{striped.MAX_STRIPES}")
+                continue
+            print(f"[*] Uploading in up to {stripes} stripes...")
+            status = striped.upload_striped(client, filename, filename, int(stripes))
+            if status == "INTEGRITY_OK":
+                print("[+] File uploaded.")
+            else:
+                print(f"[-] Striped upload failed: {status}")
             continue
 
-        with open(filename, "rb") as f:
-            data = f.read()
+        # Offer adaptive compression unless the user chose the codecs; data that does not
+        # compress in a quick sample keeps the plain sendfile path
+        if not any(p.startswith("COMPRESS=") for p in parts[2:]) and compression.worth_compressing(filename):
+            cmd += f" COMPRESS={compression.format_codecs(compression.SUPPORTED_CODECS)}"
+        # Ask for a resumable session (or continue an interrupted one)
+        if not any(p == "RESUMABLE" or p.startswith("RESUME=") for p in parts[2:]):
+            cmd += " " + resume.request_option("UPLOAD", filename)
+        client.send(cmd.encode())  # send "UPLOAD filename COMPRESS=... RESUMABLE"
         
-        client.send(str(len(data)).encode())  # send file size
+        # Wait for server acknowledgment/readiness (OK COMPRESS=... TOKEN=... for what it agreed)
+        response = client.recv(1024).decode()
+        ack = utils.parse_ack(response, "OK")
+        if ack is None:
+            print(f"[-] Server Error: {response}")
+            continue
+        codecs = compression.negotiate_codecs(ack["COMPRESS"]) if "COMPRESS" in ack else []
+        if "TOKEN" in ack:
+            resume.remember("UPLOAD", filename, ack["TOKEN"])
+
+        filesize = os.path.getsize(filename)
+        client.send(str(filesize).encode())  # send file size
         
-        ack = client.recv(1024).decode()  # wait for OK for size
-        if ack != "OK":
-            print(f"[-] Server Error: {ack}")
+        response = client.recv(1024).decode()  # wait for OK for size (OFFSET= when resuming)
+        ack = utils.parse_ack(response, "OK")
+        if ack is None:
+            print(f"[-] Server Error: {response}")
             continue
+        offset = int(ack.get("OFFSET", 0))
+        if offset:
+            print(f"[*] Resuming at {offset} of {filesize} bytes...")
             
-        client.send(data)  # send file
+        try:
+            with open(filename, "rb") as f:
+                if codecs:
+                    f.seek(offset)
+                    compression.send_stream(client, f, filesize - offset, compression.AdaptiveCompressor(codecs))
+                else:
+                    utils.send_file_range(client, f, offset, filesize - offset)  # send file (zero-copy)
+        except ConnectionError as e:
+            client = reconnect(e)
+            continue
+        resume.forget("UPLOAD", filename)
         print("[+] File uploaded.")
 
     # ----- UPLOAD_DELTA -----
     elif parts[0] == "UPLOAD_DELTA":
         if len(parts) < 2:
-            print("Usage: UPLOAD_DELTA filename")
+            print("Usage: UPLOAD_DELTA filename [ROLLING | MERKLE | CDC[=min:avg:max]] [HASH=algo-bytes] [BLOCK=auto|bytes] [WINDOW=n] [COMPRESS=zlib,lzma|none] [RESUME=token]")
             continue
         filename = parts[1]
         if not os.path.exists(filename):
             print("File not found!")
             continue
 
+        # Pipeline blocks unless the user picked a window explicitly
+        window = utils.DELTA_WINDOW
+        options = []
+        for part in parts[2:]:
+            if part.startswith("WINDOW="):
+                try:
+                    window = max(0, int(part.split("=")[1]))
+                except ValueError:
+                    pass
+            else:
+                options.append(part)
+        use_cdc = any(o == "CDC" or o.startswith("CDC=") for o in options)
+        if not use_cdc and not {"ROLLING", "BINARY", "MERKLE"} & set(options):
+            options.append("BINARY")
+        # Propose cheaper block digests and a per-file block size for the binary manifest
+        if "BINARY" in options and not any(o.startswith("HASH=") for o in options):
+            options.append(f"HASH={utils.format_hash_spec(utils.PREFERRED_HASH)}")
+        if "BINARY" in options and not any(o.startswith("BLOCK=") for o in options):
+            options.append("BLOCK=auto")
+        # Missing blocks are compressed adaptively (the rolling delta stays raw)
+        if "ROLLING" not in options and not any(o.startswith("COMPRESS=") for o in options):
+            options.append(f"COMPRESS={compression.format_codecs(compression.SUPPORTED_CODECS)}")
+        # The server sizes its Merkle tree by the file size we announce
+        if "MERKLE" in options:
+            options.append(f"SIZE={os.path.getsize(filename)}")
+        # Binary-manifest block mode can resume an interrupted sync
+        if ("BINARY" in options and "MERKLE" not in options
+                and not any(o == "RESUMABLE" or o.startswith("RESUME=") for o in options)):
+            options.append(resume.request_option("UPLOAD_DELTA", filename))
+        cmd = " ".join(["UPLOAD_DELTA", filename] + options + [f"WINDOW={window}"])
+
         # 1. Send Command
         client.send(cmd.encode())
 
@@ -73,74 +192,120 @@ while True:
             print("[-] File not found on server. Full upload required.")
             print("[-] Use 'UPLOAD' command instead.")
             continue
-        elif response != "ACK":
+        ack = utils.parse_ack(response)
+        if ack is None or (use_cdc and "CDC" not in ack):
             print(f"[-] Server Error: {response}")
             continue
+        if use_cdc:
+            cdc_params = utils.parse_cdc_params(ack["CDC"])
+        # The server's ACK says which block hash it agreed to (none = SHA-256, 32 bytes)
+        hash_spec = utils.parse_hash_spec(ack["HASH"]) if "HASH" in ack else utils.DEFAULT_HASH
+        block_size = int(ack.get("BLOCK", utils.BLOCK_SIZE))
+        codecs = compression.negotiate_codecs(ack["COMPRESS"]) if "COMPRESS" in ack else []
+        if "TOKEN" in ack:
+            resume.remember("UPLOAD_DELTA", filename, ack["TOKEN"])
+
+        # CDC mode: chunk sizes come back in the ACK, chunks are matched anywhere in the server's copy
+        if use_cdc:
+            print(f"[Delta Sync] Chunking file (CDC {utils.format_cdc_params(cdc_params)})...")
+            chunks, file_hash = utils.send_chunk_manifest(client, filename, cdc_params)
+            missing_chunks = utils.recv_block_ranges(client)
+            if missing_chunks is None:
+                print("[-] Error processing server response: malformed missing-chunk ranges")
+                continue
+
+            total_bytes = sum(length for _, length in chunks)
+            missing_bytes = sum(chunks[i][1] for i in missing_chunks)
+            print(f"[Delta Sync] Chunks: {len(chunks)}, already on server: {len(chunks) - len(missing_chunks)}")
+            if total_bytes > 0:
+                print(f"[Delta Sync] Uploading {missing_bytes/1024:.2f} KB instead of {total_bytes/1024:.2f} KB")
+                print(f"[Delta Sync] Bandwidth saved: {100 * (1 - missing_bytes / total_bytes):.1f}%")
+
+            if missing_chunks:
+                compressor = compression.AdaptiveCompressor(codecs) if codecs else None
+                utils.send_delta_blocks(client, filename, missing_chunks, window, chunks=chunks, compressor=compressor)
+
+            final_status = client.recv(1024).decode()
+            if final_status == "INTEGRITY_OK":
+                print("[+] Delta Sync Successful! File updated on server.")
+            else:
+                print("[-] Integrity Check Failed on Server.")
+            continue
+
+        # ROLLING mode: server sends its signature, we send COPY/LITERAL instructions
+        if "ROLLING" in parts[2:]:
+            client.send(b"OK")
+
+            sig_len = int(utils.recv_exact(client, 10).decode().strip())
+            signature = json.loads(utils.recv_exact(client, sig_len).decode())
+
+            print("[Delta Sync] Matching against server signature (rolling checksum)...")
+            literal_bytes = 0
+            copied_bytes = 0
+            for op in utils.compute_delta(filename, signature):
+                if op[0] == "COPY":
+                    copied_bytes += op[2]
+                elif op[0] == "LITERAL":
+                    literal_bytes += len(op[1])
+                client.sendall(utils.encode_delta_op(op))
+
+            total_bytes = literal_bytes + copied_bytes
+            print(f"[Delta Sync] Reused {copied_bytes} bytes, sent {literal_bytes} bytes")
+            if total_bytes > 0:
+                print(f"[Delta Sync] Bandwidth saved: {100 * (1 - literal_bytes / total_bytes):.1f}%")
+
+            final_status = client.recv(1024).decode()
+            if final_status == "INTEGRITY_OK":
+                print("[+] Delta Sync Successful! File updated on server.")
+            else:
+                print("[-] Integrity Check Failed on Server.")
+            continue
 
-        # 3. Compute Hashes
-        print("[Delta Sync] Computing file hashes...")
-        total_blocks, block_hashes, file_hash = utils.get_file_block_hashes(filename)
-        
-        start_msg = {
-            "total_blocks": total_blocks,
-            "hashes": block_hashes,
-            "file_hash": file_hash
-        }
-        json_data = json.dumps(start_msg).encode()
-        
-        # 4. Send Hash List
-        client.send(str(len(json_data)).encode().ljust(10)) # Send size fixed width
-        
-        ack = client.recv(1024).decode()
-        if ack != "OK":
-             print(f"[-] Server Error waiting for json: {ack}")
-             continue
-             
-        client.send(json_data)
-        
-        # 5. Receive Missing Blocks List
-        # Read size first (fixed 10 bytes)
-        resp_len_data = client.recv(10).decode().strip()
         try:
-            resp_len = int(resp_len_data)
-            
-            resp_data = b""
-            while len(resp_data) < resp_len:
-                chunk = client.recv(min(4096, resp_len - len(resp_data)))
-                if not chunk: break
-                resp_data += chunk
-            
-            missing_blocks = json.loads(resp_data.decode())["missing"]
+            if "MERKLE" in options:
+                # 3. Send Block Count + File Hash, then descend only into differing subtrees
+                print("[Delta Sync] Computing file hashes (Merkle tree)...")
+                total_blocks, block_hashes, file_hash = utils.get_file_block_hashes(filename)
+                client.sendall(total_blocks.to_bytes(8, 'big') + bytes.fromhex(file_hash))
+
+                # 4. Missing Blocks fall out of the last round
+                exchange = utils.merkle_exchange_client(client, block_hashes)
+                if exchange is None:
+                    raise ValueError("malformed Merkle reply")
+                missing_blocks, hash_bytes = exchange
+                print(f"[Delta Sync] Merkle exchange sent {hash_bytes} bytes of hashes")
+            else:
+                # 3. Stream Binary Manifest (hashing and sending overlap)
+                print("[Delta Sync] Computing file hashes...")
+                print(f"[Delta Sync] Block size: {block_size} bytes")
+                total_blocks, file_hash = utils.send_binary_manifest(client, filename, hash_spec, block_size)
+
+                # 4. Receive Missing Blocks (run-length ranges)
+                missing_blocks = utils.recv_block_ranges(client)
+                if missing_blocks is None:
+                    raise ValueError("malformed missing-block ranges")
             
             # LOGGING
             print(f"[Delta Sync] Total Blocks: {total_blocks}")
             print(f"[Delta Sync] Blocks already on server: {total_blocks - len(missing_blocks)}")
-            saved_size_est = (total_blocks - len(missing_blocks)) * utils.BLOCK_SIZE
-            total_size_est = total_blocks * utils.BLOCK_SIZE # Approx
+            saved_size_est = (total_blocks - len(missing_blocks)) * block_size
+            total_size_est = total_blocks * block_size # Approx
             if total_size_est > 0:
-                 print(f"[Delta Sync] Uploading only {len(missing_blocks)} blocks ({(len(missing_blocks)*utils.BLOCK_SIZE)/1024:.2f} KB instead of {total_size_est/1024:.2f} KB)")
+                 print(f"[Delta Sync] Uploading only {len(missing_blocks)} blocks ({(len(missing_blocks)*block_size)/1024:.2f} KB instead of {total_size_est/1024:.2f} KB)")
                  print(f"[Delta Sync] Bandwidth saved: {100 * (1 - len(missing_blocks)/total_blocks):.1f}%")
             
-            # 6. Send Missing Blocks
-            with open(filename, "rb") as f:
-                for idx in missing_blocks:
-                    # Read block
-                    f.seek(idx * utils.BLOCK_SIZE)
-                    block_data = f.read(utils.BLOCK_SIZE)
-                    
-                    # Send Header: Index (4) + Len (4)
-                    header = idx.to_bytes(4, 'big') + len(block_data).to_bytes(4, 'big')
-                    client.send(header)
-                    client.send(block_data)
-                    
-                    # Wait for ACK per block
-                    ack = client.recv(1024).decode()
-                    if ack != "ACK":
-                        print(f"[-] Block {idx} upload failed")
-                        break
+            # 5. Send Missing Blocks (pipelined, cumulative ACKs)
+            compressor = compression.AdaptiveCompressor(codecs) if codecs else None
+            try:
+                utils.send_delta_blocks(client, filename, missing_blocks, window, block_size=block_size,
+                                        compressor=compressor)
+            except ConnectionError as e:
+                client = reconnect(e)
+                continue
                         
-            # 7. Final Integrity Check
+            # 6. Final Integrity Check
             final_status = client.recv(1024).decode()
+            resume.forget("UPLOAD_DELTA", filename)
             if final_status == "INTEGRITY_OK":
                 print("[+] Delta Sync Successful! File updated on server.")
             else:
@@ -150,13 +315,89 @@ while True:
             print(f"[-] Error processing server response: {e}")
 
 
+    # ----- SYNC_DIR -----
+    elif parts[0] == "SYNC_DIR":
+        if len(parts) < 2:
+            print("Usage: SYNC_DIR directory [HASH]")
+            continue
+        directory = parts[1]
+        if not os.path.isdir(directory):
+            print("Directory not found!")
+            continue
+
+        # One listing, one reply, then only the changed files back-to-back
+        print(f"[Dir Sync] Scanning {directory}...")
+        result = dirsync.sync_dir(client, directory, "HASH" in parts[2:])
+        if isinstance(result, str):
+            print(f"[-] Directory sync failed: {result}")
+            continue
+        print(f"[Dir Sync] Unchanged: {result['unchanged']}, delta: {result['delta']}, "
+              f"full: {result['full']}, skipped: {result['skipped']}, failed: {result['failed']}")
+        if result["failed"]:
+            print("[-] Some files failed the integrity check on the server.")
+        else:
+            print("[+] Directory sync complete.")
+
+    # ----- DOWNLOAD_DELTA -----
+    elif parts[0] == "DOWNLOAD_DELTA":
+        if len(parts) < 2:
+            print("Usage: DOWNLOAD_DELTA filename [COMPRESS=zlib,lzma|none] [BLOCK=auto|bytes]")
+            continue
+        filename = parts[1]
+        if not os.path.exists(filename):
+            print("[-] No local copy to sync against. Use 'DOWNLOAD' instead.")
+            continue
+
+        if not any(p.startswith("COMPRESS=") for p in parts[2:]):
+            cmd += f" COMPRESS={compression.format_codecs(compression.SUPPORTED_CODECS)}"
+        # Let the server pick the block size for this file (announced in the ACK)
+        if not any(p.startswith("BLOCK=") for p in parts[2:]):
+            cmd += " BLOCK=auto"
+        client.send(cmd.encode())
+
+        response = client.recv(1024).decode()
+        if response == "NOT_FOUND":
+            print("[-] File does not exist on server.")
+            continue
+        ack = utils.parse_ack(response)
+        if ack is None:
+            print(f"[-] Server Error: {response}")
+            continue
+
+        print("[Delta Sync] Computing local file hashes...")
+        block_size = int(ack.get("BLOCK", utils.BLOCK_SIZE))
+        ok, blocks_received, total_blocks = utils.recv_delta_download(client, filename, compressed="COMPRESS" in ack,
+                                                                      block_size=block_size)
+        print(f"[Delta Sync] Received {blocks_received} of {total_blocks} blocks")
+        if total_blocks > 0:
+            print(f"[Delta Sync] Bandwidth saved: {100 * (1 - blocks_received / total_blocks):.1f}%")
+        if ok:
+            print(f"[+] Delta download complete. {filename} is up to date.")
+        else:
+            print("[-] Delta download failed integrity check. Local file left unchanged.")
+
     # ----- DOWNLOAD -----
     elif parts[0] == "DOWNLOAD":
         if len(parts) < 2:
-            print("Usage: DOWNLOAD filename")
+            print("Usage: DOWNLOAD filename [STRIPES=n]")
             continue
 
         filename = parts[1]
+
+        # Striped: no resume/compression prompts, the file is replaced only once verified
+        stripes = next((p.split("=")[1] for p in parts[2:] if p.startswith("STRIPES=")), None)
+        if stripes is not None:
+            if not stripes.isdigit() or not 1 <= int(stripes) <= striped.MAX_STRIPES:
+                print(f"[-] STRIPES must be 1-{striped.MAX_STRIPES}")
+                continue
+            ok, message = striped.download_striped(client, filename, filename, int(stripes))
+            if ok:
+                print(f"[+] Download complete ({message}). Saved as {filename}")
+            elif message == "NOT_FOUND":
+                print("[-] File does not exist on server.")
+            else:
+                print(f"[-] Striped download failed: {message}")
+            continue
         offset = 0
         mode = "wb"
         use_compression = False
@@ -178,9 +419,10 @@ while True:
         # Ask for compression (Optional, but let's enable it by default for "Innovation" or ask user?)
         # For this demo, let's just enable it if it's a fresh download or if the user wants "Turbo Mode".
         # Prompt user:
+        # Adaptive: the server picks codec and level per chunk, or sends it raw
         comp_choice = input("Enable Compression? (y/n): ")
         if comp_choice.lower() == 'y':
-            cmd += " COMPRESS"
+            cmd += f" COMPRESS={compression.format_codecs(compression.SUPPORTED_CODECS)}"
             use_compression = True
         
         client.send(cmd.encode())  # send request
@@ -191,9 +433,17 @@ while True:
             continue
             
         is_compressed = False
+        is_framed = False
         filesize = 0
         
-        if response.startswith("COMPRESSED_"):
+        if response.startswith("FRAMED_"):
+            is_framed = True
+            try:
+                filesize = int(response.split("_")[1])
+            except ValueError:
+                print(f"[-] Error: Server sent invalid size: {response}")
+                continue
+        elif response.startswith("COMPRESSED_"):
             is_compressed = True
             try:
                 filesize = int(response.split("_")[1])
@@ -214,27 +464,29 @@ while True:
         client.send(b"OK")  # acknowledge to start transfer
 
         with open(filename, mode) as f:
-            if is_compressed:
+            if is_framed:
+                print("[*] Receiving Compressed Stream (adaptive)...")
+                if compression.recv_stream(client, f, filesize) is None:
+                    print("[-] Malformed compressed frame, download incomplete.")
+            elif is_compressed:
                 print("[*] Receiving Compressed Stream...")
                 decompressor = zlib.decompressobj()
+                reader = utils.SocketReader(client)
                 while True:
                     # Read Chunk Length (4 bytes)
-                    len_bytes = client.recv(4)
-                    if not len_bytes:
+                    len_bytes = reader.recv_exactly(4)
+                    if len(len_bytes) < 4:
                         break
                     chunk_len = int.from_bytes(len_bytes, byteorder='big')
                     
                     if chunk_len == 0:
                         break # EOF
                     
-                    # Read Chunk Data
-                    compressed_data = b""
-                    while len(compressed_data) < chunk_len:
-                        packet = client.recv(chunk_len - len(compressed_data))
-                        if not packet:
-                            break
-                        compressed_data += packet
-                        
+                    # Read Chunk Data (into the reader's buffer, no concatenation)
+                    compressed_data = reader.recv_exactly(chunk_len)
+                    if len(compressed_data) < chunk_len:
+                        break
+
                     # Decompress
                     decompressed = decompressor.decompress(compressed_data)
                     f.write(decompressed)
@@ -244,18 +496,7 @@ while True:
             
             else:
                 # Normal Transfer
-                bytes_received = 0
-                while bytes_received < filesize:
-                    chunk_size = 4096
-                    remaining = filesize - bytes_received
-                    if remaining < chunk_size:
-                        chunk_size = remaining
-                    
-                    data = client.recv(chunk_size)
-                    if not data:
-                        break
-                    f.write(data)
-                    bytes_received += len(data)
+                utils.recv_to_file(client, f, filesize, recv_buffer)
 
         print(f"[+] Download complete. Saved as {filename}")
 
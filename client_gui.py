@@ -3,17 +3,15 @@ import threading
 import os
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
-import json
 import utils
 
-CHUNK = 64 * 1024  # 64 KB
-
 class FileTransferGUI:
     def __init__(self, root):
         self.root = root
         self.root.title("Multi-Client File Transfer — GUI Client")
         self.sock = None
         self.connected = False
+        self.recv_buffer = bytearray(utils.RECV_BUFFER_SIZE)  # reused by every plain download
 
         # --- Top bar: connection ---
         top = ttk.Frame(root, padding=10)
@@ -151,9 +149,10 @@ class FileTransferGUI:
             return
         def _do_list():
             try:
-                self.send_cmd("LIST")
-                resp = self.recv_text(65536)
-                files = [f for f in resp.splitlines() if f.strip()]
+                if not self.connected:
+                    raise RuntimeError("Not connected")
+                # Paged LIST: the whole listing arrives however many files there are
+                files = [entry["name"] for entry in utils.list_files(self.sock)]
                 self.files_list.delete(0, "end")
                 for f in files:
                     self.files_list.insert("end", f)
@@ -181,40 +180,25 @@ class FileTransferGUI:
                     self.log_msg(f"[*] Attempting Delta Sync for '{filename}'...")
                     
                     # 1) Send UPLOAD_DELTA command
-                    self.send_cmd(f"UPLOAD_DELTA {filename}")
+                    self.send_cmd(f"UPLOAD_DELTA {filename} BINARY HASH={utils.format_hash_spec(utils.PREFERRED_HASH)} "
+                                  f"BLOCK=auto WINDOW={utils.DELTA_WINDOW}")
                     
                     # 2) Check Response
                     response = self.sock.recv(1024).decode()
+                    ack = utils.parse_ack(response)
                     
-                    if response == "ACK":
+                    if ack is not None:
                          # ... Delta Logic ...
                          # To avoid code duplication and massive nesting, let's keep it here.
                          self.log_msg("[+] Server ready for Delta Sync. Computing hashes...")
                          
-                         total_blocks, block_hashes, file_hash = utils.get_file_block_hashes(path)
-                         start_msg = {
-                            "total_blocks": total_blocks,
-                            "hashes": block_hashes,
-                            "file_hash": file_hash
-                         }
-                         json_data = json.dumps(start_msg).encode()
-                         
-                         self.sock.sendall(str(len(json_data)).encode().ljust(10))
-                         if self.recv_text(1024) != "OK":
-                              raise RuntimeError("Server error receiving hash list size")
-                         
-                         self.sock.sendall(json_data)
-                         
-                         len_data = self.sock.recv(10).decode().strip()
-                         resp_len = int(len_data)
-                         
-                         resp_data = b""
-                         while len(resp_data) < resp_len:
-                             chunk = self.sock.recv(min(4096, resp_len - len(resp_data)))
-                             if not chunk: break
-                             resp_data += chunk
-                         
-                         missing_blocks = json.loads(resp_data.decode())["missing"]
+                         # Stream binary manifest, get missing blocks back as ranges
+                         hash_spec = utils.parse_hash_spec(ack["HASH"]) if "HASH" in ack else utils.DEFAULT_HASH
+                         block_size = int(ack.get("BLOCK", utils.BLOCK_SIZE))
+                         total_blocks, file_hash = utils.send_binary_manifest(self.sock, path, hash_spec, block_size)
+                         missing_blocks = utils.recv_block_ranges(self.sock)
+                         if missing_blocks is None:
+                             raise RuntimeError("Server sent malformed missing-block ranges")
                          
                          saved_blocks = total_blocks - len(missing_blocks)
                          self.log_msg(f"[Delta Sync] Blocks present: {saved_blocks}/{total_blocks}")
@@ -223,26 +207,16 @@ class FileTransferGUI:
                              self.log_msg(f"[Delta Sync] Bandwidth saved: {saved_pct:.1f}%")
                          
                          self.progress["value"] = 0
-                         count = 0
                          total_missing = len(missing_blocks)
-                         
-                         with open(path, "rb") as f:
-                             for idx in missing_blocks:
-                                 f.seek(idx * utils.BLOCK_SIZE)
-                                 block_data = f.read(utils.BLOCK_SIZE)
-                                 
-                                 header = idx.to_bytes(4, 'big') + len(block_data).to_bytes(4, 'big')
-                                 self.sock.sendall(header)
-                                 self.sock.sendall(block_data)
-                                 
-                                 ack = self.recv_text(1024)
-                                 if ack != "ACK":
-                                     raise RuntimeError(f"Block {idx} failed")
-                                 
-                                 count += 1
-                                 if total_missing > 0:
-                                     self.progress["value"] = int((count / total_missing) * 100)
-                                     self.root.update_idletasks()
+
+                         def _on_block(count):
+                             self.progress["value"] = int((count / total_missing) * 100)
+                             self.root.update_idletasks()
+
+                         # Pipelined send, server ACKs cumulatively
+                         if not utils.send_delta_blocks(self.sock, path, missing_blocks, utils.DELTA_WINDOW, _on_block,
+                                                        block_size=block_size):
+                             raise RuntimeError("Delta block stream failed")
                                      
                          final = self.recv_text(1024)
                          if final == "INTEGRITY_OK":
@@ -273,17 +247,14 @@ class FileTransferGUI:
                 if self.recv_text(1024) != "OK":
                      raise RuntimeError("Server rejected size")
                      
-                sent = 0
                 self.progress["value"] = 0
+                def _on_sent(sent):
+                     self.progress["value"] = int((sent / size) * 100) if size else 100
+                     self.root.update_idletasks()
+
+                # Zero-copy sendfile, progress updated per window
                 with open(path, "rb") as f:
-                     while True:
-                         chunk = f.read(CHUNK)
-                         if not chunk: break
-                         self.sock.sendall(chunk)
-                         sent += len(chunk)
-                         pct = int((sent / size) * 100) if size else 100
-                         self.progress["value"] = pct
-                         self.root.update_idletasks()
+                     utils.send_file_range(self.sock, f, 0, size, _on_sent)
                 self.log_msg(f"✅ Full Upload Complete: '{filename}'")
                 self.refresh_list()
                 
@@ -346,6 +317,34 @@ class FileTransferGUI:
 
         def _do_download():
             try:
+                # Delta download if we already have an older copy at the destination
+                if self.var_delta.get() and os.path.exists(save_path):
+                    self.log_msg(f"[*] Attempting Delta Download for '{filename}'...")
+                    self.send_cmd(f"DOWNLOAD_DELTA {filename} BLOCK=auto")
+                    response = self.recv_text(1024)
+                    if response == "NOT_FOUND":
+                        self.log_msg("❌ Server says: file not found.")
+                        messagebox.showerror("Download Error", "File not found on server.")
+                        return
+                    ack = utils.parse_ack(response)
+                    if ack is None:
+                        raise RuntimeError(f"Unexpected server response: {response!r}")
+
+                    self.progress["value"] = 0
+                    def _on_block(count, total):
+                        self.progress["value"] = int((count / total) * 100)
+                        self.root.update_idletasks()
+
+                    block_size = int(ack.get("BLOCK", utils.BLOCK_SIZE))
+                    ok, received, total_blocks = utils.recv_delta_download(self.sock, save_path, _on_block,
+                                                                           block_size=block_size)
+                    self.log_msg(f"[Delta Sync] Received {received}/{total_blocks} blocks")
+                    if ok:
+                        self.log_msg(f"✅ Delta Download Complete: '{filename}' → '{save_path}'")
+                    else:
+                        self.log_msg("❌ Delta Download Integrity Failed! Local file left unchanged.")
+                    return
+
                 # 1) request
                 self.send_cmd(f"DOWNLOAD {filename}")
                 # 2) get size or NOT_FOUND
@@ -363,18 +362,15 @@ class FileTransferGUI:
                 self.sock.sendall(b"OK")
 
                 # 4) receive in chunks
-                received = 0
                 self.progress["value"] = 0
+                got = [0]
+                def _on_data(chunk):
+                    got[0] += len(chunk)
+                    self.progress["value"] = int((got[0] / size) * 100) if size else 100
+                    self.root.update_idletasks()
+
                 with open(save_path, "wb") as f:
-                    while received < size:
-                        chunk = self.sock.recv(min(CHUNK, size - received))
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                        received += len(chunk)
-                        pct = int((received / size) * 100) if size else 100
-                        self.progress["value"] = pct
-                        self.root.update_idletasks()
+                    received = utils.recv_to_file(self.sock, f, size, self.recv_buffer, _on_data)
 
                 if received == size:
                     self.log_msg(f"✅ Downloaded '{filename}' → '{save_path}' ({size} bytes)")
@@ -0,0 +1,241 @@
+import os
+import time
+import zlib
+import utils
+
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+
+# Adaptive compression for data streams (UPLOAD, DOWNLOAD, delta blocks).
+# Every chunk travels as a self-contained frame:
+#   Raw Length (4) + Codec (1) + Payload Length (4) + Payload
+# so each one can use a different codec/level, or go raw when it does not
+# shrink (already-compressed media). The level is picked from the measured
+# compression speed and ratio of each level against the measured link speed.
+
+RAW, ZLIB, LZMA = 0, 1, 2
+CODEC_IDS = {"zlib": ZLIB, "lzma": LZMA}
+SUPPORTED_CODECS = ["zlib"] + (["lzma"] if lzma is not None else [])
+
+FRAME_HEADER_SIZE = 9
+STREAM_CHUNK = 256 * 1024  # raw bytes per frame for whole-file streams
+# Largest raw frame anyone sends: a CDC chunk of utils.CDC_MAX_SIZE_LIMIT.
+# Receivers refuse bigger ones before reading the payload, and callers bound
+# it further by what they expect
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Candidates, fastest first
+LEVELS = [("zlib", 1), ("zlib", 6), ("zlib", 9), ("lzma", 0), ("lzma", 6)]
+MIN_COMPRESS_SIZE = 512   # smaller chunks are not worth a codec call
+SKIP_RATIO = 0.9          # send raw unless the chunk shrinks by 10%+
+PROBE_INTERVAL = 32       # re-measure one level every N chunks
+MIN_LINK_SENDS = 4        # frames sent before the link speed is trusted
+STATS_WEIGHT = 0.3        # weight of the newest sample in the per-level averages
+SAMPLE_SIZE = 64 * 1024   # worth_compressing: bytes per sample
+SAMPLE_COUNT = 4          # samples spread over the file
+
+def negotiate_codecs(text):
+    """Codecs from a "zlib,lzma" proposal that we support, in our order."""
+    offered = set(text.split(","))
+    return [name for name in SUPPORTED_CODECS if name in offered]
+
+def format_codecs(codecs):
+    return ",".join(codecs)
+
+def worth_compressing(file_path):
+    """
+    Cheap check before offering compression for a whole file: zlib level 1
+    over a few samples spread across it. False for already-compressed or
+    random data, which then keeps the plain (sendfile) path.
+    """
+    size = os.path.getsize(file_path)
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    raw = packed = 0
+    step = max(SAMPLE_SIZE, size // SAMPLE_COUNT)
+    with open(file_path, "rb") as f:
+        for offset in range(0, size, step)[:SAMPLE_COUNT]:
+            f.seek(offset)
+            data = f.read(SAMPLE_SIZE)
+            raw += len(data)
+            packed += len(zlib.compress(data, 1))
+    return packed <= raw * SKIP_RATIO
+
+def compress_chunk(data, codec, level):
+    if codec == "zlib":
+        return zlib.compress(data, level)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=level)
+
+def decode_frame(raw_len, codec, payload):
+    """Raw bytes of a frame, or None if it does not decode to exactly raw_len bytes."""
+    if raw_len > MAX_FRAME_SIZE:
+        return None
+    if codec == RAW:
+        return payload if len(payload) == raw_len else None
+    try:
+        if codec == ZLIB:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(payload, raw_len)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                return None
+        elif codec == LZMA and lzma is not None:
+            decompressor = lzma.LZMADecompressor()
+            data = decompressor.decompress(payload, raw_len)
+            if not decompressor.eof:
+                return None
+        else:
+            return None
+    except (zlib.error, lzma.LZMAError if lzma else zlib.error):
+        return None
+    return data if len(data) == raw_len else None
+
+def parse_frame_header(header, max_raw=MAX_FRAME_SIZE):
+    """
+    (raw_len, codec, payload_len) of a frame header, or None if the frame
+    decodes to more than `max_raw` bytes (never more than MAX_FRAME_SIZE) or
+    its payload is longer than that (a chunk that does not shrink goes raw).
+    """
+    raw_len, codec, payload_len = (int.from_bytes(header[:4], 'big'), header[4],
+                                   int.from_bytes(header[5:9], 'big'))
+    if raw_len > min(max_raw, MAX_FRAME_SIZE) or payload_len > raw_len:
+        return None
+    return raw_len, codec, payload_len
+
+def recv_frame_body(sock, header, reader=None, max_raw=MAX_FRAME_SIZE):
+    """
+    Receives the payload announced by `header` and decodes it (None on error,
+    or if it would decode to more than `max_raw` bytes).
+    With a utils.SocketReader the payload lands in its reusable buffer; a raw
+    frame's data is then only valid until the reader's next read.
+    """
+    frame = parse_frame_header(header, max_raw)
+    if frame is None:
+        return None
+    raw_len, codec, payload_len = frame
+    if reader is not None:
+        payload = reader.recv_exactly(payload_len)
+    else:
+        payload = utils.recv_exact(sock, payload_len)
+    if len(payload) < payload_len:
+        return None
+    return decode_frame(raw_len, codec, payload)
+
+def recv_frame(sock, reader=None, max_raw=MAX_FRAME_SIZE):
+    header = utils.recv_exact(sock, FRAME_HEADER_SIZE)
+    if len(header) < FRAME_HEADER_SIZE:
+        return None
+    return recv_frame_body(sock, header, reader, max_raw)
+
+class AdaptiveCompressor:
+    """
+    Encodes one transfer's chunks as frames, choosing per chunk between raw
+    and the negotiated codec levels. Cost per input byte of a level is
+    1 / compress_speed + ratio / link_speed (raw: 1 / link_speed); the
+    cheapest measured option wins, and one level is re-measured every
+    PROBE_INTERVAL chunks so the choice follows the data and the link.
+    """
+    def __init__(self, codecs):
+        self.levels = [lv for lv in LEVELS if lv[0] in codecs]
+        self.stats = {}  # level -> [input bytes/s, compressed/raw ratio]
+        self.link_bytes = 0
+        self.link_time = 0.0
+        self.sends = 0
+        self.chunks = 0
+
+    def link_speed(self):
+        if self.sends < MIN_LINK_SENDS or self.link_time <= 0:
+            return None
+        return self.link_bytes / self.link_time
+
+    def sent(self, wire_bytes, seconds):
+        """Reports how long handing `wire_bytes` to the socket took."""
+        self.link_bytes += wire_bytes
+        self.link_time += seconds
+        self.sends += 1
+
+    def _choose(self):
+        if not self.levels:
+            return None
+        self.chunks += 1
+        if not self.stats or self.chunks % PROBE_INTERVAL == 0:
+            cheapest = self.stats.get(self.levels[0])
+            if cheapest is not None and cheapest[1] > SKIP_RATIO:
+                # Not even shrinking at the fastest level: slower ones are not worth a probe
+                return self.levels[0]
+            return self.levels[(self.chunks // PROBE_INTERVAL) % len(self.levels)]
+
+        link = self.link_speed()
+        if link is None:
+            return self.levels[0]  # cheapest level until the link is measured
+
+        best, best_cost = None, 1.0 / link
+        for level, (speed, ratio) in self.stats.items():
+            cost = 1.0 / speed + ratio / link
+            if cost < best_cost:
+                best, best_cost = level, cost
+        return best
+
+    def _record(self, level, speed, ratio):
+        previous = self.stats.get(level)
+        if previous is None:
+            self.stats[level] = [speed, ratio]
+        else:
+            previous[0] += STATS_WEIGHT * (speed - previous[0])
+            previous[1] += STATS_WEIGHT * (ratio - previous[1])
+
+    def frame(self, data):
+        """Returns (frame_header, payload) for one chunk."""
+        level = self._choose() if len(data) >= MIN_COMPRESS_SIZE else None
+        if level is not None:
+            start = time.perf_counter()
+            payload = compress_chunk(data, *level)
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            ratio = len(payload) / len(data)
+            self._record(level, len(data) / elapsed, ratio)
+            if ratio <= SKIP_RATIO:
+                header = (len(data).to_bytes(4, 'big') + bytes([CODEC_IDS[level[0]]])
+                          + len(payload).to_bytes(4, 'big'))
+                return header, payload
+
+        header = len(data).to_bytes(4, 'big') + bytes([RAW]) + len(data).to_bytes(4, 'big')
+        return header, data
+
+def send_stream(sock, f, size, compressor, progress=None):
+    """
+    Sends `size` bytes of the open file `f` (from its current position) as
+    frames of STREAM_CHUNK raw bytes. Returns raw bytes sent.
+    `progress(raw_bytes_sent)` is called after each frame.
+    """
+    sent = 0
+    while sent < size:
+        data = f.read(min(STREAM_CHUNK, size - sent))
+        if not data:
+            break
+        header, payload = compressor.frame(data)
+        start = time.perf_counter()
+        utils.send_parts(sock, header, payload)
+        compressor.sent(len(header) + len(payload), time.perf_counter() - start)
+        sent += len(data)
+        if progress:
+            progress(sent)
+    return sent
+
+def recv_stream(sock, f, size, on_data=None):
+    """
+    Receives frames until `size` raw bytes were written to `f`.
+    Returns raw bytes received, or None if a frame was malformed or runs
+    past `size`.
+    """
+    received = 0
+    reader = utils.SocketReader(sock, STREAM_CHUNK)
+    while received < size:
+        data = recv_frame(sock, reader, size - received)
+        if data is None:
+            return None
+        f.write(data)
+        if on_data:
+            on_data(data)
+        received += len(data)
+    return received
@@ -1,6 +1,9 @@
-from flask import Flask, jsonify, render_template
+from flask import Flask, Response, jsonify, render_template, request
 import monitor
+import catalog
 import os
+import json
+import time
 import logging
 
 # Disable Flask logs
@@ -9,6 +12,12 @@ log.setLevel(logging.ERROR)
 
 app = Flask(__name__)
 
+# Event stream: at most one update per STREAM_INTERVAL per browser, changes
+# in between are coalesced; a comment every KEEPALIVE keeps proxies from
+# closing an idle stream
+STREAM_INTERVAL = 0.5
+KEEPALIVE = 15
+
 @app.route("/")
 def index():
     return render_template("dashboard.html")
@@ -17,19 +26,62 @@ def index():
 def get_snapshot():
     return jsonify(monitor.get_snapshot())
 
+def _event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+@app.route("/api/stream")
+def stream():
+    """
+    Server-Sent Events: a full snapshot when the browser (re)connects, then
+    only what changed (see monitor.wait_for_changes).
+    """
+    def events():
+        snapshot, cursor = monitor.snapshot_position()
+        yield _event("snapshot", snapshot)
+        while True:
+            next_cursor, delta = monitor.wait_for_changes(cursor, KEEPALIVE)
+            if next_cursor is None:
+                # Fell behind the journal: start over from a snapshot
+                snapshot, cursor = monitor.snapshot_position()
+                yield _event("snapshot", snapshot)
+            elif delta:
+                cursor = next_cursor
+                yield _event("delta", delta)
+            else:
+                yield ": keepalive\n\n"
+                continue
+            time.sleep(STREAM_INTERVAL)
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route("/metrics")
+def get_metrics():
+    # Prometheus text format for scrapers
+    return Response(monitor.render_metrics(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/api/files")
 def get_files():
+    """
+    One page of the file catalog (no disk access per request):
+    ?prefix=&sort=name|size|mtime&order=asc|desc&offset=0&limit=100
+    """
+    args = request.args
+    sort = args.get("sort", "name")
+    if sort not in catalog.SORT_KEYS:
+        sort = "name"
     try:
-        files = os.listdir("files")
-        file_list = []
-        for f in files:
-            path = os.path.join("files", f)
-            size = os.path.getsize(path)
-            size_str = f"{size/1024:.1f} KB" if size < 1024*1024 else f"{size/1024/1024:.1f} MB"
-            file_list.append({"name": f, "size": size_str})
-        return jsonify(file_list)
-    except Exception:
-        return jsonify([])
+        offset = int(args.get("offset", 0))
+        limit = int(args.get("limit", 100))
+    except ValueError:
+        offset, limit = 0, 100
+    total, entries = catalog.page(args.get("prefix", ""), sort, args.get("order") == "desc", offset, limit)
+
+    file_list = []
+    for name, size, mtime_ns, is_dir in entries:
+        size_str = f"{size/1024:.1f} KB" if size < 1024*1024 else f"{size/1024/1024:.1f} MB"
+        file_list.append({"name": name, "size": "DIR" if is_dir else size_str, "bytes": size,
+                          "mtime": mtime_ns / 1e9})
+    return jsonify({"total": total, "offset": offset, "files": file_list})
 
 def run():
     print("[+] Dashboard running on http://localhost:8000")
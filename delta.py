@@ -0,0 +1,546 @@
+import json
+import hashlib
+import os
+import shutil
+import time
+import utils
+import compression
+import monitor
+import manifest_cache
+import reconstruct
+import blockstore
+import resume
+
+# Server side of the delta modes without the socket: option negotiation,
+# the comparison results and the rebuild of a file from its stored version
+# plus verified blocks, chunks or COPY/LITERAL instructions. server.py and
+# async_server.py only move the bytes; everything here is plain blocking
+# code (hashing, file I/O) that the asyncio engine runs on its executor.
+
+# ---------------------------------------------------------------------------
+# UPLOAD_DELTA
+# ---------------------------------------------------------------------------
+
+def parse_upload_options(parts):
+    """
+    Options of "UPLOAD_DELTA filename [...]" as a dict: window (None = ACK
+    per block), cdc_params, hash_spec (None = SHA-256, 32-byte digests),
+    block_request (None = BLOCK_SIZE, 0 = let the server choose), codecs
+    (block compression, not for ROLLING) and size (the client's file size,
+    announced for MERKLE).
+    """
+    options = {"window": None, "cdc_params": None, "hash_spec": None, "block_request": None, "codecs": [],
+               "size": None}
+    for part in parts[2:]:
+        if part.startswith("WINDOW="):
+            try:
+                options["window"] = max(0, int(part.split("=")[1]))
+            except ValueError:
+                pass
+        elif part == "CDC" or part.startswith("CDC="):
+            options["cdc_params"] = utils.negotiate_cdc_params(utils.parse_cdc_params(part[4:]) if "=" in part else None)
+        elif part.startswith("HASH=") and "BINARY" in parts[2:]:
+            options["hash_spec"] = utils.negotiate_hash_spec(utils.parse_hash_spec(part[5:]))
+        elif part.startswith("BLOCK=") and "BINARY" in parts[2:]:
+            value = part.split("=")[1]
+            options["block_request"] = int(value) if value.isdigit() else 0
+        elif part.startswith("COMPRESS=") and "ROLLING" not in parts[2:]:
+            options["codecs"] = compression.negotiate_codecs(part[9:])
+        elif part.startswith("SIZE=") and part[5:].isdigit():
+            options["size"] = int(part[5:])
+    return options
+
+def merkle_max_blocks(options, block_size):
+    """
+    Most blocks a MERKLE client may announce: its SIZE= in blocks, capped at
+    MERKLE_MAX_BLOCKS (no SIZE = an empty file only).
+    """
+    size = options["size"] or 0
+    return min(-(-size // block_size), utils.MERKLE_MAX_BLOCKS)
+
+def full_upload_required(parts, options, file_path):
+    """
+    A delta needs a stored version of the file; with the block store, CDC
+    and BINARY syncs can build a new file from data other files hold.
+    """
+    if os.path.exists(file_path):
+        return False
+    if not blockstore.ENABLED:
+        return True
+    return options["cdc_params"] is None and ("BINARY" not in parts[2:] or bool({"MERKLE", "ROLLING"} & set(parts[2:])))
+
+def compress_option(codecs):
+    return f" COMPRESS={compression.format_codecs(codecs)}" if codecs else ""
+
+def cdc_ack(options):
+    """ACK of a CDC sync: the chunk sizes we agreed to."""
+    return f"ACK CDC={utils.format_cdc_params(options['cdc_params'])}{compress_option(options['codecs'])}".encode()
+
+def block_mode_ack(parts, options, filename, file_path):
+    """
+    Negotiates a block-mode sync. Returns (ack, algo, digest_len, block_size,
+    token): the ACK echoes the block hash and size we agreed to, plus the
+    session token if the client asked for a resumable binary-manifest sync.
+    """
+    ack_options = []
+    if options["hash_spec"] is not None:
+        ack_options.append(f"HASH={utils.format_hash_spec(options['hash_spec'])}")
+    algo, digest_len = options["hash_spec"] or utils.DEFAULT_HASH
+
+    block_size = utils.BLOCK_SIZE
+    block_request = options["block_request"]
+    if block_request is not None:
+        if utils.valid_block_size(block_request):
+            block_size = block_request
+        elif os.path.exists(file_path):  # scaled to the file and tuned by its previous syncs
+            block_size = manifest_cache.preferred_block_size(file_path, digest_len)
+        ack_options.append(f"BLOCK={block_size}")
+
+    # Block mode with a binary manifest can resume after a dropped connection
+    token = None
+    if "BINARY" in parts[2:] and not {"MERKLE", "ROLLING"} & set(parts[2:]):
+        token = resume.session_token(parts, resume.DELTA, filename)
+    if token:
+        ack_options.append(f"TOKEN={token}")
+    return (" ".join(["ACK"] + ack_options) + compress_option(options["codecs"])).encode(), algo, digest_len, block_size, token
+
+def server_manifest(file_path, algo, block_size):
+    """(total_blocks, block_hashes, file_hash) of our copy; a file new to the server (block store mode) has none."""
+    if not os.path.exists(file_path):
+        return 0, [], None
+    return manifest_cache.get_manifest(file_path, algo, block_size)
+
+def find_blocks(filename, missing_blocks, expected, algo, block_size, total_blocks):
+    """
+    Blocks this file lacks may still be held by other stored files.
+    Returns (blocks still to receive, (copies, found)) as in blockstore.resolve_blocks.
+    """
+    missing_blocks, copies, found = blockstore.resolve_blocks(missing_blocks, expected, algo, block_size, total_blocks)
+    if found:
+        print(f"[Delta Sync] {len(found)} blocks found in {len(copies)} stored file(s)")
+        monitor.log_event(f"{filename}: {len(found)} blocks taken from stored files")
+    return missing_blocks, (copies, found)
+
+def json_missing_blocks(client_state, server_hashes, expected):
+    """(total_blocks, missing_blocks, file_hash) of a JSON hash list; fills `expected`."""
+    client_total_blocks = client_state["total_blocks"]
+    client_hashes = client_state["hashes"]
+    missing_blocks = []
+    for i in range(client_total_blocks):
+        if i >= len(server_hashes) or server_hashes[i] != client_hashes[i]:
+            missing_blocks.append(i)
+            expected[i] = client_hashes[i]
+    return client_total_blocks, missing_blocks, client_state["file_hash"]
+
+def resume_blocks(token, filename, file_path, missing_blocks, client_final_hash, algo, block_size):
+    """
+    Session of a resumable binary-manifest sync. Returns (session, resumed,
+    resumed_blocks, missing_blocks): blocks a resumed session already
+    applied are taken out of the missing ones.
+    """
+    session, resumed = resume.delta_session(token, filename, file_path, client_final_hash, algo, block_size)
+    if not resumed:
+        return session, False, [], missing_blocks
+    resumed_blocks = [i for i in missing_blocks if i in session["applied"]]
+    missing_blocks = [i for i in missing_blocks if i not in session["applied"]]
+    print(f"[Resume] {filename}: {len(resumed_blocks)} blocks already received")
+    monitor.log_event(f"Delta Resumed: {filename} ({len(resumed_blocks)} blocks kept)")
+    return session, True, resumed_blocks, missing_blocks
+
+class BlockApply:
+    """
+    Builds the client's version of a stored file after a block-mode
+    comparison (JSON, BINARY or MERKLE manifest): unchanged blocks are
+    cloned/copied in-kernel from the stored version, every received block is
+    checked against the client's digest as it is written, and finish() puts
+    the result in place only if the full-file hash follows from the new block
+    hashes. A resumed session continues its own temp file, which already
+    holds the unchanged ranges and the blocks received before the drop.
+    `foreign` = (copies, found) are blocks the block store located in other
+    stored files (see find_blocks); a file new to the server is built from
+    those and received blocks only.
+    """
+    def __init__(self, filename, file_path, server_hashes, algo, block_size, client_total_blocks,
+                 missing_blocks, expected, session=None, resumed=False, resumed_blocks=(), foreign=({}, {})):
+        self.filename = filename
+        self.file_path = file_path
+        self.algo = algo
+        self.block_size = block_size
+        self.client_total_blocks = client_total_blocks
+        self.missing_blocks = missing_blocks
+        self.expected = expected
+        self.session = session
+        self.resumed_blocks = list(resumed_blocks)
+
+        copies, found = foreign
+        self.found = found
+        self.changed_blocks = sorted(list(missing_blocks) + self.resumed_blocks + list(found))
+
+        self.temp_path = session["temp_path"] if session else file_path + ".tmp"
+        exists = os.path.exists(file_path)
+        server_size = os.path.getsize(file_path) if exists else 0
+        keep_ranges = reconstruct.unchanged_ranges(self.changed_blocks, client_total_blocks, server_size, block_size)
+        self.delta_file = reconstruct.DeltaFile(file_path if exists else None, self.temp_path, keep_ranges, reuse=resumed)
+        for src_path, ranges in copies.items():
+            self.delta_file.copy_from(src_path, ranges)
+        self.delta_file.map(client_total_blocks * block_size)
+
+        # New manifest = ours for matching blocks, patched with received ones
+        self.new_hashes = server_hashes[:client_total_blocks]
+        self.new_hashes += [None] * (client_total_blocks - len(self.new_hashes))
+
+        # Size of the last block: ours unless the client sends a new one
+        self.last_idx = client_total_blocks - 1
+        self.last_block_len = max(0, min(block_size, server_size - self.last_idx * block_size))
+        for blk_idx in self.resumed_blocks:
+            self.new_hashes[blk_idx] = session["applied"][blk_idx]
+            if blk_idx == self.last_idx:
+                self.last_block_len = session["last_block_len"]
+        for blk_idx, (blk_hash, blk_len) in found.items():
+            self.new_hashes[blk_idx] = blk_hash
+            if blk_idx == self.last_idx:
+                self.last_block_len = blk_len
+
+        self.pending = set(missing_blocks)
+        self.verified = True
+        self.received_bytes = 0
+        self.total_missing_bytes = len(missing_blocks) * block_size  # approx
+
+    def region(self, blk_idx, blk_len):
+        """Mapped output slice to receive a block we are waiting for straight into, or None."""
+        if blk_idx in self.pending and blk_len <= self.block_size:
+            return self.delta_file.region(blk_idx * self.block_size, blk_len)
+        return None
+
+    def accept(self, blk_idx, blk_data, in_place=False):
+        """
+        Verifies a received block against the client's digest and writes it,
+        unless it was received `in_place` into region(). Any block that does
+        not match fails the whole file. Returns whether it matched.
+        """
+        blk_len = len(blk_data)
+        self.received_bytes += blk_len
+        monitor.update_transfer(self.filename, self.received_bytes, self.total_missing_bytes, mode="Delta Sync")
+
+        if blk_idx not in self.pending or blk_len > self.block_size:
+            self.verified = False
+            return False
+        blk_hash = utils.hash_block(blk_data, self.algo)
+        if blk_hash[:len(self.expected[blk_idx])] != self.expected[blk_idx]:
+            self.verified = False
+            return False
+
+        self.pending.discard(blk_idx)
+        if not in_place:
+            self.delta_file.write_at(blk_idx * self.block_size, blk_data)
+        self.new_hashes[blk_idx] = blk_hash
+        if blk_idx == self.last_idx:
+            self.last_block_len = blk_len
+        if self.session:
+            resume.block_applied(self.session, self.delta_file, blk_idx, blk_hash, blk_len, self.last_idx)
+        return True
+
+    def interrupt(self):
+        """Stream lost mid-transfer: a resumable session keeps what arrived, anything else is discarded."""
+        if not self.session:
+            self.delta_file.abort()
+            return
+        resume.checkpoint_delta(self.session, self.delta_file)
+        self.delta_file.close()
+        print(f"[Resume] {self.filename}: interrupted after {len(self.session['applied'])} blocks")
+        monitor.log_event(f"Delta Interrupted: {self.filename} (resumable)")
+
+    def _found_intact(self):
+        # Blocks copied from other stored files: the index's digests are only
+        # trusted once the bytes that actually landed in the output match them
+        # (a source may have been rewritten between the lookup and the copy)
+        for blk_idx, (blk_hash, blk_len) in self.found.items():
+            data = self.delta_file.read_at(blk_idx * self.block_size, blk_len)
+            if len(data) != blk_len or utils.hash_block(data, self.algo) != blk_hash:
+                return False
+        return True
+
+    def finish(self, client_final_hash):
+        """
+        Integrity check: unchanged blocks matched our cached manifest, every
+        received block matched the client's digest, blocks copied from other
+        stored files are re-hashed where they landed, and the full-file hash
+        follows from the resulting block hashes. Replaces the stored file if
+        it passes. Returns whether it did.
+        """
+        ok = (self.verified and not self.pending
+              and utils.tree_file_hash(self.new_hashes, self.algo) == client_final_hash
+              and self._found_intact())
+        if ok:
+            self.delta_file.finish(max(0, self.last_idx * self.block_size + self.last_block_len))
+            shutil.move(self.temp_path, self.file_path)
+            edit_runs = len(utils.block_runs(self.changed_blocks))
+            manifest_cache.store_manifest(self.file_path, self.new_hashes, client_final_hash, self.algo,
+                                          self.block_size, edit_runs=edit_runs)
+        else:
+            self.delta_file.abort()
+        if self.session:
+            resume.discard(self.session["token"])
+
+        if ok:
+            print("[Delta Sync] Integrity verification successful.")
+            saved_percent = 100 * (1 - len(self.missing_blocks) / (self.client_total_blocks or 1))
+            print(f"[Delta Sync] Bandwidth saved: {saved_percent:.1f}%")
+            monitor.finish_transfer(self.filename, self.received_bytes, self.client_total_blocks * self.block_size)
+        else:
+            monitor.log_event(f"Integrity FAIL: {self.filename}")
+            print("[Delta Sync] Integrity check failed!")
+        return ok
+
+# ---------------------------------------------------------------------------
+# UPLOAD_DELTA ... CDC
+# ---------------------------------------------------------------------------
+
+def server_chunks(file_path, params):
+    """(chunks, file_hash, exists) of our copy; a file new to the server (block store mode) has none."""
+    if not os.path.exists(file_path):
+        return [], None, False
+    chunks, file_hash = manifest_cache.get_chunk_manifest(file_path, params)
+    return chunks, file_hash, True
+
+def find_chunks(filename, plan, missing_chunks, params):
+    """
+    Chunks this file lacks may still be held by other stored files.
+    Returns (chunks still to receive, {src_path: copy ranges}).
+    """
+    missing_chunks, foreign = blockstore.resolve(plan, missing_chunks, params)
+    if foreign:
+        foreign_bytes = sum(r[2] for ranges in foreign.values() for r in ranges)
+        print(f"[Delta Sync] {foreign_bytes} bytes found in {len(foreign)} other stored file(s)")
+    print(f"[Delta Sync] Need to receive {len(missing_chunks)} of {len(plan)} chunks")
+    monitor.log_event(f"{filename}: {len(missing_chunks)} chunks missing")
+    monitor.count_blocks(compared=len(plan), sent=len(missing_chunks))
+    return missing_chunks, foreign
+
+class ChunkApply:
+    """
+    Builds the client's version from a content-defined chunk plan: reused
+    chunks are copied from wherever they sit in our copy (or in other stored
+    files), received ones are checked against their hash as they arrive.
+    """
+    def __init__(self, filename, file_path, exists, plan, missing_chunks, foreign):
+        self.filename = filename
+        self.file_path = file_path
+        self.plan = plan
+        self.new_size = plan[-1][0] + plan[-1][1] if plan else 0
+        self.temp_path = file_path + ".tmp"
+        self.moved = reconstruct.moved_ranges(plan)
+        self.delta_file = reconstruct.DeltaFile(file_path if exists else None, self.temp_path,
+                                                moved_ranges=self.moved)
+        self.source = self._source_hashes() if exists else None
+        for src_path, ranges in foreign.items():
+            self.delta_file.copy_from(src_path, ranges)
+        self.delta_file.map(self.new_size)
+
+        self.pending = set(missing_chunks)
+        self.verified = True
+        self.received_bytes = 0
+        self.total_missing_bytes = sum(plan[i][1] for i in missing_chunks)
+
+    def accept(self, chunk_idx, chunk_data):
+        """Verifies and writes a received chunk. Returns whether it matched."""
+        chunk_len = len(chunk_data)
+        self.received_bytes += chunk_len
+        monitor.update_transfer(self.filename, self.received_bytes, self.total_missing_bytes, mode="Delta Sync (CDC)")
+
+        entry = self.plan[chunk_idx] if chunk_idx < len(self.plan) else None
+        if (chunk_idx not in self.pending or chunk_len != entry[1]
+                or hashlib.sha256(chunk_data).hexdigest() != entry[3]):
+            self.verified = False
+            return False
+        self.pending.discard(chunk_idx)
+        self.delta_file.write_at(entry[0], chunk_data)
+        return True
+
+    def abort(self):
+        self.delta_file.abort()
+
+    def _source_hashes(self):
+        # (block hashes, size) of our copy, if its cached manifest describes
+        # the very file the reused ranges were just copied from
+        try:
+            entry = manifest_cache.cached_entry(self.file_path)
+            st = os.fstat(self.delta_file.src_fd)
+        except OSError:
+            return None
+        if (entry is None or entry.get("hash_algo") != "sha256" or entry.get("block_size") != utils.BLOCK_SIZE
+                or entry["key"][1:] != [st.st_size, st.st_mtime_ns, st.st_ino]):
+            return None
+        return entry["hashes"], st.st_size
+
+    def _block_hashes(self):
+        # SHA-256 BLOCK_SIZE hashes of the rebuilt file. A block inside a range
+        # reused from our copy at the same alignment keeps the hash our
+        # manifest has; received chunks, data from other files and data moved
+        # by other than a multiple of BLOCK_SIZE are hashed here.
+        started = time.perf_counter()
+        block_size = utils.BLOCK_SIZE
+        hashes = []
+        ranges = iter(self.moved if self.source else ())
+        current = next(ranges, None)
+        for offset in range(0, self.new_size, block_size):
+            length = min(block_size, self.new_size - offset)
+            while current is not None and current[1] + current[2] <= offset:
+                current = next(ranges, None)
+            digest = None
+            if (current is not None and current[1] <= offset and offset + length <= current[1] + current[2]
+                    and (current[0] - current[1]) % block_size == 0):
+                source_hashes, source_size = self.source
+                source_block = (offset + current[0] - current[1]) // block_size
+                if min(block_size, source_size - source_block * block_size) == length:
+                    digest = source_hashes[source_block]
+            if digest is None:
+                digest = utils.hash_block(self.delta_file.read_at(offset, length))
+            hashes.append(digest)
+        monitor.add_hash_time(time.perf_counter() - started)
+        return hashes
+
+    def finish(self, params, client_final_hash):
+        """
+        Chunks were verified one by one; the full-file hash is checked over
+        block hashes taken from our manifest where reused data kept its
+        alignment and hashed from the rebuilt file elsewhere, which also
+        refreshes its block manifest. Replaces the stored file if it matches.
+        Returns whether it did.
+        """
+        ok = self.verified and not self.pending
+        if ok:
+            new_hashes = self._block_hashes()
+            self.delta_file.finish(self.new_size)
+            ok = utils.tree_file_hash(new_hashes) == client_final_hash
+        else:
+            self.delta_file.abort()
+
+        if ok:
+            shutil.move(self.temp_path, self.file_path)
+            manifest_cache.store_chunk_manifest(self.file_path, params, [[e[1], e[3]] for e in self.plan],
+                                                client_final_hash, new_hashes)
+            saved_percent = 100 * (1 - self.received_bytes / (self.new_size or 1))
+            print(f"[Delta Sync] Reused {self.new_size - self.received_bytes} bytes, "
+                  f"received {self.received_bytes} bytes ({saved_percent:.1f}% saved)")
+            monitor.finish_transfer(self.filename, self.received_bytes, self.new_size)
+        else:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+            monitor.log_event(f"Integrity FAIL: {self.filename}")
+            print("[Delta Sync] Integrity check failed!")
+        return ok
+
+# ---------------------------------------------------------------------------
+# UPLOAD_DELTA ... ROLLING
+# ---------------------------------------------------------------------------
+
+def signature_reply(file_path):
+    """Our block signature as sent to a rolling-checksum client (10-byte length + JSON)."""
+    signature_bytes = json.dumps(utils.get_file_signature(file_path)).encode()
+    return str(len(signature_bytes)).encode().ljust(10) + signature_bytes
+
+class RollingApply:
+    """Rebuilds a file from COPY (range of our file) / LITERAL (new bytes) instructions, hashing as it goes."""
+    def __init__(self, filename, file_path):
+        self.filename = filename
+        self.file_path = file_path
+        self.temp_path = file_path + ".tmp"
+        self.src = open(file_path, "rb")
+        self.dst = open(self.temp_path, "wb")
+        self.hasher = utils.BlockHasher()
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+    def copy(self, offset, length):
+        self.src.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = self.src.read(min(65536, remaining))
+            if not data:
+                break
+            self.dst.write(data)
+            self.hasher.update(data)
+            remaining -= len(data)
+        self.copied_bytes += length
+
+    def literal(self, data):
+        self.dst.write(data)
+        self.hasher.update(data)
+        self.literal_bytes += len(data)
+        monitor.update_transfer(self.filename, self.literal_bytes, self.literal_bytes + self.copied_bytes,
+                                mode="Delta Sync (Rolling)")
+
+    def abort(self):
+        self.src.close()
+        self.dst.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def finish(self, client_final_hash):
+        """Replaces the stored file if the result hashes to `client_final_hash` (None = cut off)."""
+        self.src.close()
+        self.dst.close()
+        _, new_hashes, new_file_hash = self.hasher.finish()
+        if client_final_hash is not None and new_file_hash == client_final_hash:
+            shutil.move(self.temp_path, self.file_path)
+            manifest_cache.store_manifest(self.file_path, new_hashes, new_file_hash)
+            total = self.literal_bytes + self.copied_bytes
+            saved_percent = 100 * (1 - self.literal_bytes / (total or 1))
+            print(f"[Delta Sync] Reused {self.copied_bytes} bytes, received {self.literal_bytes} bytes ({saved_percent:.1f}% saved)")
+            monitor.finish_transfer(self.filename, self.literal_bytes, total)
+            return True
+        monitor.log_event(f"Integrity FAIL: {self.filename}")
+        print("[Delta Sync] Integrity check failed!")
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+        return False
+
+# ---------------------------------------------------------------------------
+# DOWNLOAD_DELTA
+# ---------------------------------------------------------------------------
+
+def download_ack(parts, file_path):
+    """
+    Negotiates "DOWNLOAD_DELTA filename [COMPRESS=codecs] [BLOCK=n|auto]" for
+    an existing file. Returns (ack, codecs, block_size); the block size is
+    announced if it was asked for.
+    """
+    codecs = []
+    block_request = None  # None = BLOCK_SIZE, 0 = let the server choose
+    for part in parts[2:]:
+        if part.startswith("COMPRESS="):
+            codecs = compression.negotiate_codecs(part[9:])
+        elif part.startswith("BLOCK="):
+            value = part.split("=")[1]
+            block_request = int(value) if value.isdigit() else 0
+
+    ack_options = []
+    block_size = utils.BLOCK_SIZE
+    if block_request is not None:
+        if utils.valid_block_size(block_request):
+            block_size = block_request
+        else:
+            block_size = manifest_cache.preferred_block_size(file_path)
+        ack_options.append(f"BLOCK={block_size}")
+    if codecs:
+        ack_options.append(f"COMPRESS={compression.format_codecs(codecs)}")
+    return " ".join(["ACK"] + ack_options).encode(), codecs, block_size
+
+def download_plan(filename, file_path, server_total, server_final_hash, manifest):
+    """
+    Blocks to send for the client's manifest (total_blocks, differing, _):
+    the ones it has but differ, plus everything past the end of its copy.
+    Returns (blocks, reply header: New Size (8) + File Hash (32) + Block Ranges).
+    """
+    client_total_blocks, differing, _ = manifest
+    send_blocks = [i for i in differing if i < server_total]
+    send_blocks += range(client_total_blocks, server_total)
+
+    total_size = os.path.getsize(file_path)
+    header = (total_size.to_bytes(8, 'big') + bytes.fromhex(server_final_hash)
+              + utils.encode_block_ranges(send_blocks))
+    print(f"[Delta Sync] Sending {len(send_blocks)} of {server_total} blocks")
+    monitor.log_event(f"{filename}: sending {len(send_blocks)} blocks")
+    monitor.count_blocks(compared=client_total_blocks, sent=len(send_blocks))
+    return send_blocks, header
@@ -0,0 +1,220 @@
+import os
+import stat
+import utils
+import manifest_cache
+
+# Batched directory sync (SYNC_DIR).
+# The client describes its whole tree in one listing, the server answers with
+# one action per file, and the transfers then follow back-to-back on the same
+# connection:
+#   C: SYNC_DIR dirname ENTRIES=n BYTES=m [HASH]     S: OK
+#   C: listing, per file PathLen (2) + Path + Size (8) + Mtime ns (8) [+ Hash (32)]
+#   S: one action byte per file (UNCHANGED / DELTA / FULL / SKIP)
+#   C: per FULL file:  Size (8) + Mtime ns (8) + Data (no reply)
+#      per DELTA file: Mtime ns (8) + a CDC delta exchange (see server.handle_cdc_delta,
+#                      WINDOW=DELTA_WINDOW), ending in INTEGRITY_OK / INTEGRITY_FAIL
+#   C: DONE                                          S: SYNC_DONE <updated> <failed>
+# A file whose size and mtime match the server's copy costs no I/O at all;
+# the server copy takes the client's mtime after every transfer. With HASH a
+# file that only got touched is recognised by its file hash instead.
+
+UNCHANGED, DELTA, FULL, SKIP = 0, 1, 2, 3
+DELTA_MIN_SIZE = 64 * 1024  # smaller changed files are re-sent whole, no round trip
+ENTRY_FIXED_SIZE = 2 + 8 + 8
+
+def safe_path(base, rel_path):
+    """Server path for a listing path ("a/b.txt"), or None if it would leave `base`."""
+    if not rel_path or "\\" in rel_path or "\0" in rel_path:
+        return None
+    parts = rel_path.split("/")
+    if any(part in ("", ".", "..") for part in parts):
+        return None
+    return os.path.join(base, *parts)
+
+def valid_dir_name(name):
+    return name not in (".", "..") and "/" not in name and "\\" not in name
+
+def parse_sync_request(parts):
+    """(dirname, entries, listing_bytes, with_hash) from a SYNC_DIR command, or None."""
+    if len(parts) < 2 or not valid_dir_name(parts[1]):
+        return None
+    options = dict(part.split("=", 1) for part in parts[2:] if "=" in part)
+    try:
+        return parts[1], int(options["ENTRIES"]), int(options["BYTES"]), "HASH" in parts[2:]
+    except (KeyError, ValueError):
+        return None
+
+# ---------------------------------------------------------------------------
+# Listing
+# ---------------------------------------------------------------------------
+
+def build_listing(root, with_hash=False):
+    """[(rel_path, size, mtime_ns, file_hash or None)] of the regular files under `root`."""
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            rel_path = os.path.relpath(path, root).replace(os.sep, "/")
+            file_hash = utils.get_file_block_hashes(path)[2] if with_hash else None
+            entries.append((rel_path, st.st_size, st.st_mtime_ns, file_hash))
+    return entries
+
+def encode_listing(entries):
+    out = bytearray()
+    for rel_path, size, mtime_ns, file_hash in entries:
+        name = rel_path.encode()
+        out += len(name).to_bytes(2, 'big') + name + size.to_bytes(8, 'big') + mtime_ns.to_bytes(8, 'big')
+        if file_hash is not None:
+            out += bytes.fromhex(file_hash)
+    return bytes(out)
+
+def parse_listing(data, count, with_hash):
+    """Inverse of encode_listing, or None if `data` does not hold `count` entries."""
+    entries = []
+    pos = 0
+    try:
+        for _ in range(count):
+            name_len = int.from_bytes(data[pos:pos + 2], 'big')
+            rel_path = data[pos + 2:pos + 2 + name_len].decode()
+            pos += 2 + name_len
+            size = int.from_bytes(data[pos:pos + 8], 'big')
+            mtime_ns = int.from_bytes(data[pos + 8:pos + 16], 'big')
+            pos += 16
+            file_hash = None
+            if with_hash:
+                file_hash = data[pos:pos + 32].hex()
+                pos += 32
+            entries.append((rel_path, size, mtime_ns, file_hash))
+    except UnicodeDecodeError:
+        return None
+    return entries if pos == len(data) else None
+
+# ---------------------------------------------------------------------------
+# Server side
+# ---------------------------------------------------------------------------
+
+def plan_sync(base, entries):
+    """One action per listing entry, compared against the server copy under `base`."""
+    actions = []
+    for rel_path, size, mtime_ns, file_hash in entries:
+        path = safe_path(base, rel_path)
+        if path is None:
+            actions.append(SKIP)
+            continue
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                actions.append(FULL)
+            except OSError:
+                actions.append(SKIP)  # a parent is a file on the server
+            continue
+        except OSError:
+            actions.append(SKIP)
+            continue
+
+        if not stat.S_ISREG(st.st_mode):
+            actions.append(SKIP)
+        elif st.st_size == size and st.st_mtime_ns == mtime_ns:
+            actions.append(UNCHANGED)
+        elif (file_hash is not None and st.st_size == size
+                and manifest_cache.get_manifest(path)[2] == file_hash):
+            manifest_cache.set_mtime(path, mtime_ns)  # only touched: stat matches next time
+            actions.append(UNCHANGED)
+        elif size < DELTA_MIN_SIZE:
+            actions.append(FULL)
+        else:
+            actions.append(DELTA)
+    return actions
+
+def recv_full(sock, path, buffer):
+    """
+    Receives one FULL file (Size + Mtime + Data) into place.
+    Returns False if the stream broke off.
+    """
+    header = utils.recv_exact(sock, 16)
+    if len(header) < 16:
+        return False
+    size = int.from_bytes(header[:8], 'big')
+    mtime_ns = int.from_bytes(header[8:], 'big')
+
+    temp_path = path + ".tmp"
+    hasher = utils.BlockHasher()
+    with open(temp_path, "wb") as f:
+        received = utils.recv_to_file(sock, f, size, buffer, hasher.update)
+    if received < size:
+        os.remove(temp_path)
+        return False
+
+    os.replace(temp_path, path)
+    _, block_hashes, file_hash = hasher.finish()
+    manifest_cache.store_manifest(path, block_hashes, file_hash)
+    manifest_cache.set_mtime(path, mtime_ns)
+    return True
+
+# ---------------------------------------------------------------------------
+# Client side
+# ---------------------------------------------------------------------------
+
+def _send_delta(sock, path, mtime_ns):
+    sock.sendall(mtime_ns.to_bytes(8, 'big'))
+    chunks, _ = utils.send_chunk_manifest(sock, path, utils.CDC_DEFAULT_PARAMS)
+    missing_chunks = utils.recv_block_ranges(sock)
+    if missing_chunks is None:
+        return None
+    if missing_chunks and not utils.send_delta_blocks(sock, path, missing_chunks, utils.DELTA_WINDOW, chunks=chunks):
+        return None
+    return sock.recv(1024).decode() == "INTEGRITY_OK"
+
+def sync_dir(sock, root, with_hash=False):
+    """
+    Client side of SYNC_DIR for the local directory `root`.
+    Returns a dict of counts (unchanged, delta, full, skipped, failed), or
+    an error string.
+    """
+    entries = build_listing(root, with_hash)
+    listing = encode_listing(entries)
+    name = os.path.basename(os.path.normpath(os.path.abspath(root)))
+    options = " HASH" if with_hash else ""
+    sock.send(f"SYNC_DIR {name} ENTRIES={len(entries)} BYTES={len(listing)}{options}".encode())
+    response = sock.recv(1024).decode()
+    if response != "OK":
+        return response
+    sock.sendall(listing)
+
+    actions = utils.recv_exact(sock, len(entries))
+    if len(actions) < len(entries):
+        return "connection lost"
+
+    counts = {"unchanged": 0, "delta": 0, "full": 0, "skipped": 0, "failed": 0}
+    for (rel_path, size, mtime_ns, _), action in zip(entries, actions):
+        path = os.path.join(root, *rel_path.split("/"))
+        if action == UNCHANGED:
+            counts["unchanged"] += 1
+        elif action == SKIP:
+            counts["skipped"] += 1
+        elif action == FULL:
+            # Size as listed: a file that changed meanwhile is picked up next time
+            with open(path, "rb") as f:
+                sock.sendall(size.to_bytes(8, 'big') + mtime_ns.to_bytes(8, 'big'))
+                if utils.send_file_range(sock, f, 0, size) < size:
+                    return f"{rel_path} shrank while sending"
+            counts["full"] += 1
+        else:
+            ok = _send_delta(sock, path, mtime_ns)
+            if ok is None:
+                return f"delta exchange for {rel_path} failed"
+            counts["delta" if ok else "failed"] += 1
+
+    sock.send(b"DONE")
+    if not sock.recv(1024).decode().startswith("SYNC_DONE"):
+        return "no SYNC_DONE from server"
+    return counts
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import utils
+import blockstore
+import catalog
+import monitor
+
+# Server-side store of block manifests (per-block hashes + full-file hash for
+# one hash algorithm and block size, and/or the content-defined chunk list for
+# one set of CDC parameters), plus each file's delta history, which is used to
+# pick its block size.
+# Entries live on disk under MANIFEST_DIR and the most recent ones are kept
+# in memory. An entry is only valid while the file's (path, size, mtime_ns,
+# inode) still match, so any change made outside the server is picked up.
+
+MANIFEST_DIR = "manifests"
+MAX_CACHED = 128
+FORMAT_VERSION = 3  # 2: full-file hash is utils.tree_file_hash, 3: per-algorithm block view
+HISTORY_WEIGHT = 0.5  # weight of the latest sync in the edit-run average
+
+_lock = threading.Lock()
+_lru = OrderedDict()  # {abs_path: entry}
+
+def _file_key(file_path):
+    st = os.stat(file_path)
+    return [os.path.abspath(file_path), st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _disk_path(file_path):
+    name = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()
+    return os.path.join(MANIFEST_DIR, name + ".json")
+
+def _remember(path, entry):
+    _lru[path] = entry
+    _lru.move_to_end(path)
+    while len(_lru) > MAX_CACHED:
+        _lru.popitem(last=False)
+
+def _load_raw(file_path):
+    # Entry for this path whether or not the file changed since
+    path = os.path.abspath(file_path)
+    with _lock:
+        entry = _lru.get(path)
+        if entry is not None:
+            _lru.move_to_end(path)
+
+    if entry is None:
+        try:
+            with open(_disk_path(file_path)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with _lock:
+            _remember(path, entry)
+    return entry
+
+def _load(file_path, key):
+    entry = _load_raw(file_path)
+    if entry is None or entry.get("key") != key or entry.get("version") != FORMAT_VERSION:
+        return None
+    return entry
+
+def cached_entry(file_path):
+    """
+    The cached entry (all views) of an unchanged stored file, or None; never
+    hashes. Read from disk without displacing the in-memory LRU (the block
+    store reads every entry at startup).
+    """
+    key = _file_key(file_path)
+    with _lock:
+        entry = _lru.get(key[0])
+    if entry is None:
+        try:
+            with open(_disk_path(file_path)) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+    if entry.get("key") != key or entry.get("version") != FORMAT_VERSION:
+        return None
+    return entry
+
+def _history(file_path):
+    # Delta history outlives the content it was measured on
+    entry = _load_raw(file_path)
+    if entry is not None and entry.get("version") == FORMAT_VERSION and "edit_runs" in entry:
+        return {"edit_runs": entry["edit_runs"]}
+    return {}
+
+def _save(entry):
+    with _lock:
+        _remember(entry["key"][0], entry)
+
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    disk_path = _disk_path(entry["key"][0])
+    temp_path = disk_path + ".tmp." + str(threading.get_ident())
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, disk_path)
+    except OSError as e:
+        print(f"[Manifest] Could not persist manifest for {entry['key'][0]}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _listed_hash(entry):
+    # The whole-file hash STAT and LIST report (SHA-256 over BLOCK_SIZE blocks), if the entry has it
+    if entry.get("hash_algo") == "sha256" and entry.get("block_size") == utils.BLOCK_SIZE:
+        return entry.get("file_hash")
+    return None
+
+def _merge(file_path, key, fields):
+    # Adds a second view (blocks or chunks) of the same unchanged file
+    entry = _load(file_path, key) or dict(_history(file_path), key=key, version=FORMAT_VERSION)
+    entry = dict(entry, **fields)
+    _save(entry)
+
+def hash_file(file_path, algo="sha256", block_size=utils.BLOCK_SIZE):
+    """utils.get_file_block_hashes, with the time it takes counted in monitor."""
+    started = time.perf_counter()
+    result = utils.get_file_block_hashes(file_path, algo, block_size)
+    monitor.add_hash_time(time.perf_counter() - started)
+    return result
+
+def get_manifest(file_path, algo="sha256", block_size=utils.BLOCK_SIZE):
+    """
+    Returns (total_blocks, block_hashes, full_file_hash) for a stored file,
+    hashed with `algo` (see utils.HASH_ALGORITHMS) in `block_size` blocks.
+    Served from the cache when the file is unchanged, otherwise the file is
+    hashed once and the result stored.
+    """
+    key = _file_key(file_path)
+    entry = _load(file_path, key)
+    if (entry is not None and "hashes" in entry and entry.get("block_size") == block_size
+            and entry.get("hash_algo") == algo):
+        return len(entry["hashes"]), entry["hashes"], entry["file_hash"]
+
+    total_blocks, block_hashes, file_hash = hash_file(file_path, algo, block_size)
+    _merge(file_path, key, {"block_size": block_size, "hash_algo": algo,
+                            "hashes": block_hashes, "file_hash": file_hash})
+    return total_blocks, block_hashes, file_hash
+
+def get_chunk_manifest(file_path, params):
+    """
+    Returns (chunks, full_file_hash) for a stored file chunked with the CDC
+    parameters `params`, chunks being [[length, sha256_hex], ...].
+    """
+    key = _file_key(file_path)
+    cdc_params = utils.format_cdc_params(params)
+    entry = _load(file_path, key)
+    if entry is not None and entry.get("cdc_params") == cdc_params:
+        return entry["chunks"], entry["chunk_file_hash"]
+
+    started = time.perf_counter()
+    chunks, file_hash = utils.get_file_chunk_manifest(file_path, params)
+    monitor.add_hash_time(time.perf_counter() - started)
+    _merge(file_path, key, {"cdc_params": cdc_params, "chunks": chunks, "chunk_file_hash": file_hash})
+    return chunks, file_hash
+
+def store_manifest(file_path, block_hashes, file_hash, algo="sha256", block_size=utils.BLOCK_SIZE,
+                   edit_runs=None):
+    """
+    Records the manifest of a file that was just written (upload or delta apply).
+    Must be called after the file is in its final place so the key matches.
+    A delta apply passes the number of separate edited regions it saw.
+    """
+    entry = dict(_history(file_path), **{
+        "key": _file_key(file_path),
+        "version": FORMAT_VERSION,
+        "block_size": block_size,
+        "hash_algo": algo,
+        "hashes": block_hashes,
+        "file_hash": file_hash
+    })
+    if edit_runs is not None:
+        previous = entry.get("edit_runs")
+        entry["edit_runs"] = edit_runs if previous is None else (
+            HISTORY_WEIGHT * edit_runs + (1 - HISTORY_WEIGHT) * previous)
+    _save(entry)
+    blockstore.file_stored(file_path)
+    catalog.file_stored(file_path, _listed_hash(entry))
+
+def preferred_block_size(file_path, digest_len=32):
+    """
+    Block size to negotiate for a stored file: scaled with its size and
+    tuned by how many separate regions its previous syncs changed.
+    """
+    edit_runs = _history(file_path).get("edit_runs")
+    return utils.adaptive_block_size(os.path.getsize(file_path), digest_len, edit_runs)
+
+def store_chunk_manifest(file_path, params, chunks, file_hash, block_hashes=None):
+    """
+    Same as store_manifest, after a content-defined chunk delta was applied.
+    The fixed-block (SHA-256) hashes are kept too when the caller has them.
+    """
+    entry = dict(_history(file_path), **{
+        "key": _file_key(file_path),
+        "version": FORMAT_VERSION,
+        "cdc_params": utils.format_cdc_params(params),
+        "chunks": chunks,
+        "chunk_file_hash": file_hash
+    })
+    if block_hashes is not None:
+        entry.update({"block_size": utils.BLOCK_SIZE, "hash_algo": "sha256",
+                      "hashes": block_hashes, "file_hash": file_hash})
+    _save(entry)
+    blockstore.file_stored(file_path)
+    catalog.file_stored(file_path, _listed_hash(entry))
+
+def set_mtime(file_path, mtime_ns):
+    """
+    Gives a stored file the client's mtime (SYNC_DIR compares size + mtime)
+    and re-keys its manifest so the change does not invalidate it.
+    """
+    key = _file_key(file_path)
+    entry = _load(file_path, key)
+    os.utime(file_path, ns=(mtime_ns, mtime_ns))
+    if entry is not None:
+        _save(dict(entry, key=_file_key(file_path)))
+    blockstore.file_stored(file_path)
+    catalog.file_stored(file_path, entry and _listed_hash(entry))
+
+def invalidate(file_path):
+    """Drops the manifest of a deleted file."""
+    with _lock:
+        _lru.pop(os.path.abspath(file_path), None)
+    try:
+        os.remove(_disk_path(file_path))
+    except OSError:
+        pass
@@ -1,11 +1,12 @@
+import math
 import threading
 import time
-from collections import deque
+from collections import OrderedDict, deque
 
 # Shared State
 state_lock = threading.Lock()
 
-connected_clients = {}  # {addr_str: {"status": "Connected", "connected_at": timestamp}}
+connected_clients = {}  # {"ip:port": {"status": "Connected", "connected_at": timestamp}}
 active_transfers = {}   # {filename: {"progress": 0, "speed": "0 KB/s", "mode": "Normal", "size": 0, "sent": 0}}
 global_stats = {
     "total_data_sent": 0,
@@ -14,67 +15,289 @@ global_stats = {
 }
 logs = deque(maxlen=50) # Keep last 50 logs
 
+# Change journal for the dashboard's event stream: every client, transfer,
+# the stats and the log, keyed (kind, key), with the sequence number of its
+# latest change. Readers fetch the current value of what changed since their
+# position, so any number of updates to one transfer between two reads cost
+# a reader one entry.
+MAX_CHANGES = 1024
+change_seq = 0
+changes = OrderedDict()  # {(kind, key): seq}, oldest change first
+changes_floor = 0        # seq of the newest change dropped from the journal
+log_count = 0            # lines logged so far (a reader's position in the log)
+changed = threading.Condition(state_lock)
+
+# Metrics for capacity planning, served in Prometheus text format on the
+# dashboard's /metrics (see render_metrics)
+TIMED_COMMANDS = ("LIST", "UPLOAD", "UPLOAD_DELTA", "DOWNLOAD", "DOWNLOAD_DELTA", "DELETE")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)  # seconds
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(0, 22, 2))  # 1 KB/s .. 2 GB/s
+EWMA_TAU = 2.0  # seconds: time constant of the per-transfer throughput average
+
+counters = {
+    "bytes_received": 0,
+    "bytes_sent": 0,
+    "blocks_compared": 0,
+    "blocks_sent": 0,
+    "hash_seconds": 0.0,
+}
+active_connections = 0
+command_latency = {}  # {command: [bucket counts..., sum, count]}
+transfer_throughput = [0] * len(THROUGHPUT_BUCKETS) + [0.0, 0]
+
+def _note_change(kind, key=None):
+    # Caller holds state_lock
+    global change_seq, changes_floor
+    change_seq += 1
+    changes[(kind, key)] = change_seq
+    changes.move_to_end((kind, key))
+    if len(changes) > MAX_CHANGES:
+        _, changes_floor = changes.popitem(last=False)
+    changed.notify_all()
+
 def log_event(msg):
+    global log_count
     with state_lock:
         timestamp = time.strftime("%H:%M:%S")
         logs.append(f"[{timestamp}] {msg}")
+        log_count += 1
+        _note_change("log")
         print(f"[LOG] {msg}")
 
+def _client_key(addr):
+    # One entry per connection: several clients can share a host
+    return f"{addr[0]}:{addr[1]}" if isinstance(addr, tuple) else str(addr)
+
 def add_client(addr):
+    """`addr` is the connection's (host, port) as returned by accept()."""
+    global active_connections
+    key = _client_key(addr)
     with state_lock:
-        connected_clients[str(addr)] = {"status": "Connected", "connected_at": time.time()}
-    log_event(f"Client connected: {addr}")
+        connected_clients[key] = {"status": "Connected", "connected_at": time.time()}
+        active_connections += 1
+        _note_change("client", key)
+    log_event(f"Client connected: {key}")
 
 def remove_client(addr):
+    global active_connections
+    key = _client_key(addr)
+    with state_lock:
+        if key in connected_clients:
+            del connected_clients[key]
+            _note_change("client", key)
+        active_connections -= 1
+    log_event(f"Client disconnected: {key}")
+
+def _observe(histogram, buckets, value):
+    # Per-bucket counts; render_metrics makes them cumulative
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            histogram[i] += 1
+            break
+    histogram[-2] += value
+    histogram[-1] += 1
+
+def observe_command(cmd, seconds):
+    """Records how long one command took (commands outside TIMED_COMMANDS are ignored)."""
+    if cmd not in TIMED_COMMANDS:
+        return
+    with state_lock:
+        histogram = command_latency.get(cmd)
+        if histogram is None:
+            histogram = command_latency[cmd] = [0] * len(LATENCY_BUCKETS) + [0.0, 0]
+        _observe(histogram, LATENCY_BUCKETS, seconds)
+
+def count_bytes(received=0, sent=0):
+    """Payload bytes received from / sent to clients."""
+    with state_lock:
+        counters["bytes_received"] += received
+        counters["bytes_sent"] += sent
+
+def count_blocks(compared=0, sent=0):
+    """Blocks (or chunks) compared against a manifest and the ones that had to travel."""
+    with state_lock:
+        counters["blocks_compared"] += compared
+        counters["blocks_sent"] += sent
+
+def add_hash_time(seconds):
     with state_lock:
-        if str(addr) in connected_clients:
-            del connected_clients[str(addr)]
-    log_event(f"Client disconnected: {addr}")
+        counters["hash_seconds"] += seconds
+
+def format_rate(rate):
+    if rate >= 1024 * 1024:
+        return f"{rate/1024/1024:.2f} MB/s"
+    return f"{rate/1024:.1f} KB/s"
 
 def update_transfer(filename, sent_bytes, total_bytes, mode="Normal"):
     with state_lock:
-        # Calculate speed (simple moving average could be better, but instantaneous for now)
-        # For simplicity, we just update state. Speed calc requires tracking time.
-        # We'll let the frontend calc speed or do a simple diff if we stored prev state.
-        # Let's just store current progress.
-        
+        now = time.time()
         progress = (sent_bytes / total_bytes * 100) if total_bytes > 0 else 0
-        
+
+        # Throughput as an exponentially weighted moving average. Updates come
+        # at irregular intervals, so each sample is weighted by the time it covers.
+        previous = active_transfers.get(filename)
+        if previous is None or sent_bytes < previous["sent"]:
+            started_at, rate, speed = now, None, "Calculating..."
+        else:
+            started_at, rate, speed = previous["started_at"], previous["rate"], previous["speed"]
+            elapsed = now - previous["last_update"]
+            if elapsed > 0:
+                sample = (sent_bytes - previous["sent"]) / elapsed
+                if rate is None:
+                    rate = sample
+                else:
+                    rate += (1 - math.exp(-elapsed / EWMA_TAU)) * (sample - rate)
+                speed = format_rate(rate)
+
         active_transfers[filename] = {
             "progress": progress,
-            "speed": "Calculating...", # We need a way to calc speed.
+            "speed": speed,
+            "rate": rate,
             "mode": mode,
             "sent": sent_bytes,
             "size": total_bytes,
-            "last_update": time.time()
+            "started_at": started_at,
+            "last_update": now
         }
+        _note_change("transfer", filename)
 
-def finish_transfer(filename, sent_bytes, original_size):
+def finish_transfer(filename, sent_bytes, original_size, outbound=False):
+    """
+    Ends a transfer of `original_size` bytes of which `sent_bytes` crossed the
+    wire, received from the client (or sent to it if `outbound`).
+    """
     with state_lock:
-        if filename in active_transfers:
-            del active_transfers[filename]
-        
+        transfer = active_transfers.pop(filename, None)
+        if transfer is not None:
+            elapsed = time.time() - transfer["started_at"]
+            if elapsed > 0:
+                _observe(transfer_throughput, THROUGHPUT_BUCKETS, sent_bytes / elapsed)
+            _note_change("transfer", filename)
+
+        counters["bytes_sent" if outbound else "bytes_received"] += sent_bytes
         global_stats["total_data_sent"] += sent_bytes
         global_stats["total_original_size"] += original_size
         global_stats["bandwidth_saved_bytes"] += (original_size - sent_bytes)
+        _note_change("stats")
 
     saved = original_size - sent_bytes
     log_event(f"Transfer complete: {filename}. Mode: Delta Sync. Saved: {saved/1024:.2f} KB")
 
+def _stats():
+    # Caller holds state_lock
+    total_orig = global_stats["total_original_size"]
+    saved_bytes = global_stats["bandwidth_saved_bytes"]
+    saved_pct = (saved_bytes / total_orig * 100) if total_orig > 0 else 0.0
+    return {
+        "total_sent_str": f"{global_stats['total_data_sent']/1024/1024:.2f} MB",
+        "original_size_str": f"{global_stats['total_original_size']/1024/1024:.2f} MB",
+        "bandwidth_saved_percent": round(saved_pct, 2)
+    }
+
+def _snapshot():
+    # Caller holds state_lock
+    return {
+        "clients": [{"ip": k, **v} for k, v in connected_clients.items()],
+        "transfers": [{"filename": k, **v} for k, v in active_transfers.items()],
+        "stats": _stats(),
+        "logs": list(logs)
+    }
+
 def get_snapshot():
     with state_lock:
-        # Calc bandwidth saved %
-        total_orig = global_stats["total_original_size"]
-        saved_bytes = global_stats["bandwidth_saved_bytes"]
-        saved_pct = (saved_bytes / total_orig * 100) if total_orig > 0 else 0.0
-        
-        return {
-            "clients": [{"ip": k, **v} for k, v in connected_clients.items()],
-            "transfers": [{"filename": k, **v} for k, v in active_transfers.items()],
-            "stats": {
-                "total_sent_str": f"{global_stats['total_data_sent']/1024/1024:.2f} MB",
-                "original_size_str": f"{global_stats['total_original_size']/1024/1024:.2f} MB",
-                "bandwidth_saved_percent": round(saved_pct, 2)
-            },
-            "logs": list(logs)
-        }
+        return _snapshot()
+
+def snapshot_position():
+    """(snapshot, cursor): the full state and the journal position it reflects."""
+    with state_lock:
+        return _snapshot(), (change_seq, log_count)
+
+def wait_for_changes(cursor, timeout):
+    """
+    Waits up to `timeout` seconds for changes after `cursor` (from
+    snapshot_position or a previous call). Returns (cursor, delta), delta
+    holding only what changed: "clients" / "transfers" map a key to its
+    current entry (None once gone), "stats" is the new stats and "logs" the
+    new lines. delta is {} on timeout; cursor is None if the reader fell
+    behind the journal and needs a new snapshot.
+    """
+    seq, seen_logs = cursor
+    with changed:
+        changed.wait_for(lambda: change_seq > seq, timeout)
+        if seq < changes_floor:
+            return None, None
+        delta = {}
+        for (kind, key), at in reversed(changes.items()):
+            if at <= seq:
+                break
+            if kind == "client":
+                entry = connected_clients.get(key)
+                delta.setdefault("clients", {})[key] = entry and {"ip": key, **entry}
+            elif kind == "transfer":
+                entry = active_transfers.get(key)
+                delta.setdefault("transfers", {})[key] = entry and {"filename": key, **entry}
+            elif kind == "stats":
+                delta["stats"] = _stats()
+            elif kind == "log":
+                new = min(log_count - seen_logs, len(logs))
+                delta["logs"] = list(logs)[len(logs) - new:]
+        return (change_seq, log_count), delta
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _histogram_lines(name, labels, histogram, buckets):
+    prefix = f"{labels}," if labels else ""
+    cumulative = 0
+    for bound, count in zip(buckets, histogram):
+        cumulative += count
+        yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+    yield f'{name}_bucket{{{prefix}le="+Inf"}} {histogram[-1]}'
+    suffix = f"{{{labels}}}" if labels else ""
+    yield f"{name}_sum{suffix} {histogram[-2]}"
+    yield f"{name}_count{suffix} {histogram[-1]}"
+
+def render_metrics():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    # Copy under the lock, format outside it: scrapes never hold up transfers
+    with state_lock:
+        values = dict(counters)
+        connections = active_connections
+        saved = global_stats["bandwidth_saved_bytes"]
+        latency = {cmd: list(h) for cmd, h in command_latency.items()}
+        throughput = list(transfer_throughput)
+        rates = [(name, t["mode"], t["rate"]) for name, t in active_transfers.items() if t["rate"] is not None]
+
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(samples)
+
+    metric("deltasync_command_duration_seconds", "histogram", "Time to serve one command.",
+           [line for cmd in sorted(latency)
+            for line in _histogram_lines("deltasync_command_duration_seconds", f'command="{cmd}"',
+                                         latency[cmd], LATENCY_BUCKETS)])
+    metric("deltasync_bytes_received_total", "counter", "Payload bytes received from clients.",
+           [f"deltasync_bytes_received_total {values['bytes_received']}"])
+    metric("deltasync_bytes_sent_total", "counter", "Payload bytes sent to clients.",
+           [f"deltasync_bytes_sent_total {values['bytes_sent']}"])
+    metric("deltasync_bandwidth_saved_bytes_total", "counter", "Bytes delta sync did not have to transfer.",
+           [f"deltasync_bandwidth_saved_bytes_total {saved}"])
+    metric("deltasync_blocks_compared_total", "counter", "Blocks and chunks compared against a manifest.",
+           [f"deltasync_blocks_compared_total {values['blocks_compared']}"])
+    metric("deltasync_blocks_sent_total", "counter", "Blocks and chunks that had to be transferred.",
+           [f"deltasync_blocks_sent_total {values['blocks_sent']}"])
+    metric("deltasync_hash_seconds_total", "counter", "Time spent hashing stored files.",
+           [f"deltasync_hash_seconds_total {values['hash_seconds']:.6f}"])
+    metric("deltasync_active_connections", "gauge", "Open client connections.",
+           [f"deltasync_active_connections {connections}"])
+    metric("deltasync_transfer_rate_bytes_per_second", "gauge",
+           f"Throughput of each active transfer (EWMA, {EWMA_TAU:g} s time constant).",
+           [f'deltasync_transfer_rate_bytes_per_second{{file="{_label(name)}",mode="{_label(mode)}"}} {rate:.1f}'
+            for name, mode, rate in rates])
+    metric("deltasync_transfer_throughput_bytes_per_second", "histogram",
+           "Average throughput of completed transfers.",
+           list(_histogram_lines("deltasync_transfer_throughput_bytes_per_second", "",
+                                 throughput, THROUGHPUT_BUCKETS)))
+    return "\n".join(lines) + "\n"
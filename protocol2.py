@@ -0,0 +1,263 @@
+import os
+import socket
+import threading
+import utils
+
+# Framed protocol v2.
+# A connection switches to v2 with the v1 command "PROTO 2" (reply
+# "OK PROTO=2"); from then on every message in both directions is a frame
+#   Type (1) + Request ID (4) + Length (4) + Payload
+# so nothing depends on how TCP splits or coalesces the stream. Clients may
+# pipeline any number of requests without waiting; the server answers them
+# strictly in order, each with one RESPONSE frame:
+#   LIST                                  -> file names, one per line
+#   LIST [PREFIX=p] [CURSOR=c] [LIMIT=n] [SIZE] [MTIME] [HASH] -> one JSON page (catalog.py)
+#   STAT filename                         -> "STAT <size> <file hash>" / "NOT_FOUND"
+#   DELETE filename password              -> "OK" / "ERROR_..."
+#   DOWNLOAD filename [OFFSET=o] [LENGTH=l] -> "OK SIZE=<n>", then DATA frames and END
+#   UPLOAD filename [SIZE=n]              -> the client follows the request with DATA
+#                                            frames and END right away; "OK" once stored
+#   EXIT                                  -> the server closes the connection
+# Anything else is answered with ERROR_UNSUPPORTED (the delta commands stay v1).
+
+REQUEST, RESPONSE, DATA, END = 1, 2, 3, 4
+HEADER_SIZE = 9
+MAX_MESSAGE = 16 * 1024 * 1024      # REQUEST / RESPONSE payload limit
+DATA_FRAME = 64 * 1024 * 1024       # file bytes per DATA frame (sent with sendfile)
+COALESCE_LIMIT = 64 * 1024          # smaller downloads ride in the coalesced reply buffer
+READ_CHUNK = 256 * 1024
+
+def encode_header(frame_type, request_id, length):
+    return bytes([frame_type]) + request_id.to_bytes(4, 'big') + length.to_bytes(4, 'big')
+
+def parse_header(header):
+    """(type, request_id, length) of a frame header."""
+    return header[0], int.from_bytes(header[1:5], 'big'), int.from_bytes(header[5:9], 'big')
+
+def parse_range(parts, size):
+    """(offset, length) of a DOWNLOAD request within a file of `size` bytes."""
+    options = dict(part.split("=", 1) for part in parts[2:] if "=" in part)
+    try:
+        offset = max(0, int(options.get("OFFSET", 0)))
+        length = max(0, size - offset)
+        if "LENGTH" in options:
+            length = min(length, max(0, int(options["LENGTH"])))
+    except ValueError:
+        return None
+    return offset, length
+
+class FrameReader:
+    """Buffered frame reader: one recv usually yields several pipelined frames."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.pos = 0
+
+    def _available(self):
+        return len(self.buffer) - self.pos
+
+    def _fill(self):
+        data = self.sock.recv(READ_CHUNK)
+        if not data:
+            return False
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        self.buffer += data
+        return True
+
+    def _take(self, size):
+        while self._available() < size:
+            if not self._fill():
+                return None
+        data = bytes(self.buffer[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def has_frame(self):
+        """True if a whole frame is already buffered (reading it will not block)."""
+        if self._available() < HEADER_SIZE:
+            return False
+        _, _, length = parse_header(self.buffer[self.pos:self.pos + HEADER_SIZE])
+        return self._available() >= HEADER_SIZE + length
+
+    def read_header(self):
+        """(type, request_id, length) of the next frame, or None at end of stream."""
+        header = self._take(HEADER_SIZE)
+        return parse_header(header) if header is not None else None
+
+    def read_payload(self, length):
+        """A REQUEST / RESPONSE payload, or None if it is oversized or cut off."""
+        if length > MAX_MESSAGE:
+            return None
+        return self._take(length)
+
+    def copy_payload(self, f, length, on_data=None):
+        """Streams a DATA payload into the open file `f`. Returns bytes copied."""
+        copied = min(length, self._available())
+        if copied:
+            data = memoryview(self.buffer)[self.pos:self.pos + copied]
+            f.write(data)
+            if on_data:
+                on_data(data)
+            data.release()
+            self.pos += copied
+        if copied < length:
+            copied += utils.recv_to_file(self.sock, f, length - copied, on_data=on_data)
+        return copied
+
+class FrameWriter:
+    """Collects small frames and sends them in one write on flush()."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = []
+        self.pending_bytes = 0
+
+    def frame(self, frame_type, request_id, payload=b""):
+        self.pending.append(encode_header(frame_type, request_id, len(payload)))
+        if payload:
+            self.pending.append(payload)
+        self.pending_bytes += HEADER_SIZE + len(payload)
+        if self.pending_bytes >= COALESCE_LIMIT:
+            self.flush()
+
+    def response(self, request_id, text):
+        self.frame(RESPONSE, request_id, text.encode() if isinstance(text, str) else text)
+
+    def flush(self):
+        if self.pending:
+            utils.send_parts(self.sock, *self.pending)
+            self.pending = []
+            self.pending_bytes = 0
+
+    def send_file(self, request_id, f, offset, length):
+        """DATA frames for a file range, then END. Large ranges go out with sendfile."""
+        if length <= COALESCE_LIMIT:
+            f.seek(offset)
+            if length:
+                self.frame(DATA, request_id, f.read(length))
+            self.frame(END, request_id)
+            return
+        self.flush()
+        sent = 0
+        while sent < length:
+            size = min(DATA_FRAME, length - sent)
+            self.sock.sendall(encode_header(DATA, request_id, size))
+            if utils.send_file_range(self.sock, f, offset + sent, size) < size:
+                raise ConnectionError("file shrank while sending")
+            sent += size
+        self.frame(END, request_id)
+
+# ---------------------------------------------------------------------------
+# Client side
+# ---------------------------------------------------------------------------
+
+def connect(address):
+    """A socket switched to v2, or None if the server does not speak it."""
+    sock = socket.create_connection(address)
+    sock.send(b"PROTO 2")
+    if sock.recv(1024).decode() != "OK PROTO=2":
+        sock.close()
+        return None
+    return sock
+
+def _send_requests(sock, requests):
+    # Runs beside the reader so big uploads and big downloads never block each other
+    writer = FrameWriter(sock)
+    try:
+        for request_id, (parts, local_path) in enumerate(requests, 1):
+            writer.frame(REQUEST, request_id, " ".join(parts).encode())
+            if local_path is not None:
+                with open(local_path, "rb") as f:
+                    writer.send_file(request_id, f, 0, os.fstat(f.fileno()).st_size)
+        writer.flush()
+    except OSError:
+        # Socket or local file error: drop the connection so the reader sees it
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def _recv_download(reader, request_id, dest_path, offset=None):
+    # A whole file arrives in a temp file that replaces dest_path once complete;
+    # a range (OFFSET= / LENGTH=) is written in place at `offset`, keeping the
+    # rest of the local copy
+    if offset is None:
+        target_path = dest_path + ".part"
+        f = open(target_path, "wb")
+    else:
+        target_path = dest_path
+        f = open(dest_path, "r+b" if os.path.exists(dest_path) else "wb")
+        f.seek(offset)
+    with f:
+        while True:
+            header = reader.read_header()
+            if header is None or header[1] != request_id or header[0] not in (DATA, END):
+                break
+            if header[0] == END:
+                f.close()
+                if offset is None:
+                    os.replace(target_path, dest_path)
+                return True
+            if reader.copy_payload(f, header[2]) < header[2]:
+                break
+    if offset is None:
+        os.remove(target_path)
+    return False
+
+def pipeline(sock, commands, dest_dir="."):
+    """
+    Sends all `commands` ("LIST", "DOWNLOAD name", "UPLOAD path", ...) on a
+    v2 connection without waiting, then collects the replies in order.
+    Downloads are written to `dest_dir` (via a temp file; a ranged DOWNLOAD
+    is written in place into the local copy). Returns
+    [(command, reply text)]; an UPLOAD of a local file that cannot be read
+    is not sent and reported as that command's failure.
+    """
+    requests = []
+    for command in commands:
+        parts = command.split()
+        if not parts:
+            continue
+        if parts[0] == "UPLOAD" and len(parts) >= 2:
+            # The server gets the file's name and size; the sender reads the local path
+            local_path = parts[1]
+            try:
+                size = os.path.getsize(local_path)
+            except OSError as e:
+                requests.append((command, None, f"local file error: {e.strerror}"))
+                continue
+            parts = ["UPLOAD", os.path.basename(local_path), f"SIZE={size}"]
+            requests.append((command, parts, local_path))
+        else:
+            requests.append((command, parts, None))
+
+    sent = [(parts, local_path) for _, parts, local_path in requests if parts is not None]
+    sender = threading.Thread(target=_send_requests, args=(sock, sent), daemon=True)
+    sender.start()
+
+    reader = FrameReader(sock)
+    results = []
+    request_id = 0
+    for command, parts, detail in requests:
+        if parts is None:
+            results.append((command, detail))  # never sent
+            continue
+        request_id += 1
+        header = reader.read_header()
+        status = None
+        if header is not None and header[0] == RESPONSE and header[1] == request_id:
+            status = reader.read_payload(header[2])
+        if status is None:
+            results.append((command, "connection lost"))
+            break
+        status = status.decode()
+        if parts[0] == "DOWNLOAD" and status.startswith("OK") and len(parts) >= 2:
+            ranged = any(p.startswith(("OFFSET=", "LENGTH=")) for p in parts[2:])
+            offset = (parse_range(parts, 0) or (0, 0))[0] if ranged else None
+            if not _recv_download(reader, request_id, os.path.join(dest_dir, os.path.basename(parts[1])), offset):
+                results.append((command, "connection lost"))
+                break
+        results.append((command, status))
+    sender.join()
+    return results
@@ -0,0 +1,244 @@
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+# Delta reconstruction engine.
+# Builds the new version of a stored file next to it without a userspace copy
+# of the unchanged data: a reflink clone where the filesystem supports it
+# (btrfs, XFS, ...), otherwise copy_file_range of just the unchanged ranges,
+# otherwise plain positional reads/writes. Changed data can be written
+# through a shared mapping of the output instead of one pwrite per block.
+
+FICLONE = 0x40049409  # _IOW(0x94, 9, int) from linux/fs.h
+COPY_CHUNK = 1024 * 1024
+
+def _pread(fd, size, offset):
+    if hasattr(os, "pread"):
+        return os.pread(fd, size, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+def _pwrite(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        return os.pwrite(fd, data, offset)
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.write(fd, data)
+
+def reflink(src_fd, dst_fd):
+    """Makes dst share src's extents (copy-on-write). Returns False if unsupported."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    """
+    Copies `length` bytes between open descriptors at explicit offsets.
+    Uses os.copy_file_range (in-kernel, reflinked on some filesystems) and
+    falls back to pread/pwrite when it is missing or refuses the pair.
+    Returns the number of bytes copied (short only at end of src).
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < length:
+                n = os.copy_file_range(src_fd, dst_fd, length - copied,
+                                       src_offset + copied, dst_offset + copied)
+                if n == 0:
+                    return copied
+                copied += n
+            return copied
+        except OSError:
+            pass  # e.g. EXDEV/EINVAL: finish the rest in userspace
+
+    while copied < length:
+        data = _pread(src_fd, min(COPY_CHUNK, length - copied), src_offset + copied)
+        if not data:
+            break
+        _pwrite(dst_fd, data, dst_offset + copied)
+        copied += len(data)
+    return copied
+
+def unchanged_ranges(changed_blocks, total_blocks, src_size, block_size):
+    """
+    Byte ranges (offset, length) of blocks [0, total_blocks) that are not in
+    `changed_blocks` and exist in the source file, coalesced into runs.
+    """
+    changed = set(changed_blocks)
+    limit = min(total_blocks, (src_size + block_size - 1) // block_size)
+    ranges = []
+    for idx in range(limit):
+        if idx in changed:
+            continue
+        offset = idx * block_size
+        length = min(block_size, src_size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+    return ranges
+
+def moved_ranges(plan):
+    """
+    (src_offset, dst_offset, length) copies for the reused entries of a
+    content-defined chunk plan, coalesced where both sides are contiguous.
+    """
+    ranges = []
+    for dst_offset, length, src_offset, _ in plan:
+        if src_offset is None:
+            continue
+        if ranges:
+            last = ranges[-1]
+            if last[0] + last[2] == src_offset and last[1] + last[2] == dst_offset:
+                last[2] += length
+                continue
+        ranges.append([src_offset, dst_offset, length])
+    return ranges
+
+class DeltaFile:
+    """
+    New version of `src_path` being built at `temp_path`.
+    Unchanged data is placed up front (clone or in-kernel copy), changed
+    blocks are written in place as they arrive, and finish() trims the
+    result to its final size.
+
+    `keep_ranges` are (offset, length) runs kept at the same offset. With
+    content-defined chunks reused data can move, so `moved_ranges` of
+    (src_offset, dst_offset, length) may be given instead; no clone is
+    attempted then since the layouts differ.
+
+    `src_path` may be None for a file that is new on the server; data held
+    by other stored files is placed with copy_from().
+
+    With `reuse` the output of an interrupted build at `temp_path` is
+    continued as it is (a resumed upload): nothing is truncated or copied.
+
+    After map(size), write_at copies into the mapped output and region()
+    hands out writable slices to receive into directly.
+    """
+    def __init__(self, src_path, temp_path, keep_ranges=(), moved_ranges=None, reuse=False):
+        flags = getattr(os, "O_BINARY", 0)
+        self.temp_path = temp_path
+        self.src_fd = os.open(src_path, os.O_RDONLY | flags) if src_path is not None else None
+        if not reuse:
+            flags |= os.O_TRUNC
+        self.fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | flags, 0o644)
+
+        self.mapped = None
+        self.view = None
+
+        if self.src_fd is None or reuse:
+            self.cloned = False
+            return
+
+        if moved_ranges is not None:
+            self.cloned = False
+            for src_offset, dst_offset, length in moved_ranges:
+                copy_range(self.src_fd, self.fd, src_offset, dst_offset, length)
+            return
+
+        self.cloned = reflink(self.src_fd, self.fd)
+        if not self.cloned:
+            for offset, length in keep_ranges:
+                copy_range(self.src_fd, self.fd, offset, offset, length)
+
+    def copy_from(self, src_path, ranges):
+        """Copies (src_offset, dst_offset, length) ranges of another file into the output."""
+        src_fd = os.open(src_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for src_offset, dst_offset, length in ranges:
+                copy_range(src_fd, self.fd, src_offset, dst_offset, length)
+        finally:
+            os.close(src_fd)
+
+    def map(self, size):
+        """
+        Sizes the output to `size` bytes (an upper bound of the final size)
+        and maps it for writing. Returns False if mmap is not available.
+        """
+        if mmap is None or size <= 0:
+            return False
+        try:
+            os.ftruncate(self.fd, size)
+            self.mapped = mmap.mmap(self.fd, size)
+        except (OSError, ValueError):
+            self.mapped = None
+            return False
+        self.view = memoryview(self.mapped)
+        return True
+
+    def region(self, offset, length):
+        """Writable slice of the mapped output, or None if it is not mapped there."""
+        if self.view is None or offset + length > len(self.view):
+            return None
+        return self.view[offset:offset + length]
+
+    def read_at(self, offset, length):
+        """Bytes of the output as built so far (e.g. to check data placed by copy_from)."""
+        target = self.region(offset, length)
+        if target is None:
+            return _pread(self.fd, length, offset)
+        data = bytes(target)
+        target.release()
+        return data
+
+    def write_at(self, offset, data):
+        target = self.region(offset, len(data))
+        if target is not None:
+            target[:] = data
+            target.release()
+            return
+
+        view = memoryview(data)
+        while view:
+            n = _pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+
+    def flush(self):
+        """Makes everything written so far durable (checkpoints of resumable uploads)."""
+        if self.mapped is not None:
+            self.mapped.flush()
+        os.fsync(self.fd)
+
+    def _unmap(self):
+        if self.mapped is None:
+            return
+        self.view.release()
+        try:
+            self.mapped.close()
+        except BufferError:
+            pass  # a region() slice is still referenced; unmapped when freed
+        self.mapped = None
+        self.view = None
+
+    def finish(self, size):
+        self._unmap()
+        os.ftruncate(self.fd, size)
+        self.close()
+
+    def close(self):
+        self._unmap()
+        for fd in (self.fd, self.src_fd):
+            if fd is None:
+                continue
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def abort(self):
+        self.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
@@ -0,0 +1,232 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+# Resumable uploads.
+# A client that adds RESUMABLE to UPLOAD, or to a block-mode UPLOAD_DELTA
+# (BINARY manifest), gets a session token in the reply. The server keeps the
+# partial data next to the stored file plus a checkpoint of what arrived in
+# SESSION_DIR, so after a dropped connection the client sends the same
+# command with RESUME=<token> and only the rest travels:
+#   UPLOAD:        checkpoint = bytes written to files/<name>.<token>.part;
+#                  the size ACK becomes "OK OFFSET=<n>" and the data starts at n.
+#   UPLOAD_DELTA:  checkpoint = delta blocks already written into
+#                  files/<name>.<token>.tmp (index -> block hash); after the
+#                  manifest exchange they are left out of the missing ranges.
+# A session only resumes while it describes the same transfer (upload size;
+# client file hash, block hash and size and an unchanged stored file for a
+# delta), otherwise it starts over. Unused sessions expire after SESSION_TTL.
+
+SESSION_DIR = "sessions"
+SESSION_TTL = 24 * 3600
+CHECKPOINT_BYTES = 16 * 1024 * 1024  # full upload: fsync + checkpoint every N bytes
+CHECKPOINT_BLOCKS = 256               # delta: flush + checkpoint every N applied blocks
+CLIENT_STATE = ".upload_sessions.json"
+
+UPLOAD, DELTA = "upload", "delta"
+
+_TOKEN = re.compile(r"^[0-9a-f]{32}$")
+_active = set()  # tokens a connection is currently receiving into
+_active_lock = threading.Lock()
+
+# ---------------------------------------------------------------------------
+# Server side
+# ---------------------------------------------------------------------------
+
+def _record_path(token):
+    return os.path.join(SESSION_DIR, token + ".json")
+
+def load(token):
+    """The persisted record of a session, or None."""
+    try:
+        with open(_record_path(token)) as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if "applied" in record:
+        record["applied"] = {int(idx): digest for idx, digest in record["applied"].items()}
+    return record
+
+def save(record):
+    """Persists a checkpoint (the data it describes must already be on disk)."""
+    record["updated"] = time.time()
+    os.makedirs(SESSION_DIR, exist_ok=True)
+    path = _record_path(record["token"])
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"[Resume] Could not persist session {record['token']}: {e}")
+
+def discard(token):
+    """Drops a session and whatever partial data it still holds."""
+    record = load(token)
+    for path in (_record_path(token), record and record["temp_path"]):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def _expire():
+    if not os.path.isdir(SESSION_DIR):
+        return
+    now = time.time()
+    for name in os.listdir(SESSION_DIR):
+        token = name[:-5]
+        if not name.endswith(".json") or not _TOKEN.match(token):
+            continue
+        record = load(token)
+        if record is None or now - record.get("updated", 0) > SESSION_TTL:
+            with _active_lock:
+                if token in _active:
+                    continue
+            discard(token)
+
+def session_token(parts, kind, filename):
+    """
+    Token for a command's RESUMABLE / RESUME=<token> option, claimed for this
+    connection until release(). The requested one if it names a `kind`
+    session for `filename` that no other connection is using, otherwise a
+    new one. None if the client did not ask for a resumable upload.
+    """
+    requested = next((p[7:] for p in parts[2:] if p.startswith("RESUME=")), None)
+    if requested is None and "RESUMABLE" not in parts[2:]:
+        return None
+
+    if requested is not None and _TOKEN.match(requested):
+        record = load(requested)
+        if record is not None and record["kind"] == kind and record["filename"] == filename:
+            with _active_lock:
+                if requested not in _active:
+                    _active.add(requested)
+                    return requested
+
+    _expire()
+    token = uuid.uuid4().hex
+    with _active_lock:
+        _active.add(token)
+    return token
+
+def release(token):
+    with _active_lock:
+        _active.discard(token)
+
+def upload_session(token, filename, file_path, size):
+    """
+    Record of a resumable UPLOAD of `size` bytes: the saved one if it is for
+    the same size and its data is still there (received = resume offset),
+    otherwise a fresh one starting at 0.
+    """
+    record = load(token)
+    if (record is not None and record["kind"] == UPLOAD and record["size"] == size
+            and os.path.exists(record["temp_path"])):
+        record["received"] = min(record["received"], os.path.getsize(record["temp_path"]))
+        return record
+    if record is not None:
+        discard(token)
+    return {"token": token, "kind": UPLOAD, "filename": filename,
+            "temp_path": f"{file_path}.{token}.part", "size": size, "received": 0}
+
+def _base_key(file_path):
+    # None for a file new to the server (built from block store data only)
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def delta_session(token, filename, file_path, file_hash, algo, block_size):
+    """
+    (record, resumed) for a resumable UPLOAD_DELTA of the client version
+    `file_hash`. A saved session is resumed if it built the same version
+    with the same blocks on top of the unchanged stored file; its temp file
+    then already holds the unchanged data and every block in
+    record["applied"].
+    """
+    record = load(token)
+    base = _base_key(file_path)
+    if (record is not None and record["kind"] == DELTA and record["file_hash"] == file_hash
+            and record["algo"] == algo and record["block_size"] == block_size
+            and record["base"] == base and os.path.exists(record["temp_path"])):
+        return record, True
+    if record is not None:
+        discard(token)
+    return {"token": token, "kind": DELTA, "filename": filename,
+            "temp_path": f"{file_path}.{token}.tmp", "file_hash": file_hash,
+            "algo": algo, "block_size": block_size, "base": base,
+            "applied": {}, "last_block_len": None}, False
+
+def checkpoint_delta(record, delta_file):
+    delta_file.flush()
+    save(record)
+
+def block_applied(record, delta_file, blk_idx, blk_hash, blk_len, last_idx):
+    """Notes a verified block written to the temp file; checkpoints every CHECKPOINT_BLOCKS."""
+    record["applied"][blk_idx] = blk_hash
+    if blk_idx == last_idx:
+        record["last_block_len"] = blk_len
+    if len(record["applied"]) % CHECKPOINT_BLOCKS == 0:
+        checkpoint_delta(record, delta_file)
+
+class UploadCheckpoint:
+    """
+    on_data callback for a resumable UPLOAD into the open file `f`: counts
+    record["received"] and checkpoints every CHECKPOINT_BYTES, after an
+    fsync so the checkpoint never claims data a crash could lose.
+    """
+    def __init__(self, record, f, on_data=None):
+        self.record = record
+        self.f = f
+        self.on_data = on_data
+        self.unsaved = 0
+
+    def __call__(self, data):
+        if self.on_data:
+            self.on_data(data)
+        self.record["received"] += len(data)
+        self.unsaved += len(data)
+        if self.unsaved >= CHECKPOINT_BYTES:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            save(self.record)
+            self.unsaved = 0
+
+# ---------------------------------------------------------------------------
+# Client side: tokens of interrupted uploads, per local file
+# ---------------------------------------------------------------------------
+
+def _load_client_state():
+    try:
+        with open(CLIENT_STATE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_client_state(state):
+    with open(CLIENT_STATE, "w") as f:
+        json.dump(state, f)
+
+def _client_key(command, file_path):
+    return f"{command} {os.path.abspath(file_path)}"
+
+def request_option(command, file_path):
+    """RESUME=<token> if a `command` upload of this unchanged file was interrupted, else RESUMABLE."""
+    entry = _load_client_state().get(_client_key(command, file_path))
+    st = os.stat(file_path)
+    if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+        return f"RESUME={entry['token']}"
+    return "RESUMABLE"
+
+def remember(command, file_path, token):
+    st = os.stat(file_path)
+    state = _load_client_state()
+    state[_client_key(command, file_path)] = {"token": token, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    _save_client_state(state)
+
+def forget(command, file_path):
+    state = _load_client_state()
+    if state.pop(_client_key(command, file_path), None) is not None:
+        _save_client_state(state)
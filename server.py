@@ -1,20 +1,360 @@
 import socket
 import threading
+import asyncio
+import sys
 import os
+import time
 import zlib
 import json
-import shutil
 import utils
+import compression
 import monitor
+import manifest_cache
+import striped
+import dirsync
+import blockstore
+import catalog
+import resume
+import delta
+import storage
+import protocol2
+import async_server
 
 # Prevent Flask from loading .env file to avoid permission errors
 os.environ['FLASK_SKIP_DOTENV'] = '1'
 
 import dashboard
 
+def handle_rolling_delta(client_socket, filename, file_path):
+    """
+    Rolling-checksum delta sync (UPLOAD_DELTA filename ROLLING).
+    The server sends its block signature, the client answers with a stream of
+    COPY (range of our file) / LITERAL (new bytes) instructions, and the new file
+    is rebuilt into a temp file while its hash is computed.
+    Returns whether the file is now the client's version, or None if the
+    stream got out of sync.
+    """
+    # PROTOCOL:
+    # 1. Send ACK (already done by caller)
+    # 2. Recv OK
+    # 3. Send Signature (10-byte length + JSON)
+    # 4. Recv Instructions until END
+    # 5. Send INTEGRITY_OK / INTEGRITY_FAIL
+    if client_socket.recv(1024).decode() != "OK":
+        return None
+
+    print(f"[Delta Sync] Rolling sync requested for {filename}")
+    monitor.log_event(f"Rolling Delta Request: {filename}")
+
+    client_socket.sendall(delta.signature_reply(file_path))
+
+    rebuild = delta.RollingApply(filename, file_path)
+    client_final_hash = None
+    try:
+        while True:
+            op = utils.recv_delta_op(client_socket)
+            if op is None:
+                break
+            if op[0] == "COPY":
+                rebuild.copy(op[1], op[2])
+            elif op[0] == "LITERAL":
+                rebuild.literal(op[1])
+            else:  # END
+                client_final_hash = op[1]
+                break
+    except Exception:
+        rebuild.abort()
+        raise
+
+    ok = rebuild.finish(client_final_hash)
+    if client_final_hash is None:
+        return None  # cut off or out of sync
+    client_socket.send(b"INTEGRITY_OK" if ok else b"INTEGRITY_FAIL")
+    return ok
+
+def handle_cdc_delta(client_socket, filename, file_path, params, window, compressed=False):
+    """
+    Content-defined chunking delta sync (UPLOAD_DELTA filename CDC=min:avg:max).
+    Both sides cut their file at content-defined boundaries (FastCDC), so an
+    insertion only changes the chunks around it. The client streams a chunk
+    manifest, we reuse every chunk we already hold (wherever it sits in our
+    copy) and receive the rest.
+    Returns whether the file is now the client's version, or None if the
+    stream got out of sync.
+    """
+    # PROTOCOL:
+    # 1. Send ACK CDC=min:avg:max (already done by caller, negotiated params)
+    # 2. Recv Chunk Manifest (Length (4) + Hash (32) each, Length 0 + File Hash to end)
+    # 3. Send Missing Chunks as block ranges
+    # 4. Recv Chunks (Index (4) + Len (4) + Data, or Index (4) + compression frame
+    #    if COMPRESS was agreed), windowed ACKs as for blocks
+    # 5. Send INTEGRITY_OK / INTEGRITY_FAIL
+    print(f"[Delta Sync] CDC sync requested for {filename} ({utils.format_cdc_params(params)})")
+    monitor.log_event(f"CDC Delta Request: {filename}")
+
+    server_chunks, server_final_hash, exists = delta.server_chunks(file_path, params)
+    manifest = utils.recv_chunk_manifest(client_socket, server_chunks)
+    if manifest is None:
+        print("[Delta Sync] Malformed chunk manifest")
+        return None
+    plan, missing_chunks, client_final_hash = manifest
+
+    missing_chunks, foreign = delta.find_chunks(filename, plan, missing_chunks, params)
+    client_socket.sendall(utils.encode_block_ranges(missing_chunks))
+
+    if not missing_chunks and server_final_hash == client_final_hash:
+        client_socket.send(b"INTEGRITY_OK")
+        print("[Delta Sync] File already up to date and verified.")
+        monitor.log_event(f"{filename} already up to date")
+        return True
+
+    rebuild = delta.ChunkApply(filename, file_path, exists, plan, missing_chunks, foreign)
+    ack_every = utils.ack_interval(window)
+    header_size = 4 + compression.FRAME_HEADER_SIZE if compressed else 8
+    reader = utils.SocketReader(client_socket, params[2])  # chunk data, one buffer for the whole stream
+    try:
+        for count in range(1, len(missing_chunks) + 1):
+            header = utils.recv_exact(client_socket, header_size)
+            if len(header) < header_size:
+                rebuild.verified = False
+                break
+            chunk_idx = int.from_bytes(header[:4], 'big')
+
+            if compressed:
+                chunk_data = compression.recv_frame_body(client_socket, header[4:], reader, params[2])
+                if chunk_data is None:
+                    rebuild.verified = False
+                    break
+            else:
+                chunk_len = int.from_bytes(header[4:], 'big')
+                chunk_data = reader.recv_exactly(chunk_len)
+                if len(chunk_data) < chunk_len:
+                    rebuild.verified = False
+                    break
+            rebuild.accept(chunk_idx, chunk_data)
+
+            if window is None:
+                client_socket.send(b"ACK")
+            elif ack_every and count % ack_every == 0:
+                client_socket.send(utils.encode_window_ack(count))
+    except Exception:
+        rebuild.abort()
+        raise
+
+    ok = rebuild.finish(params, client_final_hash)
+    client_socket.send(b"INTEGRITY_OK" if ok else b"INTEGRITY_FAIL")
+    return ok
+
+def handle_download_delta(client_socket, filename, file_path, codecs=(), block_size=utils.BLOCK_SIZE):
+    """
+    Server-to-client delta sync (DOWNLOAD_DELTA filename).
+    The client describes its local copy with a binary manifest in the
+    `block_size` blocks the ACK announced and we stream back only the blocks
+    it lacks; the client rebuilds and verifies the file.
+    """
+    # PROTOCOL:
+    # 1. Send ACK (already done by caller)
+    # 2. Recv Binary Manifest of the client's copy
+    # 3. Send New Size (8) + File Hash (32) + Block Ranges
+    # 4. Send Blocks (Index (4) + Len (4) + Data, or Index (4) + compression
+    #    frame if COMPRESS was agreed), no ACKs
+    print(f"[Delta Sync] Client wants delta download of {filename}")
+    monitor.log_event(f"Delta Download Request: {filename}")
+
+    server_total, server_hashes, server_final_hash = manifest_cache.get_manifest(file_path, block_size=block_size)
+    manifest = utils.recv_binary_manifest(client_socket, server_hashes, block_size=block_size)
+    if manifest is None:
+        print("[Delta Sync] Malformed binary manifest")
+        return False
+    send_blocks, header = delta.download_plan(filename, file_path, server_total, server_final_hash, manifest)
+    client_socket.sendall(header)
+
+    total_send_bytes = len(send_blocks) * block_size  # approx
+    def _on_block(count):
+        monitor.update_transfer(filename, min(count * block_size, total_send_bytes), total_send_bytes, mode="Delta Download")
+
+    compressor = compression.AdaptiveCompressor(codecs) if codecs else None
+    utils.send_delta_blocks(client_socket, file_path, send_blocks, 0, _on_block,
+                            block_size=block_size, compressor=compressor)
+    total_size = os.path.getsize(file_path)
+    monitor.finish_transfer(filename, min(len(send_blocks) * block_size, total_size), total_size, outbound=True)
+    return True
+
+def handle_sync_dir(client_socket, parts, recv_buffer):
+    """
+    Batched directory sync (SYNC_DIR dirname ENTRIES=n BYTES=m [HASH]), see dirsync.py.
+    Files land under files/<dirname>/. Returns False if the stream got out of sync.
+    """
+    request = dirsync.parse_sync_request(parts)
+    if request is None:
+        client_socket.send(b"ERROR_Usage: SYNC_DIR dirname ENTRIES=n BYTES=m [HASH]")
+        return True
+    name, count, listing_len, with_hash = request
+    base = os.path.join("files", name)
+    client_socket.send(b"OK")
+
+    entries = dirsync.parse_listing(utils.recv_exact(client_socket, listing_len), count, with_hash)
+    if entries is None:
+        print("[Dir Sync] Malformed listing")
+        return False
+    actions = dirsync.plan_sync(base, entries)
+    client_socket.sendall(bytes(actions))
+
+    changed = sum(1 for a in actions if a in (dirsync.DELTA, dirsync.FULL))
+    print(f"[Dir Sync] {name}: {len(entries)} files, {changed} to transfer")
+    monitor.log_event(f"Dir Sync: {name} ({changed} of {len(entries)} files changed)")
+
+    updated = failed = 0
+    for (rel_path, size, _, _), action in zip(entries, actions):
+        path = dirsync.safe_path(base, rel_path)
+        if action == dirsync.FULL:
+            if not dirsync.recv_full(client_socket, path, recv_buffer):
+                return False
+            monitor.count_bytes(received=size)
+            ok = True
+        elif action == dirsync.DELTA:
+            header = utils.recv_exact(client_socket, 8)
+            if len(header) < 8:
+                return False
+            ok = handle_cdc_delta(client_socket, f"{name}/{rel_path}", path, utils.CDC_DEFAULT_PARAMS, utils.DELTA_WINDOW)
+            if ok is None:
+                return False
+            if ok:
+                manifest_cache.set_mtime(path, int.from_bytes(header, 'big'))
+        else:
+            continue
+        updated += ok
+        failed += not ok
+
+    if client_socket.recv(1024).decode() != "DONE":
+        return False
+    client_socket.send(f"SYNC_DONE {updated} {failed}".encode())
+    monitor.log_event(f"Dir Sync Complete: {name} ({updated} updated, {failed} failed)")
+    return True
+
+def handle_v2_upload(reader, writer, request_id, parts):
+    """
+    v2 UPLOAD: DATA frames into a temp file until END, then stored.
+    Returns False if the frame stream is broken.
+    """
+    filename = parts[1] if len(parts) >= 2 else None
+    size_option = next((p[5:] for p in parts[2:] if p.startswith("SIZE=")), None)
+    expected_size = int(size_option) if size_option and size_option.isdigit() else None
+    file_path = os.path.join("files", filename) if filename else None
+    temp_path = None
+    f = None
+    if file_path:
+        temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+        try:
+            f = open(temp_path, "wb")
+        except OSError:
+            temp_path = None
+    if f is None:
+        f = open(os.devnull, "wb")  # the data is drained, then the request refused
+
+    hasher = utils.BlockHasher()
+    received = 0
+    with f:
+        while True:
+            header = reader.read_header()
+            copied = 0
+            if header is not None and header[1] == request_id and header[0] == protocol2.DATA:
+                copied = reader.copy_payload(f, header[2], hasher.update)
+                received += copied
+                if filename:
+                    monitor.update_transfer(filename, received, expected_size or received, mode="Upload")
+                if copied == header[2]:
+                    continue
+            elif header is not None and header[1] == request_id and header[0] == protocol2.END:
+                break
+            if temp_path:
+                os.remove(temp_path)
+            return False
+
+    if temp_path is None:
+        writer.response(request_id, "ERROR_INVALID_NAME")
+    elif expected_size is not None and expected_size != received:
+        os.remove(temp_path)
+        writer.response(request_id, "ERROR_SIZE_MISMATCH")
+    else:
+        os.replace(temp_path, file_path)
+        _, block_hashes, file_hash = hasher.finish()
+        manifest_cache.store_manifest(file_path, block_hashes, file_hash)
+        writer.response(request_id, "OK")
+        print(f"Received file: {filename}")
+        monitor.log_event(f"Recv Complete: {filename}")
+        monitor.finish_transfer(filename, received, received)
+    return True
+
+def handle_v2(client_socket):
+    """
+    Serves a connection that switched to the framed v2 protocol (protocol2.py).
+    Pipelined requests are answered in order; replies are coalesced and only
+    flushed once no further request is already buffered.
+    """
+    reader = protocol2.FrameReader(client_socket)
+    writer = protocol2.FrameWriter(client_socket)
+    while True:
+        if not reader.has_frame():
+            writer.flush()
+        header = reader.read_header()
+        if header is None:
+            return
+        frame_type, request_id, length = header
+        payload = reader.read_payload(length)
+        if frame_type != protocol2.REQUEST or payload is None:
+            print("[v2] Malformed frame, closing connection")
+            return
+
+        parts = payload.decode(errors="replace").split()
+        cmd = parts[0] if parts else ""
+
+        started = time.perf_counter()
+        try:
+            if cmd == "LIST":
+                writer.response(request_id, catalog.listing(parts) if len(parts) > 1 else "\n".join(catalog.names()))
+
+            elif cmd == "STAT" and len(parts) >= 2:
+                writer.response(request_id, storage.stat_file(parts[1]))
+
+            elif cmd == "DELETE":
+                writer.response(request_id, storage.delete_file(parts))
+
+            elif cmd == "DOWNLOAD" and len(parts) >= 2:
+                file_path = os.path.join("files", parts[1])
+                if not os.path.isfile(file_path):
+                    writer.response(request_id, "NOT_FOUND")
+                    continue
+                with open(file_path, "rb") as f:
+                    requested = protocol2.parse_range(parts, os.fstat(f.fileno()).st_size)
+                    if requested is None:
+                        writer.response(request_id, "ERROR_INVALID_RANGE")
+                        continue
+                    offset, length = requested
+                    writer.response(request_id, f"OK SIZE={length}")
+                    writer.send_file(request_id, f, offset, length)
+                monitor.count_bytes(sent=length)
+                print(f"Sent file: {parts[1]}")
+
+            elif cmd == "UPLOAD":
+                if not handle_v2_upload(reader, writer, request_id, parts):
+                    print("[v2] Upload stream broken, closing connection")
+                    return
+
+            elif cmd == "EXIT":
+                writer.flush()
+                return
+
+            else:
+                writer.response(request_id, "ERROR_UNSUPPORTED")
+        finally:
+            monitor.observe_command(cmd, time.perf_counter() - started)
+
 def handle_client(client_socket, address):
     print(f"[+] New connection from {address}")
+    recv_buffer = bytearray(utils.RECV_BUFFER_SIZE)  # reused by every upload on this connection
     while True:
+        cmd = None
         try:
             data = client_socket.recv(1024).decode()
             if not data:
@@ -25,47 +365,96 @@ def handle_client(client_socket, address):
                 continue
 
             cmd = parts[0]
+            started = time.perf_counter()
 
-            # LIST
+            # LIST [PREFIX=p] [CURSOR=c] [LIMIT=n] [SIZE] [MTIME] [HASH] (paged, see catalog.py)
             if cmd == "LIST":
-                files = os.listdir("files")
-                client_socket.send(("\n".join(files) if files else "No files found").encode())
+                if len(parts) > 1:
+                    page = catalog.listing(parts)
+                    client_socket.sendall(str(len(page)).encode().ljust(10) + page)
+                    continue
+                files = catalog.names()
+                client_socket.sendall(("\n".join(files) if files else "No files found").encode())
 
-            # UPLOAD filename
+            # UPLOAD filename [COMPRESS=zlib,lzma] [RESUMABLE | RESUME=token]
             elif cmd == "UPLOAD":
                 if len(parts) < 2:
                     continue
                 filename = parts[1]
+                codecs = []
+                for part in parts[2:]:
+                    if part.startswith("COMPRESS="):
+                        codecs = compression.negotiate_codecs(part[9:])
+                token = resume.session_token(parts, resume.UPLOAD, filename)
                 
                 # PROTOCOL:
                 # 1. Recv UPLOAD filename
-                # 2. Send OK
+                # 2. Send OK (+ COMPRESS=codecs we accept, TOKEN=session if resumable)
                 # 3. Recv Size
-                # 4. Send OK
-                # 5. Recv Data
+                # 4. Send OK (resumable: OK OFFSET=bytes we already have)
+                # 5. Recv Data from that offset (compression frames if COMPRESS was agreed)
 
-                client_socket.send(b"OK")  # ACK the command
+                reply = ["OK"]
+                if codecs:
+                    reply.append(f"COMPRESS={compression.format_codecs(codecs)}")
+                if token:
+                    reply.append(f"TOKEN={token}")
+                client_socket.send(" ".join(reply).encode())  # ACK the command
 
-                filesize_str = client_socket.recv(1024).decode()
                 try:
+                    filesize_str = client_socket.recv(1024).decode()
                     filesize = int(filesize_str)
-                    client_socket.send(b"OK") # ACK the size
+                    file_path = os.path.join("files", filename)
+                    session = None
+                    offset = 0
+                    target_path = file_path
+                    if token:
+                        # Partial data is kept in a session file until complete
+                        session = resume.upload_session(token, filename, file_path, filesize)
+                        offset = session["received"]
+                        target_path = session["temp_path"]
+                        client_socket.send(f"OK OFFSET={offset}".encode())
+                        if offset:
+                            print(f"[Resume] {filename}: continuing at {offset}/{filesize} bytes")
+                            monitor.log_event(f"Upload Resumed: {filename} at {offset} bytes")
+                    else:
+                        client_socket.send(b"OK") # ACK the size
                     
-                    # Receive file data
+                    # Receive file data (a resumed upload is hashed once complete)
                     bytes_received = 0
-                    file_path = os.path.join("files", filename)
-                    with open(file_path, "wb") as f:
-                        while bytes_received < filesize:
-                            chunk_size = 4096
-                            remaining = filesize - bytes_received
-                            if remaining < chunk_size:
-                                chunk_size = remaining
-                            
-                            chunk = client_socket.recv(chunk_size)
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            bytes_received += len(chunk)
+                    hasher = utils.BlockHasher() if offset == 0 else None # build the manifest while ingesting
+                    on_data = hasher.update if hasher else None
+                    try:
+                        with open(target_path, "r+b" if offset else "wb") as f:
+                            if offset:
+                                f.truncate(offset)
+                                f.seek(offset)
+                            if session:
+                                on_data = resume.UploadCheckpoint(session, f, on_data)
+                            if codecs:
+                                bytes_received = compression.recv_stream(client_socket, f, filesize - offset, on_data)
+                            else:
+                                bytes_received = utils.recv_to_file(client_socket, f, filesize - offset, recv_buffer, on_data)
+                    finally:
+                        if session and session["received"] < filesize:
+                            resume.save(session)  # checkpoint what arrived before the drop
+
+                    if session and session["received"] < filesize:
+                        print(f"[Resume] {filename}: interrupted at {session['received']}/{filesize} bytes")
+                        monitor.log_event(f"Upload Interrupted: {filename} (resumable)")
+                        break  # stream is out of sync or gone, drop the connection
+                    if bytes_received is None:
+                        print("Malformed compressed upload")
+                        break  # stream is out of sync, drop the connection
+                    if session:
+                        os.replace(target_path, file_path)
+                        resume.discard(token)
+                    if offset + bytes_received == filesize:
+                        if hasher:
+                            _, block_hashes, file_hash = hasher.finish()
+                        else:
+                            _, block_hashes, file_hash = manifest_cache.hash_file(file_path)
+                        manifest_cache.store_manifest(file_path, block_hashes, file_hash)
                     
                     print(f"Received file: {filename}")
                     monitor.log_event(f"Recv Complete: {filename}")
@@ -74,173 +463,309 @@ def handle_client(client_socket, address):
                 except ValueError:
                     print("Invalid file size received")
                     client_socket.send(b"ERROR_INVALID_SIZE")
+                finally:
+                    if token:
+                        resume.release(token)
+
+            # UPLOAD_STRIPED filename SIZE=n STRIPES=k HASH=hex
+            elif cmd == "UPLOAD_STRIPED":
+                if len(parts) < 2:
+                    continue
+                filename = parts[1]
+                request = striped.parse_stripe_request(parts)
+                if request is None:
+                    client_socket.send(b"ERROR_Usage: UPLOAD_STRIPED filename SIZE=n STRIPES=k HASH=hex")
+                    continue
+                size, stripes, file_hash = request
+
+                # PROTOCOL:
+                # 1. Send OK SESSION=id
+                # 2. Stripes arrive on their own connections (STRIPE id index)
+                # 3. Recv COMMIT / ABORT
+                # 4. Send INTEGRITY_OK / INTEGRITY_FAIL
+                session = striped.open_session(os.path.join("files", filename), size, stripes, file_hash)
+                print(f"[Striped] {filename}: {size} bytes in {len(session.ranges)} stripes")
+                monitor.log_event(f"Striped Upload: {filename} ({len(session.ranges)} stripes)")
+                closed = False
+                try:
+                    client_socket.send(f"OK SESSION={session.id}".encode())
+                    reply = client_socket.recv(1024).decode()
+                    closed = True
+                    ok = striped.close_session(session, reply == "COMMIT")
+                finally:
+                    if not closed:
+                        striped.close_session(session, False)  # main connection lost
+
+                if ok:
+                    client_socket.send(b"INTEGRITY_OK")
+                    monitor.log_event(f"Recv Complete: {filename}")
+                    monitor.finish_transfer(filename, size, size)
+                else:
+                    client_socket.send(b"INTEGRITY_FAIL")
+                    monitor.log_event(f"Integrity FAIL: {filename}")
+
+            # STRIPE session index
+            elif cmd == "STRIPE":
+                session = striped.acquire_stripe(parts[1], parts[2]) if len(parts) == 3 else None
+                if session is None:
+                    client_socket.send(b"ERROR_NO_SESSION")
+                    continue
+
+                filename = os.path.basename(session.file_path)
+                def _on_stripe_data(received):
+                    monitor.update_transfer(filename, received, session.size, mode="Striped Upload")
+                try:
+                    client_socket.send(b"OK")
+                    ok = striped.recv_stripe(client_socket, session, int(parts[2]), recv_buffer, _on_stripe_data)
+                finally:
+                    striped.release_stripe(session)  # before the reply, so COMMIT finds it done
+                if ok:
+                    client_socket.send(b"STRIPE_OK")
+                else:
+                    client_socket.send(b"STRIPE_FAIL")
+
+            # SYNC_DIR dirname ENTRIES=n BYTES=m [HASH]
+            elif cmd == "SYNC_DIR":
+                if not handle_sync_dir(client_socket, parts, recv_buffer):
+                    break  # stream is out of sync, drop the connection
+
+            # STAT filename -> STAT size file_hash (striped downloads)
+            elif cmd == "STAT":
+                if len(parts) < 2:
+                    continue
+                client_socket.send(storage.stat_file(parts[1]))
 
-            # UPLOAD_DELTA filename
+            # UPLOAD_DELTA filename [options]
             elif cmd == "UPLOAD_DELTA":
                 if len(parts) < 2:
                     continue
                 filename = parts[1]
                 file_path = os.path.join("files", filename)
+
+                options = delta.parse_upload_options(parts)
+                window, cdc_params, codecs = options["window"], options["cdc_params"], options["codecs"]
+                ack_every = utils.ack_interval(window)
                 
-                # Check if we have the file
-                if not os.path.exists(file_path):
+                # Check if we have the file (with the block store a CDC or BINARY
+                # sync can build a new file from data other files hold)
+                if delta.full_upload_required(parts, options, file_path):
                     client_socket.send(b"FULL_UPLOAD_REQUIRED")
                     continue
+
+                # UPLOAD_DELTA filename CDC[=min:avg:max] -> content-defined chunks,
+                # the ACK carries the chunk sizes we agreed to
+                if cdc_params is not None:
+                    client_socket.send(delta.cdc_ack(options))
+                    if handle_cdc_delta(client_socket, filename, file_path, cdc_params, window, bool(codecs)) is None:
+                        break  # stream is out of sync, drop the connection
+                    continue
                 
-                client_socket.send(b"ACK") # Ready for hash list
+                # Ready for hash list; negotiated block hash and size are echoed back
+                ack, algo, digest_len, block_size, token = delta.block_mode_ack(parts, options, filename, file_path)
+                client_socket.send(ack)
+
+                # UPLOAD_DELTA filename ROLLING -> match at any byte offset
+                if "ROLLING" in parts[2:]:
+                    if handle_rolling_delta(client_socket, filename, file_path) is None:
+                        break  # stream is out of sync, drop the connection
+                    continue
                 
-                # Recv Hash List (Length prefixed)
-                json_len_data = client_socket.recv(10).decode().strip()
                 try:
-                    json_len = int(json_len_data)
-                    client_socket.send(b"OK")
-                    
-                    json_data = b""
-                    while len(json_data) < json_len:
-                         chunk = client_socket.recv(min(4096, json_len - len(json_data)))
-                         if not chunk: break
-                         json_data += chunk
-                    
-                    client_state = json.loads(json_data.decode())
-                    client_total_blocks = client_state["total_blocks"]
-                    client_hashes = client_state["hashes"]
-                    client_final_hash = client_state["file_hash"]
-                    
                     print(f"[Delta Sync] Client wants to sync {filename}")
                     monitor.log_event(f"Delta Sync Request: {filename}")
-                    
-                    print(f"[Delta Sync] Comparing hashes...")
-                    monitor.log_event(f"Comparing hashes for {filename}...")
-                    
-                    server_total, server_hashes, server_final_hash = utils.get_file_block_hashes(file_path)
-                    
-                    missing_blocks = []
-                    for i in range(client_total_blocks):
-                        if i >= len(server_hashes) or server_hashes[i] != client_hashes[i]:
-                            missing_blocks.append(i)
-                            
-                    print(f"[Delta Sync] Need to receive {len(missing_blocks)} blocks")
-                    monitor.log_event(f"{filename}: {len(missing_blocks)} blocks missing")
-                    
-                    # Send MISSING_BLOCKS
-                    response = json.dumps({"missing": missing_blocks})
-                    response_bytes = response.encode()
-                    client_socket.send(str(len(response_bytes)).encode().ljust(10)) 
-                    client_socket.send(response_bytes)
-                    
+
+                    server_total, server_hashes, server_final_hash = delta.server_manifest(file_path, algo, block_size)
+                    expected = {}  # client's digest of each missing block
+                    session, resumed = None, False
+                    resumed_blocks = []  # applied before the connection dropped last time
+                    foreign = ({}, {})  # blocks found in other stored files (block store)
+
+                    if "MERKLE" in parts[2:]:
+                        # Recv Block Count (8) + File Hash (32), then walk the tree top-down
+                        header = utils.recv_exact(client_socket, 40)
+                        if len(header) < 40:
+                            break
+                        client_total_blocks = int.from_bytes(header[:8], 'big')
+                        client_final_hash = header[8:].hex()
+
+                        print(f"[Delta Sync] Comparing Merkle tree...")
+                        monitor.log_event(f"Comparing Merkle tree for {filename}...")
+
+                        exchange = utils.merkle_exchange_server(client_socket, server_hashes, client_total_blocks,
+                                                               delta.merkle_max_blocks(options, block_size), expected)
+                        if exchange is None:
+                            print("[Delta Sync] Malformed Merkle exchange")
+                            break  # stream is out of sync, drop the connection
+                        missing_blocks, rounds = exchange
+
+                        print(f"[Delta Sync] Need to receive {len(missing_blocks)} blocks ({rounds} tree rounds)")
+                        monitor.log_event(f"{filename}: {len(missing_blocks)} blocks missing")
+
+                    elif "BINARY" in parts[2:]:
+                        # Recv Binary Manifest, compared batch by batch as it streams in
+                        print(f"[Delta Sync] Comparing hashes...")
+                        monitor.log_event(f"Comparing hashes for {filename}...")
+
+                        manifest = utils.recv_binary_manifest(client_socket, server_hashes, expected, digest_len, block_size)
+                        if manifest is None:
+                            print("[Delta Sync] Malformed binary manifest")
+                            break  # stream is out of sync, drop the connection
+                        client_total_blocks, missing_blocks, client_final_hash = manifest
+
+                        if token:
+                            session, resumed, resumed_blocks, missing_blocks = delta.resume_blocks(
+                                token, filename, file_path, missing_blocks, client_final_hash, algo, block_size)
+                        missing_blocks, foreign = delta.find_blocks(filename, missing_blocks, expected, algo,
+                                                                    block_size, client_total_blocks)
+
+                        print(f"[Delta Sync] Need to receive {len(missing_blocks)} blocks")
+                        monitor.log_event(f"{filename}: {len(missing_blocks)} blocks missing")
+
+                        # Send MISSING_BLOCKS as run-length ranges
+                        client_socket.sendall(utils.encode_block_ranges(missing_blocks))
+                    else:
+                        # Recv Hash List (Length prefixed JSON)
+                        json_len = int(utils.recv_exact(client_socket, 10).decode().strip())
+                        client_socket.send(b"OK")
+                        client_state = json.loads(utils.recv_exact(client_socket, json_len).decode())
+
+                        print(f"[Delta Sync] Comparing hashes...")
+                        monitor.log_event(f"Comparing hashes for {filename}...")
+
+                        client_total_blocks, missing_blocks, client_final_hash = delta.json_missing_blocks(
+                            client_state, server_hashes, expected)
+
+                        print(f"[Delta Sync] Need to receive {len(missing_blocks)} blocks")
+                        monitor.log_event(f"{filename}: {len(missing_blocks)} blocks missing")
+
+                        # Send MISSING_BLOCKS
+                        response_bytes = json.dumps({"missing": missing_blocks}).encode()
+                        client_socket.sendall(str(len(response_bytes)).encode().ljust(10) + response_bytes)
+
+                    monitor.count_blocks(compared=client_total_blocks, sent=len(missing_blocks))
                     if not missing_blocks:
                          print("[Delta Sync] No blocks needed. Verifying integrity...")
                          if server_final_hash == client_final_hash:
                               client_socket.send(b"INTEGRITY_OK")
                               print("[Delta Sync] File already up to date and verified.")
                               monitor.log_event(f"{filename} already up to date")
-                         else:
-                              pass 
+                              continue
                     
-                    # Ready to receive blocks
-                    temp_path = file_path + ".tmp"
-                    shutil.copy2(file_path, temp_path)
+                    # Ready to receive blocks: build the new version next to the old one
+                    rebuild = delta.BlockApply(filename, file_path, server_hashes, algo, block_size, client_total_blocks,
+                                               missing_blocks, expected, session, resumed, resumed_blocks, foreign)
+                    lost = False  # connection dropped mid-stream
                     
-                    received_delta_bytes = 0
-                    total_missing_bytes = len(missing_blocks) * utils.BLOCK_SIZE # approx
-                    
-                    with open(temp_path, "r+b") as f:
-                        for idx in missing_blocks:
-                            # Recv Header: Index (4) + Size (4)
-                            header = client_socket.recv(8)
-                            if not header or len(header) < 8:
+                    header_size = 4 + compression.FRAME_HEADER_SIZE if codecs else 8
+                    reader = utils.SocketReader(client_socket, block_size)  # blocks not received in place
+                    try:
+                        for count in range(1, len(missing_blocks) + 1):
+                            # Recv Header: Index (4) + Size (4), or Index (4) + frame header
+                            header = utils.recv_exact(client_socket, header_size)
+                            if len(header) < header_size:
+                                lost = True
                                 break
-                            
-                            blk_idx = int.from_bytes(header[:4], 'big')
-                            blk_len = int.from_bytes(header[4:], 'big')
-                            
-                            # Recv Data
-                            blk_data = b""
-                            while len(blk_data) < blk_len:
-                                chunk = client_socket.recv(min(4096, blk_len - len(blk_data)))
-                                if not chunk: break
-                                blk_data += chunk
-                            
-                            # Write to temp file
-                            f.seek(blk_idx * utils.BLOCK_SIZE)
-                            f.write(blk_data)
-                            
-                            received_delta_bytes += blk_len
-                            monitor.update_transfer(filename, received_delta_bytes, total_missing_bytes, mode="Delta Sync")
-                            
-                            # ACK per block
-                            client_socket.send(b"ACK")
-
-                    # Integrity Check
-                    _, _, new_server_hash = utils.get_file_block_hashes(temp_path)
-                    
-                    if new_server_hash == client_final_hash:
-                        client_socket.send(b"INTEGRITY_OK")
-                        print("[Delta Sync] Integrity verification successful.")
                         
-                        saved_percent = 100 * (1 - (len(missing_blocks) * utils.BLOCK_SIZE) / (client_total_blocks * utils.BLOCK_SIZE or 1))
-                        print(f"[Delta Sync] Bandwidth saved: {saved_percent:.1f}%")
+                            blk_idx = int.from_bytes(header[:4], 'big')
                         
-                        shutil.move(temp_path, file_path)
+                            # Recv Data: a block we are waiting for goes straight from the
+                            # socket into the mapped output (a bad one fails the whole file)
+                            target = None
+                            if codecs:
+                                # Compressed frames are decoded in memory, then written
+                                blk_data = compression.recv_frame_body(client_socket, header[4:], reader, block_size)
+                                if blk_data is None:
+                                    lost = True  # cut off or out of sync: drop the connection
+                                    break
+                            else:
+                                blk_len = int.from_bytes(header[4:], 'big')
+                                target = rebuild.region(blk_idx, blk_len)
+                                if target is not None:
+                                    blk_data = target
+                                    received = utils.recv_into_exact(client_socket, target)
+                                else:
+                                    blk_data = reader.recv_exactly(blk_len)
+                                    received = len(blk_data)
+                                if received < blk_len:
+                                    lost = True
+                                    break
+
+                            # Verified against the client's digest while writing, so the
+                            # result never has to be re-read
+                            rebuild.accept(blk_idx, blk_data, in_place=target is not None)
+                            if target is not None:
+                                target.release()
                         
-                        monitor.finish_transfer(filename, received_delta_bytes, client_total_blocks * utils.BLOCK_SIZE)
-                    else:
-                        client_socket.send(b"INTEGRITY_FAIL")
-                        monitor.log_event(f"Integrity FAIL: {filename}")
-                        print("[Delta Sync] Integrity check failed!")
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
+                            if window is None:
+                                # ACK per block
+                                client_socket.send(b"ACK")
+                            elif ack_every and count % ack_every == 0:
+                                # Cumulative ACK, client keeps the window full meanwhile
+                                client_socket.send(utils.encode_window_ack(count))
+                    except Exception:
+                        # connection error mid-stream
+                        rebuild.interrupt()
+                        raise
+
+                    if lost:
+                        # A resumable session keeps what arrived; the client resumes with RESUME=token
+                        rebuild.interrupt()
+                        break
+
+                    client_socket.send(b"INTEGRITY_OK" if rebuild.finish(client_final_hash) else b"INTEGRITY_FAIL")
 
                 except ValueError:
                     print("Error parsing delta metadata")
+                finally:
+                    if token:
+                        resume.release(token)
+
+            # DOWNLOAD_DELTA filename [COMPRESS=zlib,lzma] [BLOCK=n|auto]
+            elif cmd == "DOWNLOAD_DELTA":
+                if len(parts) < 2:
+                    continue
+                filename = parts[1]
+                file_path = os.path.join("files", filename)
+                if not os.path.exists(file_path):
+                    client_socket.send(b"NOT_FOUND")
+                    continue
+
+                # Ready for the client's manifest; the block size is announced if it was asked for
+                ack, codecs, block_size = delta.download_ack(parts, file_path)
+                client_socket.send(ack)
+                if not handle_download_delta(client_socket, filename, file_path, codecs, block_size):
+                    break  # stream is out of sync, drop the connection
 
             # DELETE filename password
             elif cmd == "DELETE":
-                try:
-                    if len(parts) < 3:
-                         client_socket.send(b"ERROR_Usage: DELETE filename password")
-                         continue
-                    
-                    filename = parts[1]
-                    password = parts[2]
-                    
-                    # AUTH CHECK
-                    if password != "admin":
-                        client_socket.send(b"ERROR_AUTH_FAILED")
-                        monitor.log_event(f"Delete failed (Auth): {filename}")
-                        continue
-
-                    file_path = os.path.join("files", filename)
-                    
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                        monitor.log_event(f"Deleted file: {filename}")
-                        client_socket.send(b"OK")
-                        print(f"[-] Deleted file: {filename}")
-                    else:
-                        client_socket.send(b"ERROR_NOT_FOUND")
-                        
-                except Exception as e:
-                    print(f"Error deleting file: {e}")
-                    client_socket.send(f"ERROR: {e}".encode())
+                client_socket.send(storage.delete_file(parts))
 
-            # DOWNLOAD filename [OFFSET=123]
+            # DOWNLOAD filename [OFFSET=123] [LENGTH=456] [COMPRESS | COMPRESS=zlib,lzma]
             elif cmd == "DOWNLOAD":
                 if len(parts) < 2:
                     continue
                 filename = parts[1]
                 offset = 0
+                length = None  # None = to the end (LENGTH= is used by striped downloads)
                 
                 # Parse OPTIONS
                 use_compression = False
+                codecs = []  # adaptive framed compression
                 for part in parts[2:]:
                     if part.startswith("OFFSET="):
                         try:
                             offset = int(part.split("=")[1])
                         except ValueError:
                             pass
+                    elif part.startswith("LENGTH="):
+                        try:
+                            length = max(0, int(part.split("=")[1]))
+                        except ValueError:
+                            pass
                     elif part == "COMPRESS":
                         use_compression = True
+                    elif part.startswith("COMPRESS="):
+                        codecs = compression.negotiate_codecs(part[9:])
                 
                 file_path = os.path.join("files", filename)
                 
@@ -251,6 +776,8 @@ def handle_client(client_socket, address):
                          remaining_size = 0
                     else:
                          remaining_size = total_size - offset
+                    if length is not None:
+                        remaining_size = min(remaining_size, length)
                     
                     # If compressing, we don't know the exact size, but the client expects a number.
                     # We can send "STREAM" to indicate chunked/compressed mode?
@@ -259,7 +786,10 @@ def handle_client(client_socket, address):
                     # Let's keep it simple: Client asks for compression -> Client expects chunked format.
                     # Server sends "COMPRESSED" instead of size? Or "SIZE|COMPRESSED"?
                     
-                    if use_compression:
+                    if codecs:
+                        # Frames of Raw Length (4) + Codec (1) + Payload Length (4) + Payload
+                        client_socket.send(f"FRAMED_{remaining_size}".encode())
+                    elif use_compression:
                         client_socket.send(f"COMPRESSED_{remaining_size}".encode())
                     else:
                         client_socket.send(str(remaining_size).encode())
@@ -270,40 +800,57 @@ def handle_client(client_socket, address):
                             if offset > 0:
                                 f.seek(offset)
                             
-                            if use_compression:
+                            if codecs:
+                                compressor = compression.AdaptiveCompressor(codecs)
+                                compression.send_stream(client_socket, f, remaining_size, compressor)
+                                monitor.count_bytes(sent=compressor.link_bytes)
+                                print(f"Sent file (adaptive compression): {filename}")
+
+                            elif use_compression:
                                 compressor = zlib.compressobj()
-                                while True:
-                                    data = f.read(4096)
+                                writer = utils.SocketWriter(client_socket)  # one send per ~64 KB of chunks
+                                to_send = remaining_size
+                                wire_bytes = 4  # EOF marker
+                                while to_send > 0:
+                                    data = f.read(min(4096, to_send))
                                     if not data:
                                         break
+                                    to_send -= len(data)
                                     compressed = compressor.compress(data)
                                     if compressed:
                                         # Send Length (4 bytes) + Data
-                                        client_socket.send(len(compressed).to_bytes(4, byteorder='big'))
-                                        client_socket.send(compressed)
+                                        writer.write(len(compressed).to_bytes(4, byteorder='big'), compressed)
+                                        wire_bytes += 4 + len(compressed)
                                 
                                 # Flush remaining
                                 remaining = compressor.flush()
                                 if remaining:
-                                    client_socket.send(len(remaining).to_bytes(4, byteorder='big'))
-                                    client_socket.send(remaining)
-                                
+                                    writer.write(len(remaining).to_bytes(4, byteorder='big'), remaining)
+                                    wire_bytes += 4 + len(remaining)
 
                                 # Send EOF (Length 0)
-                                client_socket.send((0).to_bytes(4, byteorder='big'))
+                                writer.write((0).to_bytes(4, byteorder='big'))
+                                writer.flush()
+                                monitor.count_bytes(sent=wire_bytes)
                                 print(f"Sent file (compressed): {filename}")
                                 
                             else:
-                                # Normal Transfer
-                                while True:
-                                    data = f.read(4096)
-                                    if not data:
-                                        break
-                                    client_socket.send(data)
+                                # Normal Transfer (zero-copy sendfile)
+                                utils.send_file_range(client_socket, f, offset, remaining_size)
+                                monitor.count_bytes(sent=remaining_size)
                         print(f"Sent file: {filename}")
                 else:
                     client_socket.send(b"NOT_FOUND")
 
+            # PROTO 2 -> the rest of the connection uses the framed v2 protocol
+            elif cmd == "PROTO":
+                if parts[1:] != ["2"]:
+                    client_socket.send(b"ERROR_UNSUPPORTED_PROTOCOL")
+                    continue
+                client_socket.send(b"OK PROTO=2")
+                handle_v2(client_socket)
+                break
+
             # EXIT
             elif cmd == "EXIT":
                 break
@@ -311,18 +858,31 @@ def handle_client(client_socket, address):
         except Exception as e:
             print(f"Error handling client {address}: {e}")
             break
+        finally:
+            if cmd is not None:
+                monitor.observe_command(cmd, time.perf_counter() - started)
 
     client_socket.close()
+    monitor.remove_client(address[:2])
     print(f"[-] Connection closed from {address}")
 
 
-def start_server():
+def start_server(use_async=False):
     # Change to project directory to avoid .env permission issues
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     # Ensure 'files' directory exists
     if not os.path.exists('files'):
         os.makedirs('files')
         print("Created 'files' directory")
+    catalog.start()  # file listings are served from the catalog
+
+    # asyncio engine: one coroutine per connection instead of one thread
+    if use_async:
+        dash_thread = threading.Thread(target=dashboard.run, daemon=True)
+        dash_thread.start()
+        monitor.log_event("Server started on port 5001 (asyncio engine)")
+        asyncio.run(async_server.serve())
+        return
 
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # Allow port reuse to avoid 'Address already in use' errors during testing
@@ -340,9 +900,13 @@ def start_server():
 
     while True:
         client_socket, address = server.accept()
-        monitor.add_client(address[0])
+        monitor.add_client(address[:2])
         thread = threading.Thread(target=handle_client, args=(client_socket, address))
         thread.start()
 
 if __name__ == "__main__":
-    start_server()
+    # python server.py --async       -> asyncio engine for many mostly idle clients
+    # python server.py --blockstore  -> deltas reuse chunks and blocks from every stored file
+    if "--blockstore" in sys.argv[1:]:
+        blockstore.enable()
+    start_server(use_async="--async" in sys.argv[1:])
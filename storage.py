@@ -0,0 +1,53 @@
+import os
+import monitor
+import manifest_cache
+import blockstore
+import catalog
+
+# Commands on the storage directory whose reply does not depend on the
+# protocol or the engine: server.py and async_server.py (v1 and v2) send
+# what these return. Plain blocking code; the asyncio engine runs it on its
+# executor.
+
+STORE_DIR = "files"
+
+def stat_file(filename):
+    """STAT filename -> reply: "STAT <size> <file hash>" or NOT_FOUND."""
+    file_path = os.path.join(STORE_DIR, filename)
+    try:
+        if not os.path.isfile(file_path):
+            return b"NOT_FOUND"
+        _, _, file_hash = manifest_cache.get_manifest(file_path)
+        return f"STAT {os.path.getsize(file_path)} {file_hash}".encode()
+    except OSError:  # deleted or replaced meanwhile
+        return b"NOT_FOUND"
+
+def delete_file(parts):
+    """DELETE filename password -> reply."""
+    try:
+        if len(parts) < 3:
+            return b"ERROR_Usage: DELETE filename password"
+
+        filename = parts[1]
+        password = parts[2]
+
+        # AUTH CHECK
+        if password != "admin":
+            monitor.log_event(f"Delete failed (Auth): {filename}")
+            return b"ERROR_AUTH_FAILED"
+
+        file_path = os.path.join(STORE_DIR, filename)
+        if not os.path.exists(file_path):
+            return b"ERROR_NOT_FOUND"
+
+        os.remove(file_path)
+        manifest_cache.invalidate(file_path)
+        blockstore.remove_file(file_path)
+        catalog.remove_file(file_path)
+        monitor.log_event(f"Deleted file: {filename}")
+        print(f"[-] Deleted file: {filename}")
+        return b"OK"
+
+    except Exception as e:
+        print(f"Error deleting file: {e}")
+        return f"ERROR: {e}".encode()
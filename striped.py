@@ -0,0 +1,282 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import utils
+import manifest_cache
+import reconstruct
+
+# Striped transfers: one large file split into byte ranges that travel over
+# parallel connections, so a long fat pipe is not limited by one TCP window.
+#
+# Upload (server keeps a session per file being assembled):
+#   main:     UPLOAD_STRIPED filename SIZE=n STRIPES=k HASH=<file hash>
+#             -> OK SESSION=<id>
+#   stripe i: STRIPE <id> <i> -> OK -> raw bytes of stripe i -> STRIPE_OK / STRIPE_FAIL
+#   main:     COMMIT (or ABORT) -> INTEGRITY_OK / INTEGRITY_FAIL
+# Stripes are written with positional writes into one temp file, which only
+# replaces the stored file once every stripe arrived and the hash matches.
+# The temp file is closed only once no stripe connection is writing to it any
+# more; a session nobody sends data to for SESSION_IDLE_TIMEOUT is discarded.
+#
+# Download: STAT filename -> STAT <size> <file hash>, then one
+# DOWNLOAD filename OFFSET=o LENGTH=l per stripe.
+
+MAX_STRIPES = 16
+STRIPE_ALIGN = 1024 * 1024  # stripe boundaries, a multiple of every block size
+SESSION_IDLE_TIMEOUT = 3600  # seconds
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def stripe_ranges(size, stripes):
+    """(offset, length) of each stripe; the same split on both sides (none for an empty file)."""
+    stripe_len = -(-size // max(1, stripes))
+    stripe_len = max(STRIPE_ALIGN, -(-stripe_len // STRIPE_ALIGN) * STRIPE_ALIGN)
+    ranges = []
+    offset = 0
+    while offset < size:
+        ranges.append((offset, min(stripe_len, size - offset)))
+        offset += stripe_len
+    return ranges
+
+# ---------------------------------------------------------------------------
+# Server side
+# ---------------------------------------------------------------------------
+
+class StripeSession:
+    """A file being assembled from stripes in `<path>.<session>.part`."""
+    def __init__(self, file_path, size, stripes, file_hash):
+        self.id = uuid.uuid4().hex
+        self.file_path = file_path
+        self.size = size
+        self.ranges = stripe_ranges(size, stripes)
+        self.file_hash = file_hash
+        self.temp_path = f"{file_path}.{self.id}.part"
+        self.fd = os.open(self.temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+        os.ftruncate(self.fd, size)
+        self.done = set()
+        self.received = 0
+        self.users = 0        # stripe connections currently writing to fd
+        self.closed = False   # committed, aborted or expired: no new stripes
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, offset, data):
+        view = memoryview(data)
+        while view:
+            n = reconstruct._pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+        with self.lock:
+            self.received += len(data)
+            self.last_active = time.monotonic()
+
+    def finish_stripe(self, index):
+        with self.lock:
+            self.done.add(index)
+
+    def complete(self):
+        with self.lock:
+            return len(self.done) == len(self.ranges)
+
+    def _discard(self):
+        # Only once closed and no stripe uses fd any more
+        os.close(self.fd)
+        os.remove(self.temp_path)
+
+    def close(self, commit):
+        """
+        Ends the session. With `commit` the stored file is replaced if all
+        stripes arrived and the hash matches (returns True). While stripes
+        are still writing, the last of them discards the temp file instead.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            self.closed = True
+            if self.users:
+                return False
+        if commit and self.complete():
+            os.close(self.fd)
+            _, block_hashes, file_hash = utils.get_file_block_hashes(self.temp_path)
+            if file_hash == self.file_hash:
+                os.replace(self.temp_path, self.file_path)
+                manifest_cache.store_manifest(self.file_path, block_hashes, file_hash)
+                return True
+            os.remove(self.temp_path)
+            return False
+        self._discard()
+        return False
+
+def _expire():
+    now = time.monotonic()
+    with _sessions_lock:
+        idle = [session for session in _sessions.values()
+                if not session.users and now - session.last_active > SESSION_IDLE_TIMEOUT]
+        for session in idle:
+            del _sessions[session.id]
+    for session in idle:
+        session.close(False)
+
+def open_session(file_path, size, stripes, file_hash):
+    _expire()
+    session = StripeSession(file_path, size, stripes, file_hash)
+    with _sessions_lock:
+        _sessions[session.id] = session
+    return session
+
+def acquire_stripe(session_id, index):
+    """
+    The open session a STRIPE request names, registered as writing until
+    release_stripe(), or None if there is no such session or stripe.
+    """
+    with _sessions_lock:
+        session = _sessions.get(session_id)
+    if session is None or not index.isdigit() or int(index) >= len(session.ranges):
+        return None
+    with session.lock:
+        if session.closed:
+            return None
+        session.users += 1
+        session.last_active = time.monotonic()
+    return session
+
+def release_stripe(session):
+    """Called when a stripe connection is done with the session (before it replies)."""
+    with session.lock:
+        session.users -= 1
+        last = session.closed and not session.users
+    if last:
+        session._discard()  # aborted while this stripe was writing
+
+def close_session(session, commit):
+    """Ends a session: commit it (returns the integrity result) or discard it."""
+    with _sessions_lock:
+        _sessions.pop(session.id, None)
+    return session.close(commit)
+
+def recv_stripe(sock, session, index, buffer, progress=None):
+    """
+    Receives stripe `index` of `session` straight into the temp file.
+    `progress(session_bytes_received)` is called after each chunk.
+    Returns True if the whole stripe arrived.
+    """
+    offset, length = session.ranges[index]
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view, min(len(view), length - received))
+        if not n:
+            break
+        session.write(offset + received, view[:n])
+        received += n
+        if progress:
+            progress(session.received)
+    if received < length:
+        return False
+    session.finish_stripe(index)
+    return True
+
+def parse_stripe_request(parts):
+    """(size, stripes, file_hash) from UPLOAD_STRIPED options, or None if invalid."""
+    options = dict(part.split("=", 1) for part in parts[2:] if "=" in part)
+    try:
+        size = int(options["SIZE"])
+        stripes = int(options["STRIPES"])
+        file_hash = options["HASH"]
+    except (KeyError, ValueError):
+        return None
+    if size < 0 or not 1 <= stripes <= MAX_STRIPES or len(file_hash) != 64:
+        return None
+    return size, stripes, file_hash
+
+# ---------------------------------------------------------------------------
+# Client side
+# ---------------------------------------------------------------------------
+
+def _send_stripe(address, session_id, index, file_path, offset, length):
+    with socket.create_connection(address) as sock:
+        sock.send(f"STRIPE {session_id} {index}".encode())
+        if sock.recv(1024).decode() != "OK":
+            return False
+        with open(file_path, "rb") as f:
+            utils.send_file_range(sock, f, offset, length)
+        return sock.recv(1024).decode() == "STRIPE_OK"
+
+def upload_striped(sock, file_path, filename, stripes):
+    """
+    Uploads `file_path` as `filename` over `stripes` extra connections to the
+    server `sock` is connected to. Returns the server's final status.
+    """
+    size = os.path.getsize(file_path)
+    _, _, file_hash = utils.get_file_block_hashes(file_path)
+    sock.send(f"UPLOAD_STRIPED {filename} SIZE={size} STRIPES={stripes} HASH={file_hash}".encode())
+    response = sock.recv(1024).decode()
+    ack = utils.parse_ack(response, "OK")
+    if ack is None or "SESSION" not in ack:
+        return response
+
+    ranges = stripe_ranges(size, stripes)
+    address = sock.getpeername()
+    with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as pool:
+        results = list(pool.map(lambda i: _send_stripe(address, ack["SESSION"], i, file_path, *ranges[i]),
+                                range(len(ranges))))
+
+    sock.send(b"COMMIT" if all(results) else b"ABORT")
+    return sock.recv(1024).decode()
+
+def _recv_stripe(address, filename, fd, offset, length):
+    with socket.create_connection(address) as sock:
+        sock.send(f"DOWNLOAD {filename} OFFSET={offset} LENGTH={length}".encode())
+        try:
+            if int(sock.recv(1024).decode()) != length:
+                return False
+        except ValueError:
+            return False
+        sock.send(b"OK")
+
+        buffer = bytearray(utils.RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        received = 0
+        while received < length:
+            n = sock.recv_into(view, min(len(view), length - received))
+            if not n:
+                return False
+            data = view[:n]
+            while data:
+                written = reconstruct._pwrite(fd, data, offset + received)
+                data = data[written:]
+                received += written
+        return True
+
+def download_striped(sock, filename, dest_path, stripes):
+    """
+    Downloads `filename` to `dest_path` over `stripes` extra connections.
+    The stripes are assembled in a temp file that only replaces `dest_path`
+    once its hash matches the server's. Returns (ok, message).
+    """
+    sock.send(f"STAT {filename}".encode())
+    parts = sock.recv(1024).decode().split()
+    if len(parts) != 3 or parts[0] != "STAT":
+        return False, " ".join(parts)
+    size, file_hash = int(parts[1]), parts[2]
+
+    temp_path = dest_path + ".part"
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        os.ftruncate(fd, size)
+        ranges = stripe_ranges(size, stripes)
+        address = sock.getpeername()
+        with ThreadPoolExecutor(max_workers=max(1, len(ranges))) as pool:
+            results = list(pool.map(lambda r: _recv_stripe(address, filename, fd, *r), ranges))
+    finally:
+        os.close(fd)
+
+    if all(results) and utils.get_file_block_hashes(temp_path)[2] == file_hash:
+        os.replace(temp_path, dest_path)
+        return True, f"{size} bytes in {len(ranges)} stripes"
+    os.remove(temp_path)
+    return False, "stripe transfer or hash check failed"
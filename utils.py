@@ -1,33 +1,213 @@
 import hashlib
+import json
+import math
 import os
+import shutil
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
-BLOCK_SIZE = 4096
+import compression
 
-def get_file_block_hashes(file_path):
+try:
+    import mmap
+except ImportError:
+    mmap = None
+
+BLOCK_SIZE = 4096  # default; BINARY manifests may negotiate a per-file size
+
+# Adaptive block size (UPLOAD_DELTA ... BINARY BLOCK=auto): powers of two in this
+# range, so they always divide DELTA_READ_SIZE and HASH_SEGMENT_SIZE
+MIN_BLOCK_SIZE = 1024
+MAX_BLOCK_SIZE = 1024 * 1024
+
+# Memory-mapped I/O for hashing, block sending and delta apply
+# (falls back to read/write where mmap is unavailable or refuses the file)
+MMAP_IO = mmap is not None
+
+# Plain (uncompressed) transfers
+SENDFILE_WINDOW = 8 * 1024 * 1024  # bytes handed to sendfile per call
+RECV_BUFFER_SIZE = 256 * 1024      # reusable recv_into buffer per connection
+COALESCE_SIZE = 64 * 1024          # SocketWriter: smaller writes are batched into one send
+
+# Pipelined delta upload: max blocks in flight before waiting for a cumulative ACK
+DELTA_WINDOW = 64
+
+# Paged LIST: entries requested per page
+LIST_PAGE = 1000
+
+# Binary block manifest (UPLOAD_DELTA ... BINARY)
+MANIFEST_MAGIC = b"DSM1"
+MANIFEST_HEADER_SIZE = 17   # magic (4) + block size (4) + digest len (1) + total blocks (8)
+MANIFEST_BATCH = 1024       # digests parsed (or sent, for chunk manifests) per batch
+
+# Block hash negotiation (UPLOAD_DELTA ... BINARY HASH=<algo>-<digest bytes>).
+# Manifests carry digests truncated to the negotiated length; the full 32-byte
+# form of the same algorithm still feeds the full-file hash.
+HASH_ALGORITHMS = {
+    "sha256": hashlib.sha256,
+    "blake2b": partial(hashlib.blake2b, digest_size=32),
+}
+DEFAULT_HASH = ("sha256", 32)        # what a server assumes when nothing is negotiated
+# What our clients propose: half the manifest size, and still SHA-256 so the
+# server's cached manifests (built on UPLOAD) are reused. BLAKE2b is faster on
+# CPUs without SHA extensions and can be requested explicitly.
+PREFERRED_HASH = ("sha256", 16)
+MIN_DIGEST_LEN = 8
+
+# Merkle-tree change discovery (UPLOAD_DELTA ... MERKLE)
+MERKLE_FANOUT = 16            # children per node: fewer round trips than a binary tree
+MERKLE_ABSENT_LEAF = b"\x00" * 32  # server-side leaf for blocks it does not have
+MERKLE_MAX_BLOCKS = 1 << 22       # largest tree the server builds (16 GiB at BLOCK_SIZE); bigger files sync with BINARY
+
+# Content-defined chunking (UPLOAD_DELTA ... CDC=min:avg:max)
+CDC_DEFAULT_PARAMS = (2048, 8192, 65536)
+CDC_MIN_SIZE_LIMIT = 256
+CDC_MAX_SIZE_LIMIT = 16 * 1024 * 1024
+
+# Rolling (rsync-style) delta tuning
+DELTA_READ_SIZE = 1024 * 1024   # how much of the local file we buffer at a time
+LITERAL_FLUSH_SIZE = 64 * 1024  # max literal run before it is sent as its own instruction
+LITERAL_MAX_LENGTH = LITERAL_FLUSH_SIZE + MAX_BLOCK_SIZE  # receivers reject longer LITERALs (flush size + a final tail)
+COPY_MAX_LENGTH = 2**32 - 1     # COPY length field is 4 bytes: longer runs become several COPYs
+ADLER_MOD = 65521
+
+# Parallel block hashing: files larger than one segment are split into
+# segments hashed on a shared thread pool (hashlib releases the GIL)
+HASH_SEGMENT_SIZE = 16 * 1024 * 1024  # multiple of BLOCK_SIZE
+HASH_WORKERS = min(32, os.cpu_count() or 1)
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+def _get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+        return _hash_pool
+
+def _hash_segment(file_path, offset, length, algo="sha256", block_size=BLOCK_SIZE):
+    """Raw digests of the blocks in file[offset:offset + length]."""
+    new_hash = HASH_ALGORITHMS[algo]
+    digests = []
+    with open(file_path, "rb") as f:
+        # Mapped: hash memoryview slices of the page cache, no copies
+        with map_for_read(f, offset, length) as view:
+            if view is not None:
+                for start in range(0, len(view), block_size):
+                    digests.append(new_hash(view[start:start + block_size]).digest())
+                return digests
+
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(DELTA_READ_SIZE, remaining))
+            if not data:
+                break
+            view = memoryview(data)
+            for start in range(0, len(data), block_size):
+                digests.append(new_hash(view[start:start + block_size]).digest())
+            remaining -= len(data)
+    return digests
+
+def iter_block_digests(file_path, algo="sha256", block_size=BLOCK_SIZE):
+    """
+    Yields the raw block digests of a file as lists, one per segment, in
+    file order. Segments are hashed in parallel with a bounded look-ahead,
+    so callers can consume (e.g. send) earlier segments meanwhile.
+    """
+    size = os.path.getsize(file_path)
+    if size <= HASH_SEGMENT_SIZE or HASH_WORKERS == 1:
+        yield _hash_segment(file_path, 0, size, algo, block_size)
+        return
+
+    pool = _get_hash_pool()
+    offsets = iter(range(0, size, HASH_SEGMENT_SIZE))
+    in_flight = deque()
+    for offset in offsets:
+        in_flight.append(pool.submit(_hash_segment, file_path, offset, HASH_SEGMENT_SIZE, algo, block_size))
+        if len(in_flight) == HASH_WORKERS * 2:
+            break
+
+    while in_flight:
+        digests = in_flight.popleft().result()
+        offset = next(offsets, None)
+        if offset is not None:
+            in_flight.append(pool.submit(_hash_segment, file_path, offset, HASH_SEGMENT_SIZE, algo, block_size))
+        yield digests
+
+def tree_file_hash(block_hashes, algo="sha256"):
+    """
+    Full-file hash from the (full-length) block hashes in hex: the algorithm
+    applied to the concatenated raw block digests. Everything that reports a
+    full_file_hash uses this, so it can be derived from a manifest without
+    re-reading the file.
+    """
+    return HASH_ALGORITHMS[algo](b"".join(bytes.fromhex(h) for h in block_hashes)).hexdigest()
+
+def hash_block(data, algo="sha256"):
+    """Full-length hex digest of one block."""
+    return HASH_ALGORITHMS[algo](data).hexdigest()
+
+def get_file_block_hashes(file_path, algo="sha256", block_size=BLOCK_SIZE):
     """
     Reads a file and returns:
     - total_blocks (int)
     - block_hashes (list of hex strings)
-    - full_file_hash (hex string)
+    - full_file_hash (hex string, see tree_file_hash)
     """
     block_hashes = []
-    hasher = hashlib.sha256()
-    
-    with open(file_path, "rb") as f:
-        while True:
-            chunk = f.read(BLOCK_SIZE)
-            if not chunk:
-                break
-            
-            # Hash for this block
-            block_sha = hashlib.sha256(chunk).hexdigest()
-            block_hashes.append(block_sha)
-            
-            # Update full file hash
-            hasher.update(chunk)
-            
+    hasher = HASH_ALGORITHMS[algo]()
+
+    for digests in iter_block_digests(file_path, algo, block_size):
+        hasher.update(b"".join(digests))
+        block_hashes.extend(d.hex() for d in digests)
+
     return len(block_hashes), block_hashes, hasher.hexdigest()
 
+class BlockHasher:
+    """
+    Incremental version of get_file_block_hashes for data that arrives in
+    arbitrary pieces (e.g. straight off a socket).
+    With keep_hashes=False only the full-file hash is tracked.
+    """
+    def __init__(self, keep_hashes=True, algo="sha256", block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.block_hashes = [] if keep_hashes else None
+        self.total_blocks = 0
+        self.new_hash = HASH_ALGORITHMS[algo]
+        self.hasher = self.new_hash()
+        self.pending = bytearray()
+
+    def _add_block(self, data):
+        digest = self.new_hash(data).digest()
+        self.hasher.update(digest)
+        self.total_blocks += 1
+        if self.block_hashes is not None:
+            self.block_hashes.append(digest.hex())
+
+    def update(self, data):
+        self.pending += data
+        if len(self.pending) >= self.block_size:
+            view = memoryview(self.pending)
+            end = len(self.pending) - len(self.pending) % self.block_size
+            for start in range(0, end, self.block_size):
+                self._add_block(view[start:start + self.block_size])
+            view.release()
+            del self.pending[:end]
+
+    def finish(self):
+        """Returns (total_blocks, block_hashes, full_file_hash), same as get_file_block_hashes."""
+        if self.pending:
+            self._add_block(self.pending)
+            self.pending = bytearray()
+        return self.total_blocks, self.block_hashes, self.hasher.hexdigest()
+
 def get_file_block(file_path, block_index):
     """
     Reads and returns the raw data for a specific block index.
@@ -35,3 +215,1023 @@ def get_file_block(file_path, block_index):
     with open(file_path, "rb") as f:
         f.seek(block_index * BLOCK_SIZE)
         return f.read(BLOCK_SIZE)
+
+@contextmanager
+def map_for_read(f, offset=0, length=None):
+    """
+    Read-only memoryview of `length` bytes (default: to EOF) of the open file
+    `f` from `offset` (a multiple of mmap.ALLOCATIONGRANULARITY), or None if
+    the range is empty or cannot be mapped. Slices must not outlive the block.
+    """
+    size = max(0, os.fstat(f.fileno()).st_size - offset)
+    if length is not None:
+        size = min(size, length)
+
+    mapped = None
+    if MMAP_IO and size:
+        try:
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ, offset=offset)
+        except (OSError, ValueError):
+            mapped = None
+    if mapped is None:
+        yield None
+        return
+
+    if hasattr(mapped, "madvise"):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapped)
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            pass  # a slice escaped (e.g. on an exception); unmapped when it is freed
+
+def recv_exact(sock, size):
+    """
+    Reads exactly `size` bytes from the socket straight into one
+    preallocated bytearray (recv_into, no chunk concatenation).
+    Returns fewer bytes only if the peer closed the connection.
+    """
+    data = bytearray(size)
+    with memoryview(data) as view:
+        received = recv_into_exact(sock, view)
+    if received < size:
+        del data[received:]
+    return data
+
+def recv_into_exact(sock, view):
+    """
+    Fills the writable buffer `view` from the socket without intermediate
+    copies. Returns the byte count (short only if the peer closed).
+    """
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:], min(65536, len(view) - received))
+        if not n:
+            break
+        received += n
+    return received
+
+class SocketReader:
+    """
+    Exact-size reads for per-block loops: every read lands in one reusable
+    buffer (grown on demand) through recv_into, so a stream of blocks costs
+    no allocation per block. Nothing is read ahead, so plain recv calls on
+    the same socket stay in sync. The returned memoryview is only valid
+    until the next read.
+    """
+    def __init__(self, sock, size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def recv_exactly(self, size):
+        """The next `size` bytes (fewer only if the peer closed)."""
+        if size > len(self.buffer):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+        target = self.view[:size]
+        return target[:recv_into_exact(self.sock, target)]
+
+class SocketWriter:
+    """
+    Batches small writes (headers, ACKs, small blocks) into one send; a
+    buffer of COALESCE_SIZE or more goes out together with what is pending
+    in one gathered write. Sends always complete (send_parts), so a partial
+    write never loses data. flush() before waiting for the peer's reply.
+    """
+    def __init__(self, sock, limit=COALESCE_SIZE):
+        self.sock = sock
+        self.limit = limit
+        self.pending = bytearray()
+
+    def write(self, *parts):
+        for part in parts:
+            if len(part) >= self.limit:
+                send_parts(self.sock, self.pending, part)
+                self.pending = bytearray()
+            else:
+                self.pending += part  # copied: the caller may reuse its buffer
+        if len(self.pending) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            send_parts(self.sock, self.pending)
+            self.pending = bytearray()
+
+def send_parts(sock, *parts):
+    """
+    Sends several buffers as one gathered write (sendmsg), so a header and a
+    memoryview slice of a mapped file go out without being concatenated.
+    """
+    if not hasattr(sock, "sendmsg"):  # Windows
+        for part in parts:
+            sock.sendall(part)
+        return
+
+    views = [memoryview(part) for part in parts if len(part)]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+# ---------------------------------------------------------------------------
+# Binary block manifest
+# ---------------------------------------------------------------------------
+
+def send_binary_manifest(sock, file_path, hash_spec=DEFAULT_HASH, block_size=BLOCK_SIZE):
+    """
+    Hashes the file (in parallel segments) and streams its manifest as it goes:
+    header, then one raw block digest per block (truncated to the negotiated
+    length), then the raw full-strength full-file hash.
+    Returns (total_blocks, full_file_hash).
+    """
+    algo, digest_len = hash_spec
+    total_blocks = (os.path.getsize(file_path) + block_size - 1) // block_size
+    sock.sendall(MANIFEST_MAGIC + block_size.to_bytes(4, 'big')
+                 + digest_len.to_bytes(1, 'big') + total_blocks.to_bytes(8, 'big'))
+
+    hasher = HASH_ALGORITHMS[algo]()
+    sent = 0
+    for digests in iter_block_digests(file_path, algo, block_size):
+        digests = digests[:total_blocks - sent]
+        data = b"".join(digests)
+        hasher.update(data)
+        if digest_len < 32:
+            data = b"".join(d[:digest_len] for d in digests)
+        sock.sendall(data)
+        sent += len(digests)
+        if sent == total_blocks:
+            break
+
+    sock.sendall(hasher.digest())
+    return total_blocks, hasher.hexdigest()
+
+def parse_manifest_header(header, expected_digest_len=32, expected_block_size=BLOCK_SIZE):
+    """
+    Validates a binary manifest header against the negotiated digest length
+    and block size.
+    Returns (total_blocks, digest_len), or None if it is not one we can compare.
+    """
+    if len(header) < MANIFEST_HEADER_SIZE or header[:4] != MANIFEST_MAGIC:
+        return None
+    block_size = int.from_bytes(header[4:8], 'big')
+    digest_len = header[8]
+    if block_size != expected_block_size or digest_len != expected_digest_len:
+        return None
+    return int.from_bytes(header[9:17], 'big'), digest_len
+
+def diff_digest_batch(data, first_index, digest_len, server_hashes, missing_blocks, expected=None):
+    """
+    Compares a batch of packed raw digests (block `first_index` onwards)
+    with the server's hex hashes and appends mismatching indices to `missing_blocks`.
+    Truncated digests are compared with the same prefix of ours.
+    If `expected` is a dict, the client's digest of each mismatching block is
+    kept there so the block can be verified when it arrives.
+    """
+    hex_len = digest_len * 2
+    for i in range(len(data) // digest_len):
+        index = first_index + i
+        digest = data[i * digest_len:(i + 1) * digest_len].hex()
+        if index >= len(server_hashes) or server_hashes[index][:hex_len] != digest:
+            missing_blocks.append(index)
+            if expected is not None:
+                expected[index] = digest
+
+def recv_binary_manifest(sock, server_hashes, expected=None, digest_len=32, block_size=BLOCK_SIZE):
+    """
+    Parses a binary manifest batch by batch and compares each digest with
+    the server's hex block hashes without keeping the client's list
+    (only the digests of missing blocks go into `expected`, if given).
+    Returns (total_blocks, missing_blocks, full_file_hash),
+    or None if the manifest is malformed or truncated.
+    """
+    header = parse_manifest_header(recv_exact(sock, MANIFEST_HEADER_SIZE), digest_len, block_size)
+    if header is None:
+        return None
+    total_blocks, digest_len = header
+
+    missing_blocks = []
+    index = 0
+    reader = SocketReader(sock, MANIFEST_BATCH * digest_len)
+    while index < total_blocks:
+        count = min(MANIFEST_BATCH, total_blocks - index)
+        data = reader.recv_exactly(count * digest_len)
+        if len(data) < count * digest_len:
+            return None
+        diff_digest_batch(data, index, digest_len, server_hashes, missing_blocks, expected)
+        index += count
+
+    file_hash = recv_exact(sock, 32)
+    if len(file_hash) < 32:
+        return None
+    return total_blocks, missing_blocks, file_hash.hex()
+
+def parse_hash_spec(text):
+    """Parses "<algo>-<digest bytes>" (e.g. "blake2b-16"). Returns a tuple or None."""
+    algo, _, length = text.rpartition("-")
+    try:
+        return algo, int(length)
+    except ValueError:
+        return None
+
+def negotiate_hash_spec(spec):
+    """
+    Server side of the hash negotiation: accepts a known algorithm with a
+    digest of MIN_DIGEST_LEN..32 bytes, otherwise falls back to DEFAULT_HASH.
+    Truncation is safe because the full-file hash is still full strength.
+    """
+    if spec is None:
+        return DEFAULT_HASH
+    algo, digest_len = spec
+    if algo not in HASH_ALGORITHMS or not MIN_DIGEST_LEN <= digest_len <= 32:
+        return DEFAULT_HASH
+    return spec
+
+def format_hash_spec(spec):
+    return f"{spec[0]}-{spec[1]}"
+
+def adaptive_block_size(file_size, digest_len=32, edit_runs=None):
+    """
+    Block size for a file of `file_size` bytes, as a power of two in
+    [MIN_BLOCK_SIZE, MAX_BLOCK_SIZE]. A sync costs about
+    (file_size / B) * digest_len manifest bytes plus ~B per edited region,
+    which is smallest at B = sqrt(file_size * digest_len / edit_runs).
+    Without history (edit_runs=None) this is about sqrt(file_size).
+    """
+    if edit_runs is None:
+        target = math.sqrt(file_size)
+    else:
+        target = math.sqrt(file_size * digest_len / max(1.0, edit_runs))
+    size = 1 << max(0, round(math.log2(max(1.0, target))))
+    return min(MAX_BLOCK_SIZE, max(MIN_BLOCK_SIZE, size))
+
+def valid_block_size(block_size):
+    return (MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE
+            and block_size & (block_size - 1) == 0)
+
+def block_runs(block_indices):
+    """Sorted block indices as [start, length] runs."""
+    runs = []
+    for idx in block_indices:
+        if runs and runs[-1][0] + runs[-1][1] == idx:
+            runs[-1][1] += 1
+        else:
+            runs.append([idx, 1])
+    return runs
+
+def parse_ack(response, keyword="ACK"):
+    """
+    Parses a handshake reply "ACK [KEY=value ...]" into a dict of the
+    options the server agreed to. Returns None if it is not an ACK
+    (or `keyword`, e.g. "OK" for UPLOAD).
+    """
+    parts = response.split()
+    if not parts or parts[0] != keyword:
+        return None
+    return dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+
+def encode_block_ranges(block_indices):
+    """
+    Run-length encodes sorted block indices:
+    b"R" + range count (4) + [start (8) + length (4)] * count
+    """
+    ranges = block_runs(block_indices)
+    parts = [b"R", len(ranges).to_bytes(4, 'big')]
+    for start, length in ranges:
+        parts.append(start.to_bytes(8, 'big') + length.to_bytes(4, 'big'))
+    return b"".join(parts)
+
+def recv_block_ranges(sock):
+    """
+    Reads a range list sent with encode_block_ranges.
+    Returns the expanded list of block indices, or None on a bad frame.
+    """
+    header = recv_exact(sock, 5)
+    if len(header) < 5 or header[:1] != b"R":
+        return None
+    count = int.from_bytes(header[1:], 'big')
+    data = recv_exact(sock, count * 12)
+    if len(data) < count * 12:
+        return None
+
+    block_indices = []
+    for i in range(count):
+        start = int.from_bytes(data[i * 12:i * 12 + 8], 'big')
+        length = int.from_bytes(data[i * 12 + 8:i * 12 + 12], 'big')
+        block_indices.extend(range(start, start + length))
+    return block_indices
+
+def recv_delta_blocks(sock, f, block_count, progress=None, compressed=False, block_size=BLOCK_SIZE):
+    """
+    Receives `block_count` blocks streamed with send_delta_blocks(window=0)
+    and writes each one at its offset in the open file `f`.
+    With `compressed` each block is Index (4) + a compression frame.
+    Returns the number of data bytes received, or None if the stream broke.
+    """
+    header_size = 4 + compression.FRAME_HEADER_SIZE if compressed else 8
+    received = 0
+    reader = SocketReader(sock, block_size)
+    for count in range(1, block_count + 1):
+        header = recv_exact(sock, header_size)
+        if len(header) < header_size:
+            return None
+        idx = int.from_bytes(header[:4], 'big')
+
+        if compressed:
+            data = compression.recv_frame_body(sock, header[4:], reader, block_size)
+            if data is None:
+                return None
+            length = len(data)
+        else:
+            length = int.from_bytes(header[4:], 'big')
+            data = reader.recv_exactly(length)
+            if len(data) < length:
+                return None
+        f.seek(idx * block_size)
+        f.write(data)
+
+        received += length
+        if progress:
+            progress(count)
+    return received
+
+def recv_delta_download(sock, file_path, progress=None, compressed=False, block_size=BLOCK_SIZE):
+    """
+    Client side of DOWNLOAD_DELTA once the server has sent ACK.
+    Sends the manifest of the local copy, rebuilds the server's version in a
+    temp file from it plus the received blocks, verifies the full-file hash
+    and only then replaces `file_path`. `compressed` is set when the ACK
+    carried COMPRESS=, `block_size` is the one it announced with BLOCK=.
+    `progress(received_count, blocks_to_receive)` is called after each block.
+    Returns (ok, blocks_received, total_blocks).
+    """
+    send_binary_manifest(sock, file_path, block_size=block_size)
+
+    header = recv_exact(sock, 40)
+    if len(header) < 40:
+        return False, 0, 0
+    new_size = int.from_bytes(header[:8], 'big')
+    file_hash = header[8:].hex()
+    total_blocks = (new_size + block_size - 1) // block_size
+
+    blocks = recv_block_ranges(sock)
+    if blocks is None:
+        return False, 0, total_blocks
+
+    temp_path = file_path + ".tmp"
+    shutil.copy2(file_path, temp_path)
+    try:
+        with open(temp_path, "r+b") as f:
+            on_block = (lambda count: progress(count, len(blocks))) if progress else None
+            received = recv_delta_blocks(sock, f, len(blocks), on_block, compressed, block_size)
+            f.truncate(new_size)
+
+        if received is not None:
+            _, _, new_hash = get_file_block_hashes(temp_path, block_size=block_size)
+            if new_hash == file_hash:
+                os.replace(temp_path, file_path)
+                return True, len(blocks), total_blocks
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)  # failed or cut off: the local file stays as it was
+    return False, len(blocks), total_blocks
+
+# ---------------------------------------------------------------------------
+# Merkle tree exchange
+# ---------------------------------------------------------------------------
+
+def build_merkle_tree(leaf_digests):
+    """
+    Builds a MERKLE_FANOUT-ary tree over raw block digests.
+    Returns the levels bottom-up: levels[0] are the leaves, levels[-1] == [root].
+    The shape depends only on the leaf count, so both sides build identical trees.
+    """
+    levels = [list(leaf_digests)]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        levels.append([
+            hashlib.sha256(b"".join(below[i:i + MERKLE_FANOUT])).digest()
+            for i in range(0, len(below), MERKLE_FANOUT)
+        ])
+    return levels
+
+def merkle_children(nodes, level_below_len):
+    """Indices of the children of `nodes` in the level below."""
+    children = []
+    for node in nodes:
+        children.extend(range(node * MERKLE_FANOUT, min((node + 1) * MERKLE_FANOUT, level_below_len)))
+    return children
+
+def pack_bitmap(flags):
+    """Packs booleans LSB-first: flag k is bit k % 8 of byte k // 8."""
+    bitmap = bytearray((len(flags) + 7) // 8)
+    for k, flag in enumerate(flags):
+        if flag:
+            bitmap[k // 8] |= 1 << (k % 8)
+    return bytes(bitmap)
+
+def merkle_exchange_client(sock, block_hashes):
+    """
+    Client side of the top-down exchange. Each round sends
+    count (4) + digests of the current frontier; the server answers with a
+    bitmap of the nodes that differ, and only their children are sent next.
+    Returns (missing_blocks, hash_bytes_sent), or None on a bad reply.
+    """
+    if not block_hashes:
+        return [], 0
+
+    levels = build_merkle_tree(bytes.fromhex(h) for h in block_hashes)
+    frontier = [0]
+    hash_bytes = 0
+
+    for level in range(len(levels) - 1, -1, -1):
+        digests = b"".join(levels[level][node] for node in frontier)
+        sock.sendall(len(frontier).to_bytes(4, 'big') + digests)
+        hash_bytes += len(digests)
+
+        bitmap = recv_exact(sock, (len(frontier) + 7) // 8)
+        if len(bitmap) < (len(frontier) + 7) // 8:
+            return None
+        differing = [node for k, node in enumerate(frontier) if bitmap[k // 8] >> (k % 8) & 1]
+
+        if level == 0 or not differing:
+            return (differing if level == 0 else []), hash_bytes
+        frontier = merkle_children(differing, len(levels[level - 1]))
+
+def build_server_merkle_tree(server_hashes, total_blocks):
+    """Server's tree sized to the client's block count (absent blocks never match)."""
+    leaves = [bytes.fromhex(h) for h in server_hashes[:total_blocks]]
+    leaves += [MERKLE_ABSENT_LEAF] * (total_blocks - len(leaves))
+    return build_merkle_tree(leaves)
+
+def merkle_exchange_server(sock, server_hashes, total_blocks, max_blocks, expected=None):
+    """
+    Server side of merkle_exchange_client. The server's tree is built over the
+    client's block count; blocks we do not have get MERKLE_ABSENT_LEAF.
+    A count above `max_blocks` (the size the client announced, in blocks) is
+    refused before anything is allocated.
+    The client's leaf digests of differing blocks go into `expected`, if given.
+    Returns (missing_blocks, rounds), or None if the client's frames are malformed.
+    """
+    if total_blocks > max_blocks:
+        return None
+    if total_blocks == 0:
+        return [], 0
+
+    levels = build_server_merkle_tree(server_hashes, total_blocks)
+    frontier = [0]
+    rounds = 0
+
+    for level in range(len(levels) - 1, -1, -1):
+        header = recv_exact(sock, 4)
+        if len(header) < 4 or int.from_bytes(header, 'big') != len(frontier):
+            return None
+        data = recv_exact(sock, len(frontier) * 32)
+        if len(data) < len(frontier) * 32:
+            return None
+
+        flags = [data[k * 32:(k + 1) * 32] != levels[level][node] for k, node in enumerate(frontier)]
+        sock.sendall(pack_bitmap(flags))
+        rounds += 1
+
+        differing = [node for node, flag in zip(frontier, flags) if flag]
+        if level == 0:
+            if expected is not None:
+                for k, node in enumerate(frontier):
+                    if flags[k]:
+                        expected[node] = data[k * 32:(k + 1) * 32].hex()
+            return differing, rounds
+        if not differing:
+            return [], rounds
+        frontier = merkle_children(differing, len(levels[level - 1]))
+
+# ---------------------------------------------------------------------------
+# Content-defined chunking (FastCDC)
+# ---------------------------------------------------------------------------
+
+# Gear table derived from SHA-256 so every client and server agree on it
+_GEAR = [int.from_bytes(hashlib.sha256(b"gear" + bytes([i])).digest()[:8], 'big') for i in range(256)]
+_MASK64 = (1 << 64) - 1
+
+def _cdc_mask(bits):
+    # High bits of the gear fingerprint depend on the last ~64 bytes
+    return ((1 << bits) - 1) << (64 - bits)
+
+def parse_cdc_params(text):
+    """Parses "min:avg:max". Returns a tuple or None."""
+    try:
+        min_size, avg_size, max_size = (int(v) for v in text.split(":"))
+    except ValueError:
+        return None
+    return min_size, avg_size, max_size
+
+def negotiate_cdc_params(params):
+    """
+    Server side of the chunk-size negotiation: accepts the client's
+    proposal when it is sane, otherwise falls back to CDC_DEFAULT_PARAMS.
+    """
+    if params is None:
+        return CDC_DEFAULT_PARAMS
+    min_size, avg_size, max_size = params
+    if not (CDC_MIN_SIZE_LIMIT <= min_size < avg_size < max_size <= CDC_MAX_SIZE_LIMIT):
+        return CDC_DEFAULT_PARAMS
+    return params
+
+def format_cdc_params(params):
+    return ":".join(str(v) for v in params)
+
+def _cdc_cut(buf, start, end, params):
+    """Length of the next chunk in buf[start:end] (FastCDC with normalized chunking)."""
+    min_size, avg_size, max_size = params
+    n = end - start
+    if n <= min_size:
+        return n
+
+    bits = max(1, avg_size.bit_length() - 1)
+    mask_s = _cdc_mask(bits + 1)  # stricter before the average size
+    mask_l = _cdc_mask(bits - 1)  # looser after it
+    gear = _GEAR
+
+    fp = 0
+    i = start + min_size
+    normal_end = start + min(avg_size, n)
+    while i < normal_end:
+        fp = ((fp << 1) + gear[buf[i]]) & _MASK64
+        i += 1
+        if not fp & mask_s:
+            return i - start
+    while i < end:
+        fp = ((fp << 1) + gear[buf[i]]) & _MASK64
+        i += 1
+        if not fp & mask_l:
+            return i - start
+    return n
+
+def iter_cdc_chunks(f, params):
+    """Yields the content-defined chunks (bytes) of an open file."""
+    max_size = params[2]
+    buf = f.read(max(DELTA_READ_SIZE, max_size))
+    pos = 0
+    while True:
+        if len(buf) - pos < max_size:
+            more = f.read(max(DELTA_READ_SIZE, max_size))
+            if more:
+                buf = buf[pos:] + more
+                pos = 0
+        if pos >= len(buf):
+            return
+        length = _cdc_cut(buf, pos, min(len(buf), pos + max_size), params)
+        yield buf[pos:pos + length]
+        pos += length
+
+def get_file_chunk_manifest(file_path, params):
+    """
+    Content-defined counterpart of get_file_block_hashes.
+    Returns (chunks, full_file_hash) with chunks as [[length, sha256_hex], ...].
+    """
+    chunks = []
+    hasher = BlockHasher(keep_hashes=False)
+    with open(file_path, "rb") as f:
+        for chunk in iter_cdc_chunks(f, params):
+            hasher.update(chunk)
+            chunks.append([len(chunk), hashlib.sha256(chunk).hexdigest()])
+    return chunks, hasher.finish()[2]
+
+def send_chunk_manifest(sock, file_path, params):
+    """
+    Streams the chunk manifest while chunking: Length (4) + raw SHA-256 (32)
+    per chunk, then a zero-length entry carrying the full-file hash.
+    Returns (chunk_locations, full_file_hash) with locations as (offset, length).
+    """
+    locations = []
+    hasher = BlockHasher(keep_hashes=False)
+    batch = []
+    offset = 0
+    with open(file_path, "rb") as f:
+        for chunk in iter_cdc_chunks(f, params):
+            hasher.update(chunk)
+            batch.append(len(chunk).to_bytes(4, 'big') + hashlib.sha256(chunk).digest())
+            locations.append((offset, len(chunk)))
+            offset += len(chunk)
+            if len(batch) == MANIFEST_BATCH:
+                sock.sendall(b"".join(batch))
+                batch = []
+
+    file_hash = hasher.finish()[2]
+    batch.append((0).to_bytes(4, 'big') + bytes.fromhex(file_hash))
+    sock.sendall(b"".join(batch))
+    return locations, file_hash
+
+def index_chunks(chunks):
+    """Maps each chunk digest to the first offset it occurs at."""
+    index = {}
+    offset = 0
+    for length, digest in chunks:
+        index.setdefault(digest, offset)
+        offset += length
+    return index
+
+def recv_chunk_manifest(sock, server_chunks):
+    """
+    Reads a manifest sent with send_chunk_manifest and plans the new file
+    against the server's chunks (any offset of the old file can be reused).
+    Returns (plan, missing_chunks, full_file_hash) where plan[i] is
+    [dst_offset, length, src_offset or None, sha256_hex], or None if malformed.
+    """
+    server_index = index_chunks(server_chunks)
+    plan = []
+    missing_chunks = []
+    dst_offset = 0
+    while True:
+        entry = recv_exact(sock, 36)
+        if len(entry) < 36:
+            return None
+        length = int.from_bytes(entry[:4], 'big')
+        digest = entry[4:].hex()
+        if length == 0:
+            return plan, missing_chunks, digest
+
+        src = server_index.get(digest)
+        if src is None:
+            missing_chunks.append(len(plan))
+        plan.append([dst_offset, length, src, digest])
+        dst_offset += length
+
+# ---------------------------------------------------------------------------
+# Delta block stream
+# ---------------------------------------------------------------------------
+
+def ack_interval(window):
+    """
+    How often the server sends a cumulative ACK in windowed mode.
+    Half the window keeps the pipe full; WINDOW=0 means no ACKs at all.
+    """
+    if not window:
+        return 0
+    return max(1, window // 2)
+
+def encode_window_ack(blocks_received):
+    """Cumulative ACK frame: b"A" + blocks received so far (4)."""
+    return b"A" + blocks_received.to_bytes(4, 'big')
+
+def send_delta_blocks(sock, file_path, missing_blocks, window=None, progress=None, chunks=None,
+                      block_size=BLOCK_SIZE, compressor=None):
+    """
+    Sends the requested blocks as Index (4) + Len (4) + Data.
+    Indices are fixed `block_size` blocks, or entries of `chunks`
+    ((offset, length) per chunk) for content-defined chunking.
+    With a compression.AdaptiveCompressor each block goes as Index (4) + frame.
+    - window=None: legacy mode, wait for "ACK" after every block
+    - window=N:    keep up to N blocks in flight, server ACKs cumulatively
+    - window=0:    stream everything, no ACKs
+    `progress(sent_count)` is called after each block.
+    Returns True if all blocks were sent and acknowledged.
+    """
+    interval = ack_interval(window)
+    acked = 0
+    count = 0
+    writer = SocketWriter(sock)  # small blocks share sends; flushed before every wait
+
+    with open(file_path, "rb") as f, map_for_read(f) as mapped:
+        for count, idx in enumerate(missing_blocks, 1):
+            if chunks is None:
+                offset, length = idx * block_size, block_size
+            else:
+                offset, length = chunks[idx]
+
+            if mapped is not None:
+                block_data = mapped[offset:offset + length]  # zero-copy slice
+            else:
+                f.seek(offset)
+                block_data = f.read(length)
+
+            if compressor is None:
+                header = idx.to_bytes(4, 'big') + len(block_data).to_bytes(4, 'big')
+                writer.write(header, block_data)
+            else:
+                # Batched frames are timed when they go out, so the link estimate
+                # still sums to bytes over time spent sending
+                frame_header, payload = compressor.frame(block_data)
+                header = idx.to_bytes(4, 'big') + frame_header
+                start = time.perf_counter()
+                writer.write(header, payload)
+                compressor.sent(len(header) + len(payload), time.perf_counter() - start)
+                del payload
+            del block_data
+
+            if window is None:
+                writer.flush()
+                if sock.recv(1024).decode() != "ACK":
+                    print(f"[-] Block {idx} upload failed")
+                    return False
+            elif window:
+                if count - acked >= window:
+                    writer.flush()
+                while count - acked >= window:
+                    frame = recv_exact(sock, 5)
+                    if len(frame) < 5 or frame[:1] != b"A":
+                        print(f"[-] Lost ACK stream after block {idx}")
+                        return False
+                    acked = int.from_bytes(frame[1:], 'big')
+
+            if progress:
+                progress(count)
+
+    writer.flush()
+
+    # Drain the cumulative ACKs still on their way so the status frame is next
+    if interval:
+        while acked < count - count % interval:
+            frame = recv_exact(sock, 5)
+            if len(frame) < 5 or frame[:1] != b"A":
+                return False
+            acked = int.from_bytes(frame[1:], 'big')
+    return True
+
+# ---------------------------------------------------------------------------
+# Plain file streaming
+# ---------------------------------------------------------------------------
+
+def send_file_range(sock, f, offset, count, progress=None):
+    """
+    Sends `count` bytes of the open file `f` starting at `offset`.
+    socket.sendfile uses os.sendfile where available, so the data goes
+    kernel-to-kernel without passing through Python.
+    `progress(bytes_sent)` is called after each window. Returns bytes sent.
+    """
+    sent = 0
+    while sent < count:
+        n = sock.sendfile(f, offset + sent, min(SENDFILE_WINDOW, count - sent))
+        if not n:
+            break
+        sent += n
+        if progress:
+            progress(sent)
+    return sent
+
+def recv_to_file(sock, f, size, buffer=None, on_data=None):
+    """
+    Receives exactly `size` bytes into the open file `f` using recv_into on a
+    single reusable buffer, so memory stays constant whatever the file size.
+    `on_data(view)` sees every chunk (e.g. for hashing or progress).
+    Returns bytes received (less than `size` only if the peer closed).
+    """
+    if buffer is None:
+        buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view, min(len(view), size - received))
+        if not n:
+            break
+        f.write(view[:n])
+        if on_data:
+            on_data(view[:n])
+        received += n
+    return received
+
+def list_files(sock, prefix="", fields=()):
+    """
+    The server's files through the paged LIST (see catalog.py), one page of
+    LIST_PAGE entries per request, so listings of any size arrive whole in
+    bounded memory. `fields` are any of SIZE, MTIME, HASH. Yields entry
+    dicts; raises ConnectionError if the reply is cut off or malformed.
+    """
+    cursor = None
+    while True:
+        command = ["LIST", f"LIMIT={LIST_PAGE}"]
+        if prefix:
+            command.append(f"PREFIX={prefix}")
+        if cursor:
+            command.append(f"CURSOR={cursor}")
+        sock.sendall(" ".join(command + list(fields)).encode())
+
+        header = recv_exact(sock, 10)
+        try:
+            body = recv_exact(sock, int(header.decode().strip()))
+            page = json.loads(body.decode())
+            entries, cursor = page["entries"], page["next"]
+        except (ValueError, KeyError):
+            raise ConnectionError("malformed LIST reply")
+        yield from entries
+        if cursor is None:
+            return
+
+# ---------------------------------------------------------------------------
+# Rolling checksum delta (rsync-style)
+# ---------------------------------------------------------------------------
+
+def weak_checksum(data):
+    """
+    Adler-32 of a block. Same value zlib.adler32 returns, so it can be
+    computed in C for whole blocks and rolled in Python one byte at a time.
+    """
+    return zlib.adler32(data)
+
+def roll_checksum(checksum, out_byte, in_byte, block_len):
+    """
+    Slides an Adler-32 window one byte forward:
+    drops `out_byte` from the front and appends `in_byte` at the back.
+    """
+    a = checksum & 0xffff
+    b = checksum >> 16
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - block_len * out_byte + a - 1) % ADLER_MOD
+    return (b << 16) | a
+
+def get_file_signature(file_path):
+    """
+    Builds the signature the server sends for rolling delta sync:
+    {"block_size", "file_size", "blocks": [[weak, strong_hex], ...]}
+    """
+    blocks = []
+    with open(file_path, "rb") as f, map_for_read(f) as mapped:
+        if mapped is not None:
+            for start in range(0, len(mapped), BLOCK_SIZE):
+                chunk = mapped[start:start + BLOCK_SIZE]
+                blocks.append([weak_checksum(chunk), hashlib.sha256(chunk).hexdigest()])
+                chunk.release()
+        else:
+            while True:
+                chunk = f.read(BLOCK_SIZE)
+                if not chunk:
+                    break
+                blocks.append([weak_checksum(chunk), hashlib.sha256(chunk).hexdigest()])
+
+    return {
+        "block_size": BLOCK_SIZE,
+        "file_size": os.path.getsize(file_path),
+        "blocks": blocks
+    }
+
+def compute_delta(file_path, signature):
+    """
+    Matches the local file against the server's signature at every byte offset.
+    Yields instructions:
+    - ("COPY", offset, length)  -> reuse a range of the server's file
+    - ("LITERAL", data)         -> raw bytes the server does not have
+    - ("END", file_hash)        -> full-file hash of the local file (last item)
+    """
+    block_size = signature["block_size"]
+
+    # weak -> {strong: block index}, first occurrence wins
+    table = {}
+    for index, (weak, strong) in enumerate(signature["blocks"]):
+        table.setdefault(weak, {}).setdefault(strong, index)
+
+    hasher = BlockHasher(keep_hashes=False)
+    literal = bytearray()
+    pending_copy = None  # [offset, length], extended while matches are contiguous
+
+    with open(file_path, "rb") as f:
+        buf = f.read(DELTA_READ_SIZE)
+        pos = 0
+        weak = None
+
+        while True:
+            # Keep at least one full window buffered
+            if len(buf) - pos < block_size:
+                more = f.read(DELTA_READ_SIZE)
+                if more:
+                    buf = buf[pos:] + more
+                    pos = 0
+                    continue
+                break
+
+            # The window is only sliced out when its checksum must be computed
+            # from scratch or the weak checksum hits: most offsets just roll
+            window = None
+            if weak is None:
+                window = buf[pos:pos + block_size]
+                weak = weak_checksum(window)
+
+            match = None
+            candidates = table.get(weak)
+            if candidates:
+                if window is None:
+                    window = buf[pos:pos + block_size]
+                match = candidates.get(hashlib.sha256(window).hexdigest())
+
+            if match is not None:
+                if literal:
+                    hasher.update(literal)
+                    yield ("LITERAL", bytes(literal))
+                    literal = bytearray()
+
+                offset = match * block_size
+                if (pending_copy and pending_copy[0] + pending_copy[1] == offset
+                        and pending_copy[1] + block_size <= COPY_MAX_LENGTH):
+                    pending_copy[1] += block_size
+                else:
+                    if pending_copy:
+                        yield ("COPY", pending_copy[0], pending_copy[1])
+                    pending_copy = [offset, block_size]
+
+                hasher.update(window)
+                pos += block_size
+                weak = None
+            else:
+                if pending_copy:
+                    yield ("COPY", pending_copy[0], pending_copy[1])
+                    pending_copy = None
+
+                out_byte = buf[pos]
+                literal.append(out_byte)
+                if pos + block_size < len(buf):
+                    weak = roll_checksum(weak, out_byte, buf[pos + block_size], block_size)
+                else:
+                    weak = None
+                pos += 1
+
+                if len(literal) >= LITERAL_FLUSH_SIZE:
+                    hasher.update(literal)
+                    yield ("LITERAL", bytes(literal))
+                    literal = bytearray()
+
+        # Tail shorter than a block: can only match the server's (short) last block
+        tail = buf[pos:]
+        if tail:
+            match = None
+            candidates = table.get(weak_checksum(tail))
+            if candidates:
+                match = candidates.get(hashlib.sha256(tail).hexdigest())
+
+            if match is not None:
+                if literal:
+                    hasher.update(literal)
+                    yield ("LITERAL", bytes(literal))
+                    literal = bytearray()
+                offset = match * block_size
+                if (pending_copy and pending_copy[0] + pending_copy[1] == offset
+                        and pending_copy[1] + len(tail) <= COPY_MAX_LENGTH):
+                    pending_copy[1] += len(tail)
+                else:
+                    if pending_copy:
+                        yield ("COPY", pending_copy[0], pending_copy[1])
+                    pending_copy = [offset, len(tail)]
+                hasher.update(tail)
+            else:
+                if pending_copy:
+                    yield ("COPY", pending_copy[0], pending_copy[1])
+                    pending_copy = None
+                literal += tail
+
+    if pending_copy:
+        yield ("COPY", pending_copy[0], pending_copy[1])
+    if literal:
+        hasher.update(literal)
+        yield ("LITERAL", bytes(literal))
+
+    yield ("END", hasher.finish()[2])
+
+def encode_delta_op(op):
+    """
+    Wire format of one delta instruction:
+    - COPY:    b"C" + offset (8) + length (4)
+    - LITERAL: b"L" + length (4) + data
+    - END:     b"E" + 64-char hex file hash
+    """
+    kind = op[0]
+    if kind == "COPY":
+        return b"C" + op[1].to_bytes(8, 'big') + op[2].to_bytes(4, 'big')
+    if kind == "LITERAL":
+        return b"L" + len(op[1]).to_bytes(4, 'big') + op[1]
+    return b"E" + op[1].encode()
+
+def recv_delta_op(sock):
+    """
+    Reads one delta instruction sent with encode_delta_op.
+    Returns None if the connection dropped mid-stream.
+    """
+    kind = recv_exact(sock, 1)
+    if kind == b"C":
+        header = recv_exact(sock, 12)
+        if len(header) < 12:
+            return None
+        return ("COPY", int.from_bytes(header[:8], 'big'), int.from_bytes(header[8:], 'big'))
+    if kind == b"L":
+        header = recv_exact(sock, 4)
+        if len(header) < 4:
+            return None
+        length = int.from_bytes(header, 'big')
+        if length > LITERAL_MAX_LENGTH:
+            return None  # never sent by compute_delta: out of sync or hostile
+        data = recv_exact(sock, length)
+        if len(data) < length:
+            return None
+        return ("LITERAL", data)
+    if kind == b"E":
+        file_hash = recv_exact(sock, 64)
+        if len(file_hash) < 64:
+            return None
+        return ("END", file_hash.decode())
+    return None